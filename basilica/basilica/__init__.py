@@ -1,134 +1,592 @@
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
+from concurrent.futures import Future, ProcessPoolExecutor
+from six.moves.urllib.parse import urlparse
 import base64
+import collections
+import functools
+import gzip
+import json
+import multiprocessing
 import requests
 import io
+import itertools
+import os
+import struct
 from PIL import Image
 import threading
+import time
+import uuid
 from six.moves.queue import Queue, Empty
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .balance import LoadBalancer
+from .batching import AdaptiveBatchSize, payload_bytes
+from .cache import EmbeddingCache, item_key, key_prefix
+from .coalesce import Coalescer
+from .files import image_sources, read_ahead
+from .hedge import HedgePolicy
+from .index import EmbeddingIndex
+from .metrics import Metrics, span
+from .quantization import Quantizer, QuantizedEmbeddings, cosine_similarity, dequantize, dot
+from .ratelimit import RateLimiter, backoff_delay
+from .shard import ShardedJob
+
 __version__ = '0.2.7'
 
+class EmbeddingError(Exception):
+    def __init__(self, error):
+        """Takes the place of the embedding of an instance that couldn't be embedded, when embedding with ``on_error='bisect'``.
+
+        :param error: What went wrong, such as the server's error response or the image failing to decode.
+        :type error: Exception
+        """
+        Exception.__init__(self, str(error))
+        self.error = error
+
 class Connection(object):
     def __init__(self, auth_key, server='https://api.basilica.ai',
-                 retries=2, backoff_factor=0.1, status_forcelist=(500)):
+                 retries=2, backoff_factor=0.1, status_forcelist=(500,),
+                 cache=None, wire_format='json', request_format='json', compression=None,
+                 rate_limit=None, metrics=None, hedge=None,
+                 pool_size=10, pool_block=False, keepalive_timeout=None, transport='http1',
+                 prewarm=0):
         """A connection to basilica.ai that can be used to generate embeddings.
 
         :param auth_key: Your auth key.  You can view your auth keys at https://basilica.ai/api-keys/.
         :type auth_key: str
-        :param server: What URL to use to connect to the server.
-        :type server: str
+        :param server: What URL to use to connect to the server.  Pass a list of URLs (or a :class:`basilica.LoadBalancer`) to spread requests across several servers by load and latency, and fail over between them.  Their stats are available from `balancer.stats()`.
+        :type server: Union[str, List[str], basilica.LoadBalancer]
         :param retries: Number of times to retry failed connections and requests.
         :type retries: int
-        :param backoff_factor: See urllib3.util.retry.Retry.backoff_factor .
+        :param backoff_factor: See urllib3.util.retry.Retry.backoff_factor .  Timed out requests are retried after a randomly jittered delay of up to this long, doubling on each attempt.
         :type backoff_factor: float
         :param status_forcelist: What HTTP response codes trigger a retry.
         :type status_forcelist: Tuple[int]
+        :param cache: Where to look up embeddings before asking the server for them.  Only the inputs that aren't in the cache are sent, and new embeddings are added to it.
+        :type cache: basilica.EmbeddingCache
+        :param wire_format: How to ask the server to send embeddings back.  ``'float32'`` and ``'float16'`` ask for a compact binary encoding, which is about a quarter (or an eighth) of the size of JSON and much faster to decode, and falls back to JSON if the server doesn't offer it.  These need numpy.  With ``'float16'``, embeddings lose some precision.
+        :type wire_format: str
+        :param request_format: How to send instances to the server.  ``'multipart'`` sends images as raw binary parts of a multipart/form-data body, rather than base64 inside JSON, which saves about a quarter of the upload.  Falls back to JSON if the server doesn't accept it.
+        :type request_format: str
+        :param compression: How to compress JSON request bodies: ``None``, ``'gzip'``, or ``'zstd'`` (which needs the `zstandard` package).  This mostly helps with text.  Falls back to no compression if the server doesn't accept it.
+        :type compression: str
+        :param rate_limit: What to pace requests with.  Share one between connections and threads using the same auth key to keep them all under its quota.  Whether or not one is given, requests turned away with a 429 are retried after the delay the server asks for, and hold back the connection's other requests in the meantime.
+        :type rate_limit: basilica.RateLimiter
+        :param metrics: Where to record counters, histograms and a timeline of each batch's stages, to see where the time goes.
+        :type metrics: basilica.Metrics
+        :param hedge: When to send a duplicate of a request that's slow to come back, taking whichever response arrives first, to cut tail latency.
+        :type hedge: basilica.HedgePolicy
+        :param pool_size: How many connections to keep open to each server.  Set this to at least the number of threads sharing the connection (times their `concurrency`), or connections will be opened and thrown away.
+        :type pool_size: int
+        :param pool_block: Whether to wait for a pooled connection to free up rather than opening an extra one, so that there are never more than `pool_size` connections to a server.
+        :type pool_block: bool
+        :param keepalive_timeout: How long to keep idle connections open, in seconds.  Defaults to as long as the server allows.
+        :type keepalive_timeout: float
+        :param transport: ``'http1'``, or ``'http2'`` to send all the requests to a server over a single multiplexed connection.  ``'http2'`` needs httpx (`pip install basilica[http2]`), and falls back to HTTP/1.1 if the server doesn't offer HTTP/2.
+        :type transport: str
+        :param prewarm: How many connections to each server to open straight away, so that the first requests don't wait for them.  (With HTTP/2, one is enough.)
+        :type prewarm: int
 
         >>> with basilica.Connection('SLOW_DEMO_KEY') as c:
         ...   print(c.embed_sentence('A sentence.'))
         [0.6246702671051025, ..., -0.03025037609040737]
         """
+        if wire_format not in _WIRE_FORMATS:
+            raise ValueError('`wire_format` argument must be one of %s (got `%s`)' % (_WIRE_FORMATS, wire_format))
+        if wire_format != 'json' and numpy is None:
+            raise ImportError('`wire_format=\'%s\'` requires numpy (`pip install numpy`)' % wire_format)
+        if request_format not in _REQUEST_FORMATS:
+            raise ValueError('`request_format` argument must be one of %s (got `%s`)' % (_REQUEST_FORMATS, request_format))
+        if compression not in _COMPRESSIONS:
+            raise ValueError('`compression` argument must be one of %s (got `%s`)' % (_COMPRESSIONS, compression))
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('`compression=\'zstd\'` requires zstandard (`pip install zstandard`)')
+        if transport not in _TRANSPORTS:
+            raise ValueError('`transport` argument must be one of %s (got `%s`)' % (_TRANSPORTS, transport))
+        self.balancer = None
+        if isinstance(server, (list, tuple)):
+            server = LoadBalancer(server)
+        if isinstance(server, LoadBalancer):
+            self.balancer = server
+            server = server.primary
         self.server = server
+        self.cache = cache
+        self.coalescer = None
+        self.wire_format = wire_format
+        self.request_format = request_format
+        self.compression = compression
+        self.rate_limit = rate_limit if rate_limit is not None else RateLimiter()
+        self.backoff_factor = backoff_factor
+        self.metrics = metrics
+        self.hedge = hedge
+        self.keepalive_timeout = keepalive_timeout
+        self.last_used = time.time()
         self.session = requests.Session()
         self.session.auth = (auth_key, '')
 
         self.retry = Retry(
             total=retries,
             read=retries,
-            connect=retries,
+            # With several servers, we'd rather fail over than retry.
+            connect=retries if self.balancer is None else 0,
             backoff_factor=backoff_factor,
             status_forcelist=status_forcelist,
         )
-        self.adapter = HTTPAdapter(max_retries=self.retry)
+        if transport == 'http2':
+            from .transport import HTTP2Adapter
+            self.adapter = HTTP2Adapter(pool_size=pool_size, pool_block=pool_block,
+                                        keepalive_timeout=keepalive_timeout,
+                                        connect_retries=self.retry.connect)
+        else:
+            endpoints = len(self.balancer.endpoints) if self.balancer is not None else 1
+            self.adapter = HTTPAdapter(max_retries=self.retry, pool_connections=max(10, endpoints),
+                                       pool_maxsize=pool_size, pool_block=pool_block)
         self.session.mount('http://', self.adapter)
         self.session.mount('https://', self.adapter)
+        if prewarm:
+            self.__prewarm(1 if transport == 'http2' else prewarm)
+
+    def __prewarm(self, connections):
+        # Any response will do, so long as it leaves a connection in the
+        # pool.  Each thread holds on to its response until they've all got
+        # one, so that they don't just reuse each other's connections.
+        if self.balancer is not None:
+            servers = [e.url for e in self.balancer.endpoints]
+        else:
+            servers = [self.server]
+        cond = threading.Condition()
+        waiting = [len(servers) * connections]
+        def warm(server):
+            res = None
+            try:
+                res = self.session.head(server, timeout=10, stream=True)
+            except requests.exceptions.RequestException:
+                pass
+            with cond:
+                waiting[0] -= 1
+                cond.notify_all()
+                while waiting[0] > 0:
+                    cond.wait()
+            if res is not None:
+                # Reading the (empty) body puts the connection back in the pool.
+                res.content
+        threads = [threading.Thread(target=warm, args=(server,))
+                   for server in servers for _ in range(connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
     def __enter__(self, *a, **kw):
         self.session.__enter__(*a, **kw)
         return self
 
     def __exit__(self, *a, **kw):
+        if self.coalescer is not None:
+            self.coalescer.close()
         return self.session.__exit__(*a, **kw)
 
-    def raw_embed(self, url, data, opts, timeout):
-        if type(url) != str:
-            raise ValueError('`url` argument must be a string (got `%s`)' % url)
-        if type(opts) != dict:
-            raise ValueError('`url` argument must be a dict (got `%s`)' % url)
-        if 'data' in opts:
-            raise ValueError('`opts` argument may not contain `data` key (got `%s`)' % opts)
-        query = opts.copy()
-        query['data'] = data
-        # For some reason the requests library doesn't retry timeouts
-        # on its own.  We don't bother with backoff.
-        for i in range(self.retry.read+1):
+    def enable_coalescing(self, max_wait_ms=5, max_batch_size=64, concurrency=4):
+        """Have single-instance calls (`embed_sentence`, `embed_image` and `embed_image_file`) from different threads share batches, instead of each making its own request.  This is useful when the connection is shared by many threads, e.g. in a web server.
+
+        :param max_wait_ms: The longest a call waits for others to join its batch, in milliseconds.
+        :type max_wait_ms: float
+        :param max_batch_size: The most instances to send in one batch.
+        :type max_batch_size: int
+        :param concurrency: How many batches to have in flight to the server at a time.
+        :type concurrency: int
+        :returns: The coalescer, whose `stats()` method reports latency percentiles and achieved batch sizes.
+        :rtype: basilica.Coalescer
+
+        >>> c = basilica.Connection('SLOW_DEMO_KEY')
+        >>> coalescer = c.enable_coalescing(max_wait_ms=2)
+        >>> # ... call c.embed_sentence from many threads ...
+        >>> coalescer.stats()['p99_latency_ms']
+        41.7
+        """
+        if self.coalescer is not None:
+            self.coalescer.close()
+        self.coalescer = Coalescer(self, max_wait_ms=max_wait_ms, max_batch_size=max_batch_size,
+                                   concurrency=concurrency)
+        return self.coalescer
+
+    def raw_embed(self, url, data, opts, timeout, retry_timeouts=True):
+        if self.hedge is None:
+            return self.__raw_embed(url, data, opts, timeout, retry_timeouts)
+        return self.__raw_embed_hedged(url, data, opts, timeout, retry_timeouts)
+
+    def __raw_embed_hedged(self, url, data, opts, timeout, retry_timeouts):
+        # requests can't cancel a request in flight, so the loser of a race
+        # is left to finish in the background and its response dropped.
+        hedge = self.hedge
+        results = Queue()
+        def attempt(hedged):
+            start = time.time()
             try:
-                headers = { 'User-Agent': 'Basilica Python Client (%s)' % __version__ }
-                res = self.session.post(url, json=query, timeout=timeout, headers=headers)
+                emb = self.__raw_embed(url, data, opts, timeout, retry_timeouts)
+            except Exception as err:
+                results.put((hedged, False, err))
+                return
+            hedge.record(time.time() - start)
+            results.put((hedged, True, emb))
+        delay = hedge.delay()
+        if delay is None:
+            attempt(False)
+            attempts = 1
+        else:
+            _start_thread(attempt, False)
+            attempts = 1
+            try:
+                # Put it back for the loop below.
+                results.put(results.get(timeout=delay))
+            except Empty:
+                if hedge.allow():
+                    if self.metrics is not None:
+                        self.metrics.count('hedges')
+                    _start_thread(attempt, True)
+                    attempts = 2
+        error = None
+        for _ in range(attempts):
+            hedged, ok, value = results.get()
+            if ok:
+                if hedged:
+                    hedge.won()
+                return value
+            error = error or value
+        raise error
+
+    def __raw_embed(self, url, data, opts, timeout, retry_timeouts):
+        query = _embed_query(url, data, opts)
+        res = self.__post(url, query, timeout, retry_timeouts)
+        if res.status_code == 415 and (self.request_format != 'json' or self.compression is not None):
+            # The server doesn't understand how we sent the request, so
+            # stick to plain JSON from now on.
+            self.request_format = 'json'
+            self.compression = None
+            res = self.__post(url, query, timeout, retry_timeouts)
+        res.raise_for_status()
+        with span(self.metrics, 'decode', items=len(data)):
+            if res.headers.get('Content-Type', '').startswith(_BINARY_TYPE):
+                emb = _decode_binary(res.content, res.headers['Content-Type'])
+            else:
+                emb = _embeddings(res.json())
+        if self.metrics is not None:
+            self.metrics.count('batches')
+            self.metrics.count('items', len(emb))
+        return emb
+
+    def __post(self, url, query, timeout, retry_timeouts):
+        with span(self.metrics, 'serialize', items=len(query['data'])):
+            body, headers = self.__body(query)
+        # urllib3 won't retry POSTs, so we retry timeouts and
+        # `status_forcelist` responses here.  429s are left to the rate
+        # limiter, since their backoff is shared with every other request
+        # using it.
+        retries = self.retry.read if retry_timeouts else 0
+        limiter = self.rate_limit
+        metrics = self.metrics
+        i = 0
+        throttles = 0
+        while True:
+            limiter.acquire(len(query['data']))
+            try:
+                with span(metrics, 'request', items=len(query['data']), bytes=len(body)):
+                    if metrics is not None:
+                        metrics.count('requests')
+                        metrics.count('bytes_sent', len(body))
+                    res = self.__send(url, body, timeout, headers)
+                    if metrics is not None:
+                        metrics.count('bytes_received', len(res.content))
             except requests.exceptions.Timeout:
-                if i < self.retry.read:
+                if metrics is not None:
+                    metrics.count('timeouts')
+                if i < retries:
+                    if metrics is not None:
+                        metrics.count('retries')
+                    time.sleep(backoff_delay(self.backoff_factor, i))
+                    i += 1
                     continue
                 else:
                     raise
-            break
-        res.raise_for_status()
-        out = res.json()
-        if 'error' in out:
-            raise RuntimeError('basilica.ai server returned error: `%s`' % out['error'])
-        if 'embeddings' not in out:
-            raise RuntimeError('basilica.ai server did not return embeddings: `%s`' % out)
-        return out['embeddings']
-
-    def embed(self, url, data, batch_size, opts, timeout):
-        batch_queue = Queue(maxsize=1)
+            except requests.exceptions.ConnectionError:
+                # With several servers, try another one.  (With just one,
+                # urllib3 has already retried.)
+                if self.balancer is None or i >= self.retry.total:
+                    raise
+                if metrics is not None:
+                    metrics.count('retries')
+                time.sleep(backoff_delay(self.backoff_factor, i))
+                i += 1
+                continue
+            if res.status_code == 429 and throttles < limiter.retries:
+                if metrics is not None:
+                    metrics.count('throttled')
+                    metrics.count('retries')
+                limiter.throttled(res.headers.get('Retry-After'))
+                throttles += 1
+                continue
+            if res.status_code != 429:
+                limiter.succeeded()
+            if res.status_code in self.retry.status_forcelist and i < self.retry.total:
+                if metrics is not None:
+                    metrics.count('retries')
+                time.sleep(backoff_delay(self.backoff_factor, i))
+                i += 1
+                continue
+            return res
+
+    def __send(self, url, body, timeout, headers):
+        now = time.time()
+        if (self.keepalive_timeout is not None and now - self.last_used > self.keepalive_timeout
+                and isinstance(self.adapter, HTTPAdapter)):
+            # urllib3 doesn't expire idle connections (httpx does), so drop
+            # them all if we've been idle that long.
+            self.adapter.close()
+        self.last_used = now
+        balancer = self.balancer
+        if balancer is None or not url.startswith(self.server):
+            return self.session.post(url, data=body, timeout=timeout, headers=headers)
+        endpoint = balancer.acquire()
+        start = time.time()
+        ok = False
+        try:
+            res = self.session.post(endpoint + url[len(self.server):], data=body,
+                                    timeout=timeout, headers=headers)
+            ok = res.status_code < 500
+            return res
+        finally:
+            balancer.release(endpoint, time.time() - start, ok)
+
+    def __body(self, query):
+        headers = _headers()
+        if self.wire_format != 'json':
+            headers['Accept'] = '%s; dtype=%s, application/json; q=0.5' % (_BINARY_TYPE, self.wire_format)
+        if self.request_format == 'multipart':
+            body, headers['Content-Type'] = _multipart_body(query)
+        elif self.compression is None:
+            body = _json_stream(query)
+            headers['Content-Type'] = 'application/json'
+        else:
+            body = _json_body(query)
+            headers['Content-Type'] = 'application/json'
+            if self.compression == 'gzip':
+                body = gzip.compress(body)
+                headers['Content-Encoding'] = 'gzip'
+            elif self.compression == 'zstd':
+                body = zstandard.ZstdCompressor().compress(body)
+                headers['Content-Encoding'] = 'zstd'
+        return body, headers
+
+    def embed(self, url, data, batch_size, opts, timeout, concurrency=1, output='list',
+              encode=None, preprocess_workers=0, dedup=0, on_error='raise'):
+        if type(concurrency) != int or concurrency < 1:
+            raise ValueError('`concurrency` argument must be a positive int (got `%s`)' % concurrency)
+        if output in _QUANTIZED_OUTPUTS:
+            output = Quantizer(output)
+        if not isinstance(output, Quantizer) and output not in _OUTPUTS:
+            raise ValueError('`output` argument must be one of %s or a `Quantizer` (got `%s`)'
+                             % (_OUTPUTS + _QUANTIZED_OUTPUTS, output))
+        if on_error not in _ON_ERRORS:
+            raise ValueError('`on_error` argument must be one of %s (got `%s`)' % (_ON_ERRORS, on_error))
+        if batch_size == 'auto':
+            batch_size = AdaptiveBatchSize()
+        if not isinstance(batch_size, AdaptiveBatchSize) and (type(batch_size) != int or batch_size < 1):
+            raise ValueError('`batch_size` argument must be a positive int or `auto` (got `%s`)' % batch_size)
+        chunks = self.__embed_chunks(url, data, batch_size, opts, timeout, concurrency,
+                                     encode, preprocess_workers, dedup, on_error)
+        if output == 'numpy':
+            return _stack(chunks, _length_hint(data))
+        if isinstance(output, Quantizer):
+            return output.stack(chunks, _length_hint(data))
+        return (_as_list(e) for chunk in chunks for e in chunk)
+
+    def __embed_chunks(self, url, data, batch_size, opts, timeout, concurrency,
+                       encode, preprocess_workers, dedup, on_error):
+        sizer = None
+        if isinstance(batch_size, AdaptiveBatchSize):
+            sizer = batch_size
+        batch_queue = Queue()
         emb_queue = Queue()
-        api_thread = threading.Thread(target=self.raw_embed_wrapper, args=(url, opts, timeout, batch_queue, emb_queue))
-        api_thread.setDaemon(True)
-        api_thread.start()
-        batch = []
-        for i in data:
-            batch.append(i)
-            if len(batch) >= batch_size:
-                try:
-                    emb = emb_queue.get(block=False)
-                    if isinstance(emb, Exception):
-                        batch_queue.put('DONE', block=True)
-                        raise emb
+        for _ in range(concurrency):
+            api_thread = threading.Thread(target=self.raw_embed_wrapper, args=(url, opts, timeout, batch_queue, emb_queue, sizer, on_error))
+            api_thread.daemon = True
+            api_thread.start()
+        executor = None
+        if encode is not None and preprocess_workers > 0:
+            # Forking a process with threads running (ours, and any
+            # coalescer or hedge threads) can deadlock the children.
+            executor = ProcessPoolExecutor(max_workers=preprocess_workers, mp_context=_process_context())
+        cache = self.cache
+        if cache is not None or dedup:
+            prefix = key_prefix(urlparse(url).path, opts)
+        job = _Job(batch_queue, emb_queue, cache, dedup, self.metrics)
+        # We let the input run at most `2*concurrency` batches ahead of the
+        # output, and buffer at most that many batches' worth of entries,
+        # so that one slow batch can't make us buffer the whole stream.
+        window = 2 * concurrency
+        limit = window * (sizer.maximum if sizer is not None else batch_size)
+        max_bytes = sizer.max_bytes if sizer is not None else None
+        try:
+            for item in data:
+                key = None
+                if cache is not None or dedup:
+                    key = item_key(prefix, item)
+                if not job.repeat(key):
+                    emb = cache.get(key) if cache is not None else None
+                    if emb is not None:
+                        job.hit(emb, key)
                     else:
-                        for e in emb:
-                            yield e
-                except Empty:
-                    pass
-                batch_queue.put(batch, block=True)
-                batch = []
-        if len(batch) > 0:
-            batch_queue.put(batch, block=True)
-        batch_queue.put('DONE', block=True)
-        while True:
-            emb = emb_queue.get(block=True)
-            if isinstance(emb, Exception):
-                raise emb
-            elif emb == 'DONE':
-                break
-            else:
-                for e in emb:
-                    yield e
+                        if executor is not None:
+                            item = executor.submit(encode, item)
+                        elif encode is not None:
+                            try:
+                                with span(self.metrics, 'encode'):
+                                    item = encode(item)
+                            except Exception as err:
+                                if on_error != 'bisect':
+                                    raise
+                                item = EmbeddingError(err)
+                        if isinstance(item, EmbeddingError):
+                            job.hit(item, key)
+                        else:
+                            job.miss(item, key)
+                if sizer is not None:
+                    full = len(job.batch) >= sizer.size or job.batch_bytes >= sizer.max_bytes
+                else:
+                    full = len(job.batch) >= batch_size
+                if full or len(job.entries) >= limit:
+                    while len(job.in_flight) >= window:
+                        job.collect(block=True)
+                        chunk = job.ready()
+                        if chunk:
+                            yield chunk
+                    job.send(max_bytes)
+                    job.collect(block=False)
+                    chunk = job.ready()
+                    if chunk:
+                        yield chunk
+                    while len(job.entries) >= limit:
+                        job.collect(block=True)
+                        chunk = job.ready()
+                        if chunk:
+                            yield chunk
+            while job.batch:
+                job.send(max_bytes)
+            while True:
+                chunk = job.ready()
+                if chunk:
+                    yield chunk
+                if not job.entries:
+                    break
+                job.collect(block=True)
+        finally:
+            for _ in range(concurrency):
+                batch_queue.put('DONE')
+            if executor is not None:
+                executor.shutdown(wait=False)
 
-    def raw_embed_wrapper(self, url, opts, timeout, batch_queue, emb_queue):
+    def raw_embed_wrapper(self, url, opts, timeout, batch_queue, emb_queue, sizer=None,
+                          on_error='raise'):
         while True:
+            item = batch_queue.get(block=True)
+            if item == 'DONE':
+                return None
+            seq, batch, queued = item
+            metrics = self.metrics
+            if metrics is not None:
+                metrics.record('queue_wait', queued, time.time() - queued, batch=seq)
             try:
-                batch = batch_queue.get(block=True)
-                if batch == 'DONE':
-                    emb_queue.put('DONE')
-                    return None
-                emb = self.raw_embed(url, batch, opts=opts, timeout=timeout)
-                emb_queue.put(emb)
+                with span(metrics, 'preprocess_wait', batch=seq):
+                    batch = [_resolve(i, on_error) for i in batch]
+                with span(metrics, 'batch', batch=seq, items=len(batch)):
+                    if on_error == 'bisect':
+                        emb = self.__raw_embed_bisect(url, batch, opts, timeout, sizer)
+                    else:
+                        emb = self.__raw_embed_batch(url, batch, opts, timeout, sizer)
+                emb_queue.put((seq, emb))
             except Exception as err:
-                emb_queue.put(err)
+                if metrics is not None:
+                    metrics.count('errors')
+                emb_queue.put((seq, err))
+
+    def __raw_embed_batch(self, url, batch, opts, timeout, sizer):
+        if sizer is None:
+            return self.raw_embed(url, batch, opts=opts, timeout=timeout)
+        return self.__raw_embed_adaptive(url, batch, opts, timeout, sizer)
+
+    def __raw_embed_bisect(self, url, batch, opts, timeout, sizer):
+        # Instances that failed to preprocess are already errors, and the
+        # rest are split in half until the server accepts them, or until
+        # we're down to the single instances it won't.
+        errors = [e for e in batch if isinstance(e, EmbeddingError)]
+        if errors:
+            rest = iter(self.__raw_embed_bisect(url, [e for e in batch if not isinstance(e, EmbeddingError)],
+                                                opts, timeout, sizer))
+            return [e if isinstance(e, EmbeddingError) else next(rest) for e in batch]
+        if not batch:
+            return []
+        try:
+            return self.__raw_embed_batch(url, batch, opts, timeout, sizer)
+        except Exception as err:
+            if not _bisectable(err):
+                raise
+            if len(batch) == 1:
+                if self.metrics is not None:
+                    self.metrics.count('failed_items')
+                return [EmbeddingError(err)]
+        half = len(batch) // 2
+        return _join(self.__raw_embed_bisect(url, batch[:half], opts, timeout, sizer),
+                     self.__raw_embed_bisect(url, batch[half:], opts, timeout, sizer))
+
+    def __raw_embed_adaptive(self, url, batch, opts, timeout, sizer):
+        # Batches whose payload turns out to be too big (which we can only
+        # tell once any `preprocess_workers` are done with them) are split
+        # into pieces that fit, and batches that time out are split in half
+        # rather than being resent as they are.  Only single instances get
+        # the usual timeout retries.
+        sizes = [payload_bytes(i) for i in batch]
+        if len(batch) > 1 and sum(sizes) > sizer.max_bytes:
+            emb = []
+            start = 0
+            while start < len(batch):
+                end = start + 1
+                total = sizes[start]
+                while end < len(batch) and total + sizes[end] <= sizer.max_bytes:
+                    total += sizes[end]
+                    end += 1
+                emb += self.__raw_embed_adaptive(url, batch[start:end], opts, timeout, sizer)
+                start = end
+            return emb
+        begin = time.time()
+        try:
+            emb = self.raw_embed(url, batch, opts=opts, timeout=timeout,
+                                 retry_timeouts=len(batch) == 1)
+        except requests.exceptions.Timeout:
+            sizer.timed_out()
+            if len(batch) == 1:
+                raise
+            return self.__raw_embed_halves(url, batch, opts, timeout, sizer)
+        sizer.record(time.time() - begin, timeout)
+        return emb
+
+    def __raw_embed_halves(self, url, batch, opts, timeout, sizer):
+        half = len(batch) // 2
+        return _join(self.__raw_embed_adaptive(url, batch[:half], opts, timeout, sizer),
+                     self.__raw_embed_adaptive(url, batch[half:], opts, timeout, sizer))
 
     def embed_images(self, images, model='generic', version='default',
-                     batch_size=32, opts={}, timeout=30):
+                     batch_size=32, opts={}, timeout=30, concurrency=1,
+                     preprocess_workers=0, output='list', dedup=0, on_error='raise'):
         """Generate embeddings for JPEG images.  Images should be passed as byte strings, and will be sent to the server in batches to be embedded.
 
         :param images: An iterable (such as a list) of the images to embed.
@@ -137,8 +595,8 @@ class Connection(object):
         :type model: str
         :param version: What version of that model to use.
         :type version: str
-        :param batch_size: How many instances to send to the server at a time.
-        :type batch_size: int
+        :param batch_size: How many instances to send to the server at a time.  Pass ``'auto'`` (or a :class:`basilica.AdaptiveBatchSize`) to adjust this as you go based on latency, timeouts and payload size.
+        :type batch_size: Union[int, str, basilica.AdaptiveBatchSize]
         :param opts: Options specific to the model/version you chose.
         :type opts: Dict[str, Any]
         :param opts["dimensions"]: Number of dimensions to return.  PCA will be used to reduce the number of dimensions with minimal information loss.
@@ -149,10 +607,22 @@ class Connection(object):
         :type opts["normalize_mean"]: bool
         :param opts["normalize_variance"]: Whether or not to normalize each feature in the embedding to have unit variance across our sample dataset.  Defaults to True when `dimensions` is set, or False otherwise.
         :type opts["normalize_variance"]: bool
+        :param opts["jpeg_quality"]: The JPEG quality (1 to 95) to re-encode images at, when they have to be resized or converted.  Images that are already RGB JPEGs of at most 512x512 are sent as they are.  Defaults to 75.
+        :type opts["jpeg_quality"]: int
         :param timeout: HTTP timeout for request.
         :type timeout: int
-        :returns: A generator of embeddings.
-        :rtype: Generator[List[float]]
+        :param concurrency: How many batches to have in flight to the server at a time.  Embeddings are still returned in the same order as the input.
+        :type concurrency: int
+        :param preprocess_workers: How many processes to use for resizing and re-encoding images ahead of the batches being uploaded.  With 0, images are prepared one at a time as they're batched.
+        :type preprocess_workers: int
+        :param output: ``'list'`` to get a generator of lists of floats, ``'numpy'`` to get a single float32 numpy array with one row per embedding, or ``'float16'``, ``'int8'`` or a :class:`basilica.Quantizer` to get them as :class:`basilica.QuantizedEmbeddings`, in a half or a quarter of the memory.
+        :type output: Union[str, basilica.Quantizer]
+        :param dedup: How many distinct recent inputs to remember, so that repeats of them in the same call are only sent to the server once.  Repeats get the same embedding object.  0 turns this off.
+        :type dedup: int
+        :param on_error: ``'raise'`` to stop at the first error, or ``'bisect'`` to split batches the server rejects until the instances at fault are found, and return a :class:`basilica.EmbeddingError` in place of each of those (or a row of NaNs, with ``output='numpy'``) while the rest carry on.
+        :type on_error: str
+        :returns: A generator of embeddings, or an array of them.
+        :rtype: Generator[List[float]] or numpy.ndarray or basilica.QuantizedEmbeddings
 
         >>> with basilica.Connection('SLOW_DEMO_KEY') as c:
         ...   images = []
@@ -165,11 +635,14 @@ class Connection(object):
         [-0.03025037609040737, ...]
         """
         url = '%s/embed/images/%s/%s' % (self.server, model, version)
-        data = ({'img': self.__encode_image(img, transform_image=opts.get("transform_image", True) )} for img in images)
-        return self.embed(url, data, batch_size=batch_size, opts=opts, timeout=timeout)
+        encode = _image_encoder(opts)
+        return self.embed(url, images, batch_size=batch_size, opts=opts, timeout=timeout,
+                          concurrency=concurrency, output=output, encode=encode,
+                          preprocess_workers=preprocess_workers, dedup=dedup,
+                          on_error=on_error)
 
     def embed_image(self, image, model='generic', version='default',
-                    opts={}, timeout=10):
+                    opts={}, timeout=10, output='list'):
         """Generate the embedding for a JPEG image.  The image should be passed as a byte string.
 
         :param image: The image to embed.
@@ -188,22 +661,34 @@ class Connection(object):
         :type opts["normalize_mean"]: bool
         :param opts["normalize_variance"]: Whether or not to normalize each feature in the embedding to have unit variance across our sample dataset.  Defaults to True when `dimensions` is set, or False otherwise.
         :type opts["normalize_variance"]: bool
+        :param opts["jpeg_quality"]: The JPEG quality (1 to 95) to re-encode images at, when they have to be resized or converted.  Images that are already RGB JPEGs of at most 512x512 are sent as they are.  Defaults to 75.
+        :type opts["jpeg_quality"]: int
         :param timeout: HTTP timeout for request.
         :type timeout: int
+        :param output: ``'list'`` to get a list of floats, or ``'numpy'`` to get a 1-D float32 numpy array.
+        :type output: str
         :returns: An embedding.
-        :rtype: List[float]
+        :rtype: List[float] or numpy.ndarray
 
         >>> with basilica.Connection('SLOW_DEMO_KEY') as c:
         ...   with open('img.jpg', 'rb') as f:
         ...     print(c.embed_image(f.read()))
         [0.6246702671051025, ...]
         """
+        if output not in _OUTPUTS:
+            raise ValueError('`output` argument must be one of %s (got `%s`)' % (_OUTPUTS, output))
+        if self.coalescer is not None:
+            url = '%s/embed/images/%s/%s' % (self.server, model, version)
+            encode = _image_encoder(opts)
+            return self.__embed_coalesced(url, image, opts, timeout, output, encode)
         return list(self.embed_images([image], model=model, version=version,
-                                      opts=opts, timeout=timeout))[0]
+                                      opts=opts, timeout=timeout, output=output))[0]
 
     def embed_image_files(self, image_files, model='generic', version='default',
-                          batch_size=32, opts={}, timeout=30):
-        """Generate embeddings for JPEG image files.  The file names should be passed as paths that can be understood by `open`.
+                          batch_size=32, opts={}, timeout=30, concurrency=1,
+                          preprocess_workers=0, output='list', dedup=0,
+                          on_error='raise', io_workers=4, prefetch=64):
+        """Generate embeddings for JPEG image files.  The file names should be passed as paths that can be understood by `open`.  Directories, glob patterns (like ``'photos/**/*.jpg'``), and tar and zip archives are expanded into the images they contain, in sorted order, without extracting anything to disk.
 
         :param image_files: An iterable (such as a list) of paths to the images to embed.
         :type image_files: Iterable[str]
@@ -211,8 +696,8 @@ class Connection(object):
         :type model: str
         :param version: What version of that model to use.
         :type version: str
-        :param batch_size: How many instances to send to the server at a time.
-        :type batch_size: int
+        :param batch_size: How many instances to send to the server at a time.  Pass ``'auto'`` (or a :class:`basilica.AdaptiveBatchSize`) to adjust this as you go based on latency, timeouts and payload size.
+        :type batch_size: Union[int, str, basilica.AdaptiveBatchSize]
         :param opts: Options specific to the model/version you chose.
         :type opts: Dict[str, Any]
         :param opts["dimensions"]: Number of dimensions to return.  PCA will be used to reduce the number of dimensions with minimal information loss.
@@ -223,10 +708,26 @@ class Connection(object):
         :type opts["normalize_mean"]: bool
         :param opts["normalize_variance"]: Whether or not to normalize each feature in the embedding to have unit variance across our sample dataset.  Defaults to True when `dimensions` is set, or False otherwise.
         :type opts["normalize_variance"]: bool
+        :param opts["jpeg_quality"]: The JPEG quality (1 to 95) to re-encode images at, when they have to be resized or converted.  Images that are already RGB JPEGs of at most 512x512 are sent as they are.  Defaults to 75.
+        :type opts["jpeg_quality"]: int
         :param timeout: HTTP timeout for request.
         :type timeout: int
-        :returns: A generator of embeddings.
-        :rtype: Generator[List[float]]
+        :param concurrency: How many batches to have in flight to the server at a time.  Embeddings are still returned in the same order as the input.
+        :type concurrency: int
+        :param preprocess_workers: How many processes to use for resizing and re-encoding images ahead of the batches being uploaded.  With 0, images are prepared one at a time as they're batched.
+        :type preprocess_workers: int
+        :param output: ``'list'`` to get a generator of lists of floats, ``'numpy'`` to get a single float32 numpy array with one row per embedding, or ``'float16'``, ``'int8'`` or a :class:`basilica.Quantizer` to get them as :class:`basilica.QuantizedEmbeddings`, in a half or a quarter of the memory.
+        :type output: Union[str, basilica.Quantizer]
+        :param dedup: How many distinct recent inputs to remember, so that repeats of them in the same call are only sent to the server once.  Repeats get the same embedding object.  0 turns this off.
+        :type dedup: int
+        :param on_error: ``'raise'`` to stop at the first error, or ``'bisect'`` to split batches the server rejects until the instances at fault are found, and return a :class:`basilica.EmbeddingError` in place of each of those (or a row of NaNs, with ``output='numpy'``) while the rest carry on.
+        :type on_error: str
+        :param io_workers: How many threads to read files with.  With 0, files are read one at a time as they're batched.
+        :type io_workers: int
+        :param prefetch: How many files to read ahead of the batches being sent.
+        :type prefetch: int
+        :returns: A generator of embeddings, or an array of them.
+        :rtype: Generator[List[float]] or numpy.ndarray or basilica.QuantizedEmbeddings
 
         >>> with basilica.Connection('SLOW_DEMO_KEY') as c:
         ...   for embedding in c.embed_image_files(['img1.jpg', 'img2.jpg']):
@@ -234,15 +735,14 @@ class Connection(object):
         [0.6246702671051025, ...]
         [-0.03025037609040737, ...]
         """
-        def load_image_files(image_files):
-            for image_file in image_files:
-                with open(image_file, 'rb') as f:
-                    yield f.read()
-        return self.embed_images(load_image_files(image_files), model=model, version=version,
-                                 batch_size=batch_size, opts=opts, timeout=timeout)
+        images = read_ahead(image_sources(image_files), io_workers, prefetch)
+        return self.embed_images(images, model=model, version=version,
+                                 batch_size=batch_size, opts=opts, timeout=timeout,
+                                 concurrency=concurrency, preprocess_workers=preprocess_workers,
+                                 output=output, dedup=dedup, on_error=on_error)
 
     def embed_image_file(self, image_file, model='generic', version='default',
-                         opts={}, timeout=10):
+                         opts={}, timeout=10, output='list'):
         """Generate the embedding for a JPEG image file.  The file name should be passed as a path that can be understood by `open`.
 
         :param image_file: Path to the image to embed.
@@ -261,11 +761,15 @@ class Connection(object):
         :type opts["normalize_mean"]: bool
         :param opts["normalize_variance"]: Whether or not to normalize each feature in the embedding to have unit variance across our sample dataset.  Defaults to True when `dimensions` is set, or False otherwise.
         :type opts["normalize_variance"]: bool
+        :param opts["jpeg_quality"]: The JPEG quality (1 to 95) to re-encode images at, when they have to be resized or converted.  Images that are already RGB JPEGs of at most 512x512 are sent as they are.  Defaults to 75.
+        :type opts["jpeg_quality"]: int
 
         :param timeout: HTTP timeout for request.
         :type timeout: int
+        :param output: ``'list'`` to get a list of floats, or ``'numpy'`` to get a 1-D float32 numpy array.
+        :type output: str
         :returns: An embedding.
-        :rtype: List[float]
+        :rtype: List[float] or numpy.ndarray
 
         >>> with basilica.Connection('SLOW_DEMO_KEY') as c:
         ...   print(c.embed_image_file('img.jpg')
@@ -273,10 +777,11 @@ class Connection(object):
         """
         with open(image_file, 'rb') as f:
             return self.embed_image(f.read(), model=model, version=version,
-                                    opts=opts, timeout=timeout)
+                                    opts=opts, timeout=timeout, output=output)
 
     def embed_sentences(self, sentences, model='english', version='default',
-                        batch_size=64, opts={}, timeout=15):
+                        batch_size=64, opts={}, timeout=15, concurrency=1,
+                        output='list', dedup=0, on_error='raise'):
         """Generate embeddings for sentences.
 
         :param sentences: An iterable (such as a list) of sentences to embed.
@@ -292,8 +797,8 @@ class Connection(object):
         :type model: str
         :param version: What version of that model to use.
         :type version: str
-        :param batch_size: How many instances to send to the server at a time.
-        :type batch_size: int
+        :param batch_size: How many instances to send to the server at a time.  Pass ``'auto'`` (or a :class:`basilica.AdaptiveBatchSize`) to adjust this as you go based on latency, timeouts and payload size.
+        :type batch_size: Union[int, str, basilica.AdaptiveBatchSize]
         :param opts: Options specific to the model/version you chose.
         :type opts: Dict[str, Any]
         :param opts["dimensions"]: Number of dimensions to return.  PCA will be used to reduce the number of dimensions with minimal information loss.
@@ -306,8 +811,16 @@ class Connection(object):
         :type opts["normalize_variance"]: bool
         :param timeout: HTTP timeout for request.
         :type timeout: int
-        :returns: A generator of embeddings.
-        :rtype: Generator[List[float]]
+        :param concurrency: How many batches to have in flight to the server at a time.  Embeddings are still returned in the same order as the input.
+        :type concurrency: int
+        :param output: ``'list'`` to get a generator of lists of floats, ``'numpy'`` to get a single float32 numpy array with one row per embedding, or ``'float16'``, ``'int8'`` or a :class:`basilica.Quantizer` to get them as :class:`basilica.QuantizedEmbeddings`, in a half or a quarter of the memory.
+        :type output: Union[str, basilica.Quantizer]
+        :param dedup: How many distinct recent inputs to remember, so that repeats of them in the same call are only sent to the server once.  Repeats get the same embedding object.  0 turns this off.
+        :type dedup: int
+        :param on_error: ``'raise'`` to stop at the first error, or ``'bisect'`` to split batches the server rejects until the instances at fault are found, and return a :class:`basilica.EmbeddingError` in place of each of those (or a row of NaNs, with ``output='numpy'``) while the rest carry on.
+        :type on_error: str
+        :returns: A generator of embeddings, or an array of them.
+        :rtype: Generator[List[float]] or numpy.ndarray or basilica.QuantizedEmbeddings
 
         >>> with basilica.Connection('SLOW_DEMO_KEY') as c:
         ...   for embedding in c.embed_sentences(['Sentence one.', 'Sentence two.']):
@@ -317,10 +830,12 @@ class Connection(object):
         """
         url = '%s/embed/text/%s/%s' % (self.server, model, version)
         data = sentences
-        return self.embed(url, data, batch_size=batch_size, opts=opts, timeout=timeout)
+        return self.embed(url, data, batch_size=batch_size, opts=opts, timeout=timeout,
+                          concurrency=concurrency, output=output, dedup=dedup,
+                          on_error=on_error)
 
     def embed_sentence(self, sentence, model='english', version='default',
-                       opts={}, timeout=5):
+                       opts={}, timeout=5, output='list'):
         """Generate the embedding for a sentence.
 
         :param sentence: The sentence to embed.
@@ -348,29 +863,537 @@ class Connection(object):
         :type opts["normalize_variance"]: bool
         :param timeout: HTTP timeout for request.
         :type timeout: int
+        :param output: ``'list'`` to get a list of floats, or ``'numpy'`` to get a 1-D float32 numpy array.
+        :type output: str
         :returns: An embedding.
-        :rtype: List[float]
+        :rtype: List[float] or numpy.ndarray
 
         >>> with basilica.Connection('SLOW_DEMO_KEY') as c:
         ...   print(c.embed_sentence('This is a sentence.')
         [0.6246702671051025, ...]
         """
+        if output not in _OUTPUTS:
+            raise ValueError('`output` argument must be one of %s (got `%s`)' % (_OUTPUTS, output))
+        if self.coalescer is not None:
+            url = '%s/embed/text/%s/%s' % (self.server, model, version)
+            return self.__embed_coalesced(url, sentence, opts, timeout, output)
         return list(self.embed_sentences([sentence], model=model, version=version,
-                                         opts=opts, timeout=timeout))[0]
+                                         opts=opts, timeout=timeout, output=output))[0]
+
+    def __embed_coalesced(self, url, item, opts, timeout, output, encode=None):
+        if output not in _OUTPUTS:
+            raise ValueError('`output` argument must be one of %s (got `%s`)' % (_OUTPUTS, output))
+        emb = None
+        if self.cache is not None:
+            key = item_key(key_prefix(urlparse(url).path, opts), item)
+            emb = self.cache.get(key)
+        if emb is None:
+            if encode is not None:
+                item = encode(item)
+            emb = self.coalescer.submit(url, item, opts, timeout).result()
+            if self.cache is not None:
+                self.cache.put_many([(key, emb)])
+        if output == 'numpy':
+            return _as_array(emb)
+        return _as_list(emb)
+
+    def embed_to_file(self, inputs, path, method='embed_sentences', count=None,
+                      checkpoint_rows=10000, progress=None, **kwargs):
+        """Generate embeddings for a large dataset straight into a `.npy` file, so that memory use doesn't grow with the size of the dataset.  Progress is recorded in a small journal next to the file (`path + '.journal'`), and calling this again with the same arguments after a crash picks up after the last recorded batch instead of starting over.
+
+        :param inputs: An iterable (such as a list) of the instances to embed.  When resuming, this must yield the same instances in the same order.
+        :type inputs: Iterable
+        :param path: Where to write the embeddings.  This will be a float32 numpy array with one row per instance, which you can open with ``numpy.load(path, mmap_mode='r')``.
+        :type path: str
+        :param method: Which method to embed the inputs with: ``'embed_sentences'``, ``'embed_images'``, or ``'embed_image_files'``.
+        :type method: str
+        :param count: How many instances there are.  Defaults to `len(inputs)`, or for ``'embed_image_files'`` the number of images the paths expand to.
+        :type count: int
+        :param checkpoint_rows: How many embeddings to write between checkpoints.  Each checkpoint flushes the file to disk and updates the journal.
+        :type checkpoint_rows: int
+        :param progress: A function to call with the row number and embedding of each instance as it's written.
+        :type progress: Callable[[int, List[float]], None]
+        :param kwargs: Other arguments (such as `model`, `opts` or `concurrency`) to pass to `method`.
+        :returns: The embeddings, memory-mapped read-only from `path`.
+        :rtype: numpy.ndarray
+
+        >>> with basilica.Connection('SLOW_DEMO_KEY') as c:
+        ...   embeddings = c.embed_to_file(sentences, 'embeddings.npy', concurrency=4)
+        """
+        if numpy is None:
+            raise ImportError('`embed_to_file` requires numpy (`pip install numpy`)')
+        if method not in _BULK_METHODS:
+            raise ValueError('`method` argument must be one of %s (got `%s`)' % (_BULK_METHODS, method))
+        if method == 'embed_image_files':
+            # Directories, globs and archives are expanded first, so that
+            # `count` and resuming are in images rather than paths.
+            if count is None:
+                inputs = list(inputs)
+                count = sum(1 for _ in image_sources(inputs))
+            inputs = image_sources(inputs)
+        elif count is None:
+            count = len(inputs)
+        journal = path + '.journal'
+        state = _read_journal(journal)
+        if state is not None and state['count'] != count:
+            raise ValueError('`%s` is for %d instances, not %d; remove it to start over'
+                             % (journal, state['count'], count))
+        out = None
+        done = 0
+        if state is not None:
+            out = numpy.lib.format.open_memmap(path, mode='r+')
+            done = state['done']
+        pending = 0
+        embeddings = getattr(self, method)(itertools.islice(inputs, done, None), **kwargs)
+        for e in embeddings:
+            if done + pending >= count:
+                raise ValueError('`inputs` had more than %d instances' % count)
+            if isinstance(e, EmbeddingError):
+                # With `on_error='bisect'`.  Rows before we know the
+                # dimension are filled in once we do.
+                if out is not None:
+                    out[done + pending] = numpy.nan
+            elif out is None:
+                out = numpy.lib.format.open_memmap(path, mode='w+', dtype=numpy.float32,
+                                                   shape=(count, len(e)))
+                out[:pending] = numpy.nan
+            elif pending == 0 and len(e) != out.shape[1]:
+                raise ValueError('`%s` has embeddings of dimension %d, not %d; remove `%s` to start over'
+                                 % (path, out.shape[1], len(e), journal))
+            if not isinstance(e, EmbeddingError):
+                out[done + pending] = e
+            if progress is not None:
+                progress(done + pending, e)
+            pending += 1
+            if pending >= checkpoint_rows and out is not None:
+                done += pending
+                pending = 0
+                out.flush()
+                _write_journal(journal, count, out.shape[1], done)
+        done += pending
+        if done != count:
+            raise ValueError('`inputs` had %d instances, expected %d' % (done, count))
+        if out is None:
+            out = numpy.lib.format.open_memmap(path, mode='w+', dtype=numpy.float32, shape=(count, 0))
+        out.flush()
+        _write_journal(journal, count, out.shape[1], done)
+        del out
+        return numpy.load(path, mmap_mode='r')
+
+
+def _headers():
+    return { 'User-Agent': 'Basilica Python Client (%s)' % __version__ }
+
+def _embed_query(url, data, opts):
+    if type(url) != str:
+        raise ValueError('`url` argument must be a string (got `%s`)' % url)
+    if type(opts) != dict:
+        raise ValueError('`url` argument must be a dict (got `%s`)' % url)
+    if 'data' in opts:
+        raise ValueError('`opts` argument may not contain `data` key (got `%s`)' % opts)
+    query = opts.copy()
+    query['data'] = data
+    return query
+
+_BULK_METHODS = ('embed_sentences', 'embed_images', 'embed_image_files')
+
+def _read_journal(journal):
+    if not os.path.exists(journal):
+        return None
+    with open(journal) as f:
+        return json.load(f)
 
-    def __encode_image(self, image, transform_image):
-        if type(image) != bytes:
-            raise TypeError('`image` argument must be bytes (got `%s`)' % (type(image).__name__))
-        if transform_image:
+def _write_journal(journal, count, dimensions, done):
+    # Written to a temporary file and renamed into place, so a crash
+    # leaves either the old journal or the new one.
+    tmp = journal + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'count': count, 'dimensions': dimensions, 'done': done}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, journal)
+
+def _process_context():
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+_TRANSPORTS = ('http1', 'http2')
+
+_WIRE_FORMATS = ('json', 'float32', 'float16')
+_REQUEST_FORMATS = ('json', 'multipart')
+_COMPRESSIONS = (None, 'gzip', 'zstd')
+
+def _json_body(query):
+    def encode_bytes(o):
+        if isinstance(o, bytes):
+            return base64.b64encode(o).decode('utf-8')
+        raise TypeError('Object of type %s is not JSON serializable' % type(o).__name__)
+    return json.dumps(query, default=encode_bytes).encode('utf-8')
+
+def _json_stream(query):
+    # The same JSON as `_json_body`, but with image instances
+    # (`{'img': bytes}`) base64ed a chunk at a time as they're sent.
+    opts = dict((k, v) for k, v in query.items() if k != 'data')
+    head = json.dumps(opts)[:-1] + (', ' if opts else '') + '"data": ['
+    pieces = [head.encode('utf-8')]
+    for i, item in enumerate(query['data']):
+        if i > 0:
+            pieces.append(b', ')
+        if _is_blob(item):
+            name, value = list(item.items())[0]
+            pieces.append(('{%s: "' % json.dumps(name)).encode('utf-8'))
+            pieces.append(_Base64(value))
+            pieces.append(b'"}')
+        else:
+            pieces.append(_json_body(item))
+    pieces.append(b']}')
+    return _Body(pieces)
+
+def _multipart_body(query):
+    # The options go in a JSON part named `opts`, followed by one part per
+    # instance, in order.  Image instances (`{'img': bytes}`) are sent as
+    # raw bytes in a part named after their key; anything else is sent as
+    # JSON in a part named `data`.
+    boundary = uuid.uuid4().hex
+    opts = dict((k, v) for k, v in query.items() if k != 'data')
+    parts = [('opts', 'application/json', json.dumps(opts).encode('utf-8'))]
+    for item in query['data']:
+        if _is_blob(item):
+            name, value = list(item.items())[0]
+            parts.append((name, 'application/octet-stream', value))
+        else:
+            parts.append(('data', 'application/json', _json_body(item)))
+    pieces = []
+    for name, content_type, value in parts:
+        pieces.append(('--%s\r\nContent-Disposition: form-data; name="%s"\r\n'
+                       'Content-Type: %s\r\n\r\n' % (boundary, name, content_type)).encode('utf-8'))
+        pieces.append(value)
+        pieces.append(b'\r\n')
+    pieces.append(('--%s--\r\n' % boundary).encode('utf-8'))
+    return _Body(pieces), 'multipart/form-data; boundary=%s' % boundary
+
+def _is_blob(item):
+    return isinstance(item, dict) and len(item) == 1 and isinstance(list(item.values())[0], bytes)
+
+class _Base64(object):
+    # Bytes to be sent base64ed, without holding the whole encoding.
+    CHUNK = 3 * 16384
+
+    def __init__(self, value):
+        self.value = value
+
+    def __len__(self):
+        return 4 * ((len(self.value) + 2) // 3)
+
+    def __iter__(self):
+        view = memoryview(self.value)
+        for i in range(0, len(view), self.CHUNK):
+            yield base64.b64encode(view[i:i+self.CHUNK])
+
+class _Body(object):
+    # A request body that's written to the socket a piece at a time, so
+    # that it's never joined into one big string: the images in it are
+    # only held once, as the bytes they came in as.  Its length is known
+    # up front, so requests sends it with a Content-Length rather than
+    # chunked, and it can be iterated more than once (for retries and
+    # hedges).  Small pieces are sent together, to save on syscalls.
+    CHUNK = 65536
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.length = sum(len(p) for p in pieces)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        buf = []
+        size = 0
+        for piece in self.pieces:
+            for chunk in (piece if isinstance(piece, _Base64) else [piece]):
+                if size + len(chunk) > self.CHUNK and buf:
+                    yield b''.join(buf)
+                    buf = []
+                    size = 0
+                if len(chunk) >= self.CHUNK:
+                    yield chunk
+                else:
+                    buf.append(chunk)
+                    size += len(chunk)
+        if buf:
+            yield b''.join(buf)
+
+# Binary responses are two little-endian uint32s (the number of
+# embeddings and their dimension), followed by the embeddings as a
+# row-major array of little-endian floats of the given `dtype`.
+_BINARY_TYPE = 'application/x-basilica-embeddings'
+
+def _decode_binary(content, content_type):
+    params = dict(p.strip().split('=', 1) for p in content_type.split(';')[1:] if '=' in p)
+    dtype = numpy.dtype(params.get('dtype', 'float32')).newbyteorder('<')
+    rows, dims = struct.unpack('<II', content[:8])
+    if len(content) != 8 + rows * dims * dtype.itemsize:
+        raise RuntimeError('basilica.ai server returned %d bytes for %d embeddings of dimension %d'
+                           % (len(content), rows, dims))
+    return numpy.frombuffer(content, dtype=dtype, count=rows*dims, offset=8).reshape(rows, dims)
+
+def _as_array(emb):
+    if numpy is None:
+        raise ImportError('`output=\'numpy\'` requires numpy (`pip install numpy`)')
+    return numpy.asarray(emb, dtype=numpy.float32)
+
+def _join(a, b):
+    # Joins the embeddings of the two halves of a split batch.  With a
+    # binary `wire_format` they're arrays, which `+` would add together.
+    if numpy is not None and isinstance(a, numpy.ndarray) and isinstance(b, numpy.ndarray):
+        return numpy.concatenate([a, b])
+    return list(a) + list(b)
+
+def _as_list(emb):
+    if numpy is not None and isinstance(emb, numpy.ndarray):
+        return emb.tolist()
+    return emb
+
+class _ServerError(RuntimeError):
+    # The server answered, but with an error instead of embeddings.
+    pass
+
+def _embeddings(out):
+    if 'error' in out:
+        raise _ServerError('basilica.ai server returned error: `%s`' % out['error'])
+    if 'embeddings' not in out:
+        raise RuntimeError('basilica.ai server did not return embeddings: `%s`' % out)
+    return out['embeddings']
+
+class _Job(object):
+    # Bookkeeping for one call to `Connection.embed`.  `entries` holds
+    # the output in input order: either an embedding we already have
+    # (e.g. a cache hit), or the number of a miss that is waiting on the
+    # server.  Misses are numbered in the order they're batched, and
+    # batches are numbered as they're handed to the API threads.  With
+    # `dedup`, we also remember the keys of that many recent distinct
+    # inputs, so that repeats can point at the same miss (or reuse its
+    # embedding) rather than being sent again.
+    def __init__(self, batch_queue, emb_queue, cache, dedup, metrics=None):
+        self.batch_queue = batch_queue
+        self.emb_queue = emb_queue
+        self.cache = cache
+        self.dedup = dedup
+        self.metrics = metrics
+        self.seen = collections.OrderedDict()
+        self.entries = collections.deque()
+        self.missed = {}
+        self.refs = {}
+        self.misses = 0
+        self.batch = []
+        self.sizes = []
+        self.batch_bytes = 0
+        self.keys = []
+        self.sent = 0
+        self.in_flight = {}
+
+    def repeat(self, key):
+        if not self.dedup:
+            return False
+        entry = self.seen.pop(key, None)
+        if entry is None:
+            return False
+        self.seen[key] = entry
+        resolved, value = entry
+        if not resolved:
+            self.refs[value] += 1
+        self.entries.append(entry)
+        return True
+
+    def remember(self, key, entry):
+        if not self.dedup:
+            return
+        self.seen[key] = entry
+        if len(self.seen) > self.dedup:
+            self.seen.popitem(last=False)
+
+    def hit(self, emb, key):
+        self.entries.append((True, emb))
+        self.remember(key, (True, emb))
+
+    def miss(self, item, key):
+        self.entries.append((False, self.misses))
+        self.remember(key, (False, self.misses))
+        self.refs[self.misses] = 1
+        self.misses += 1
+        self.batch.append(item)
+        self.sizes.append(payload_bytes(item))
+        self.batch_bytes += self.sizes[-1]
+        self.keys.append(key)
+
+    def send(self, max_bytes=None):
+        # Sends the batch, or as much of it as fits in `max_bytes`.
+        if len(self.batch) == 0:
+            return
+        start = self.misses - len(self.batch)
+        n = len(self.batch)
+        if max_bytes is not None:
+            n = 1
+            total = self.sizes[0]
+            while n < len(self.batch) and total + self.sizes[n] <= max_bytes:
+                total += self.sizes[n]
+                n += 1
+        self.batch_queue.put((self.sent, self.batch[:n], time.time()))
+        if self.metrics is not None:
+            self.metrics.observe('queue_depth', self.batch_queue.qsize())
+        self.in_flight[self.sent] = (start, self.keys[:n])
+        self.sent += 1
+        self.batch = self.batch[n:]
+        self.sizes = self.sizes[n:]
+        self.batch_bytes = sum(self.sizes)
+        self.keys = self.keys[n:]
+
+    def collect(self, block):
+        while True:
             try:
-                im = Image.open(io.BytesIO(image))
-            except IOError as e:
-                raise TypeError('`image` argument must be an image (`%s`)' % (str(e)))
-            except OSError as e:
-                raise TypeError('`image` argument must be an image (`%s`)' % (str(e)))
-            im.thumbnail((512, 512))
-            im = im.convert("RGB")
-            img_bytes = io.BytesIO()
-            im.save(img_bytes, "JPEG")
-            image = img_bytes.getvalue()
-        return base64.b64encode(image).decode('utf-8')
+                seq, emb = self.emb_queue.get(block=block)
+            except Empty:
+                return
+            if isinstance(emb, Exception):
+                raise emb
+            start, keys = self.in_flight.pop(seq)
+            for i, e in enumerate(emb):
+                self.missed[start + i] = e
+                if keys[i] in self.seen:
+                    self.seen[keys[i]] = (True, e)
+            if self.cache is not None:
+                self.cache.put_many((k, e) for k, e in zip(keys, emb) if not isinstance(e, EmbeddingError))
+            block = False
+
+    def ready(self):
+        chunk = []
+        while self.entries:
+            resolved, value = self.entries[0]
+            if resolved:
+                chunk.append(value)
+            elif value in self.missed:
+                chunk.append(self.missed[value])
+                self.refs[value] -= 1
+                if self.refs[value] == 0:
+                    del self.refs[value]
+                    del self.missed[value]
+            else:
+                break
+            self.entries.popleft()
+        return chunk
+
+_OUTPUTS = ('list', 'numpy')
+_QUANTIZED_OUTPUTS = ('float16', 'int8')
+
+_ON_ERRORS = ('raise', 'bisect')
+
+def _resolve(item, on_error):
+    # Waits on instances that are being preprocessed.
+    if not isinstance(item, Future):
+        return item
+    try:
+        return item.result()
+    except Exception as err:
+        if on_error != 'bisect':
+            raise
+        return EmbeddingError(err)
+
+def _bisectable(err):
+    # Whether an error could be down to particular instances in a batch,
+    # rather than to the connection, the auth key, a quota or the server
+    # being down.  Bisecting on the latter would just send every instance
+    # again (about twice over) and turn them all into `EmbeddingError`s.
+    if isinstance(err, _ServerError):
+        return True
+    if isinstance(err, requests.exceptions.HTTPError) and err.response is not None:
+        status = err.response.status_code
+        return 400 <= status < 500 and status not in (401, 403, 404, 408, 429)
+    return False
+
+def _start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+
+def _length_hint(data):
+    try:
+        return len(data)
+    except TypeError:
+        return 0
+
+def _stack(batches, capacity):
+    # Copies each batch of embeddings into one growing (N, D) float32
+    # matrix, so we never hold more than one batch of Python floats.
+    if numpy is None:
+        raise ImportError('`output=\'numpy\'` requires numpy (`pip install numpy`)')
+    out = None
+    n = 0
+    for batch in batches:
+        if out is None:
+            rows = [e for e in batch if not isinstance(e, EmbeddingError)]
+            if len(batch) > 0 and not rows:
+                # Can't tell the dimension from errors.  Their rows are
+                # filled in once we can.
+                n += len(batch)
+                continue
+            dimensions = len(rows[0]) if rows else 0
+            out = numpy.empty((max(capacity, n + len(batch)), dimensions), dtype=numpy.float32)
+            out[:n] = numpy.nan
+        elif n + len(batch) > len(out):
+            grown = numpy.empty((max(2 * len(out), n + len(batch)), out.shape[1]), dtype=numpy.float32)
+            grown[:n] = out[:n]
+            out = grown
+        if any(isinstance(e, EmbeddingError) for e in batch):
+            for i, e in enumerate(batch):
+                out[n+i] = numpy.nan if isinstance(e, EmbeddingError) else e
+        else:
+            out[n:n+len(batch)] = batch
+        n += len(batch)
+    if out is None and n > 0:
+        return numpy.full((n, 0), numpy.nan, dtype=numpy.float32)
+    if out is None:
+        return numpy.empty((0, 0), dtype=numpy.float32)
+    if n < len(out):
+        out = out[:n].copy()
+    return out
+
+def _image_payload(image, transform_image, jpeg_quality=75):
+    # Images stay as bytes until the request body is built, so that
+    # multipart requests don't have to base64 them.
+    return {'img': _transform_image(image, transform_image, jpeg_quality)}
+
+def _image_encoder(opts):
+    return functools.partial(_image_payload, transform_image=opts.get("transform_image", True),
+                             jpeg_quality=opts.get("jpeg_quality", 75))
+
+def _encode_image(image, transform_image, jpeg_quality=75):
+    return base64.b64encode(_transform_image(image, transform_image, jpeg_quality)).decode('utf-8')
+
+_MAX_IMAGE_SIZE = 512
+
+def _transform_image(image, transform_image, jpeg_quality=75):
+    if type(image) != bytes:
+        raise TypeError('`image` argument must be bytes (got `%s`)' % (type(image).__name__))
+    if transform_image:
+        try:
+            # This only reads the header.
+            im = Image.open(io.BytesIO(image))
+        except IOError as e:
+            raise TypeError('`image` argument must be an image (`%s`)' % (str(e)))
+        except OSError as e:
+            raise TypeError('`image` argument must be an image (`%s`)' % (str(e)))
+        if im.format == 'JPEG' and im.mode == 'RGB' and max(im.size) <= _MAX_IMAGE_SIZE:
+            # Already what we'd turn it into, so don't decode it at all.
+            return image
+        if im.format == 'JPEG':
+            # Have the decoder scale the image down by 2, 4 or 8 as it
+            # goes (so long as it stays at least 512px), which is much
+            # cheaper than decoding it at full size.
+            im.draft('RGB', (_MAX_IMAGE_SIZE, _MAX_IMAGE_SIZE))
+        im.thumbnail((_MAX_IMAGE_SIZE, _MAX_IMAGE_SIZE))
+        im = im.convert("RGB")
+        img_bytes = io.BytesIO()
+        im.save(img_bytes, "JPEG", quality=jpeg_quality)
+        image = img_bytes.getvalue()
+    return image
@@ -0,0 +1,231 @@
+"""asyncio bindings for basilica.ai.  These need `aiohttp`, which you
+can get with `pip install basilica[async]`.
+"""
+from . import _embed_query, _embeddings, _encode_image, _headers
+from .files import read_file
+from .ratelimit import RateLimiter, backoff_delay
+import aiohttp
+import asyncio
+import base64
+import collections
+
+
+class AsyncConnection(object):
+    def __init__(self, auth_key, server='https://api.basilica.ai',
+                 retries=2, backoff_factor=0.1, status_forcelist=(500,),
+                 pool_size=100, keepalive_timeout=30, rate_limit=None):
+        """An asyncio connection to basilica.ai that can be used to generate embeddings.  It takes the same arguments as :class:`basilica.Connection`, and follows the same retry and timeout rules.
+
+        :param auth_key: Your auth key.  You can view your auth keys at https://basilica.ai/api-keys/.
+        :type auth_key: str
+        :param server: What URL to use to connect to the server.
+        :type server: str
+        :param retries: Number of times to retry failed connections and requests.
+        :type retries: int
+        :param backoff_factor: How long to wait between retries of failed connections and requests, doubling on each attempt, with random jitter.
+        :type backoff_factor: float
+        :param status_forcelist: What HTTP response codes trigger a retry.
+        :type status_forcelist: Tuple[int]
+        :param pool_size: Maximum number of open connections to the server.  Idle connections are kept alive and reused.
+        :type pool_size: int
+        :param keepalive_timeout: How long to keep idle connections open, in seconds.
+        :type keepalive_timeout: float
+        :param rate_limit: What to pace requests with.  It can be shared with other connections, including synchronous ones.
+        :type rate_limit: basilica.RateLimiter
+
+        >>> async with basilica.aio.AsyncConnection('SLOW_DEMO_KEY') as c:
+        ...   print(await c.embed_sentence('A sentence.'))
+        [0.6246702671051025, ..., -0.03025037609040737]
+        """
+        self.server = server
+        self.auth = 'Basic %s' % base64.b64encode(('%s:' % auth_key).encode('utf-8')).decode('ascii')
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.status_forcelist = status_forcelist
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.rate_limit = rate_limit if rate_limit is not None else RateLimiter()
+        self.session = None
+
+    async def __aenter__(self):
+        self.__session()
+        return self
+
+    async def __aexit__(self, *a):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def __session(self):
+        # aiohttp sessions have to be created inside a running event loop.
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size,
+                                             keepalive_timeout=self.keepalive_timeout)
+            headers = _headers()
+            headers['Authorization'] = self.auth
+            self.session = aiohttp.ClientSession(connector=connector, headers=headers)
+        return self.session
+
+    async def raw_embed(self, url, data, opts, timeout):
+        query = _embed_query(url, data, opts)
+        session = self.__session()
+        client_timeout = aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)
+        limiter = self.rate_limit
+        i = 0
+        throttles = 0
+        while True:
+            wait = limiter.reserve(len(data))
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                async with session.post(url, json=query, timeout=client_timeout) as res:
+                    if res.status == 429 and throttles < limiter.retries:
+                        limiter.throttled(res.headers.get('Retry-After'))
+                        throttles += 1
+                        continue
+                    if res.status != 429:
+                        limiter.succeeded()
+                    if res.status in self.status_forcelist and i < self.retries:
+                        await asyncio.sleep(backoff_delay(self.backoff_factor, i))
+                        i += 1
+                        continue
+                    res.raise_for_status()
+                    return _embeddings(await res.json())
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+                if i < self.retries:
+                    await asyncio.sleep(backoff_delay(self.backoff_factor, i))
+                    i += 1
+                    continue
+                raise
+
+    async def embed(self, url, data, batch_size, opts, timeout, concurrency=4):
+        if type(concurrency) != int or concurrency < 1:
+            raise ValueError('`concurrency` argument must be a positive int (got `%s`)' % concurrency)
+        pending = collections.deque()
+        try:
+            async for batch in _batches(_aiter(data), batch_size):
+                pending.append(asyncio.ensure_future(self.raw_embed(url, batch, opts, timeout)))
+                if len(pending) >= concurrency:
+                    for e in await pending.popleft():
+                        yield e
+            while pending:
+                for e in await pending.popleft():
+                    yield e
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def embed_images(self, images, model='generic', version='default',
+                     batch_size=32, opts={}, timeout=30, concurrency=4):
+        """Generate embeddings for JPEG images.  Takes the same arguments as :meth:`basilica.Connection.embed_images`, but `images` may also be an async iterable.  Images are resized in the event loop's default executor.
+
+        :returns: An async generator of embeddings.
+        :rtype: AsyncGenerator[List[float]]
+
+        >>> async with basilica.aio.AsyncConnection('SLOW_DEMO_KEY') as c:
+        ...   async for embedding in c.embed_images([img1, img2]):
+        ...     print(embedding)
+        [0.6246702671051025, ...]
+        [-0.03025037609040737, ...]
+        """
+        url = '%s/embed/images/%s/%s' % (self.server, model, version)
+        transform_image = opts.get("transform_image", True)
+        jpeg_quality = opts.get("jpeg_quality", 75)
+        async def encode_images():
+            loop = asyncio.get_running_loop()
+            async for img in _aiter(images):
+                yield {'img': await loop.run_in_executor(None, _encode_image, img, transform_image,
+                                                         jpeg_quality)}
+        return self.embed(url, encode_images(), batch_size=batch_size, opts=opts,
+                          timeout=timeout, concurrency=concurrency)
+
+    async def embed_image(self, image, model='generic', version='default',
+                          opts={}, timeout=10):
+        """Generate the embedding for a JPEG image.  Takes the same arguments as :meth:`basilica.Connection.embed_image`.
+
+        :returns: An embedding.
+        :rtype: List[float]
+        """
+        embeddings = self.embed_images([image], model=model, version=version,
+                                       opts=opts, timeout=timeout)
+        return [e async for e in embeddings][0]
+
+    def embed_image_files(self, image_files, model='generic', version='default',
+                          batch_size=32, opts={}, timeout=30, concurrency=4):
+        """Generate embeddings for JPEG image files.  Takes the same arguments as :meth:`basilica.Connection.embed_image_files`, but `image_files` may also be an async iterable.  Files are read in the event loop's default executor.
+
+        :returns: An async generator of embeddings.
+        :rtype: AsyncGenerator[List[float]]
+        """
+        async def load_image_files():
+            loop = asyncio.get_running_loop()
+            async for image_file in _aiter(image_files):
+                yield await loop.run_in_executor(None, read_file, image_file)
+        return self.embed_images(load_image_files(), model=model, version=version,
+                                 batch_size=batch_size, opts=opts, timeout=timeout,
+                                 concurrency=concurrency)
+
+    async def embed_image_file(self, image_file, model='generic', version='default',
+                               opts={}, timeout=10):
+        """Generate the embedding for a JPEG image file.  Takes the same arguments as :meth:`basilica.Connection.embed_image_file`.
+
+        :returns: An embedding.
+        :rtype: List[float]
+        """
+        image = await asyncio.get_running_loop().run_in_executor(None, read_file, image_file)
+        return await self.embed_image(image, model=model, version=version,
+                                      opts=opts, timeout=timeout)
+
+    def embed_sentences(self, sentences, model='english', version='default',
+                        batch_size=64, opts={}, timeout=15, concurrency=4):
+        """Generate embeddings for sentences.  Takes the same arguments as :meth:`basilica.Connection.embed_sentences`, but `sentences` may also be an async iterable.
+
+        :returns: An async generator of embeddings.
+        :rtype: AsyncGenerator[List[float]]
+
+        >>> async with basilica.aio.AsyncConnection('SLOW_DEMO_KEY') as c:
+        ...   async for embedding in c.embed_sentences(['Sentence one.', 'Sentence two.']):
+        ...     print(embedding)
+        [0.6246702671051025, ...]
+        [-0.03025037609040737, ...]
+        """
+        url = '%s/embed/text/%s/%s' % (self.server, model, version)
+        return self.embed(url, sentences, batch_size=batch_size, opts=opts,
+                          timeout=timeout, concurrency=concurrency)
+
+    async def embed_sentence(self, sentence, model='english', version='default',
+                             opts={}, timeout=5):
+        """Generate the embedding for a sentence.  Takes the same arguments as :meth:`basilica.Connection.embed_sentence`.
+
+        :returns: An embedding.
+        :rtype: List[float]
+
+        >>> async with basilica.aio.AsyncConnection('SLOW_DEMO_KEY') as c:
+        ...   print(await c.embed_sentence('This is a sentence.'))
+        [0.6246702671051025, ...]
+        """
+        embeddings = self.embed_sentences([sentence], model=model, version=version,
+                                          opts=opts, timeout=timeout)
+        return [e async for e in embeddings][0]
+
+
+async def _aiter(data):
+    if hasattr(data, '__aiter__'):
+        async for i in data:
+            yield i
+    else:
+        for i in data:
+            yield i
+
+async def _batches(data, batch_size):
+    batch = []
+    async for i in data:
+        batch.append(i)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
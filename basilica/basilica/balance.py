@@ -0,0 +1,145 @@
+import random
+import threading
+import time
+
+
+class LoadBalancer(object):
+    def __init__(self, endpoints, decay=0.3, max_failures=3, eject_seconds=5.0,
+                 max_eject_seconds=60.0):
+        """Spreads requests across several servers, for the `server` argument of :class:`basilica.Connection`.  (Passing a list of URLs uses one of these with the default settings.)
+
+        Each request goes to the healthy endpoint with the lowest expected wait: the moving average of its recent latencies, times one more than the number of requests it has outstanding.  Timeouts, connection errors and 5xx responses count as failures, and failed requests are retried on whichever endpoint is then best.  After `max_failures` failures in a row an endpoint is ejected for `eject_seconds`, and then sent a single request as a probe: if that succeeds it's healthy again, and if it fails it's ejected for twice as long as before.  If every endpoint is ejected, requests go to whichever is due back soonest.
+
+        :param endpoints: The server URLs.
+        :type endpoints: List[str]
+        :param decay: How much weight the moving average gives each new latency.
+        :type decay: float
+        :param max_failures: How many failures in a row get an endpoint ejected.
+        :type max_failures: int
+        :param eject_seconds: How long to eject an endpoint for the first time.
+        :type eject_seconds: float
+        :param max_eject_seconds: The longest to eject an endpoint for.
+        :type max_eject_seconds: float
+
+        >>> servers = ['https://us.example.com', 'https://eu.example.com']
+        >>> with basilica.Connection('SLOW_DEMO_KEY', server=servers) as c:
+        ...   embeddings = list(c.embed_sentences(sentences, concurrency=8))
+        ...   print(c.balancer.stats()['https://eu.example.com']['requests'])
+        37
+        """
+        if len(endpoints) == 0:
+            raise ValueError('`endpoints` argument must not be empty')
+        self.endpoints = [_Endpoint(e) for e in endpoints]
+        self.decay = decay
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.lock = threading.Lock()
+
+    @property
+    def primary(self):
+        return self.endpoints[0].url
+
+    def acquire(self):
+        """Pick an endpoint for a request, and count it as outstanding until :meth:`release` is called.
+
+        :returns: The endpoint's URL.
+        :rtype: str
+        """
+        with self.lock:
+            now = time.time()
+            candidates = []
+            for e in self.endpoints:
+                if e.until > now:
+                    continue
+                if e.until > 0:
+                    # Due back from being ejected: send it one probe.
+                    if e.probing:
+                        continue
+                    e.probing = True
+                    return self.__take(e)
+                candidates.append(e)
+            if not candidates:
+                e = min(self.endpoints, key=lambda e: e.until)
+                return self.__take(e)
+            e = min(candidates, key=lambda e: ((e.latency or 0.0) * (e.outstanding + 1),
+                                               e.outstanding, random.random()))
+            return self.__take(e)
+
+    def release(self, endpoint, latency, ok):
+        """Note how a request to `endpoint` went."""
+        with self.lock:
+            e = self.__find(endpoint)
+            e.outstanding -= 1
+            probe = e.probing
+            e.probing = False
+            if ok:
+                e.latency = latency if e.latency is None else e.latency + (latency - e.latency) * self.decay
+                e.failures = 0
+                if probe or e.until > 0:
+                    e.until = 0.0
+                    e.ejections = 0
+                return
+            e.failed += 1
+            e.failures += 1
+            if probe or e.failures >= self.max_failures:
+                e.ejections += 1
+                e.total_ejections += 1
+                eject = min(self.max_eject_seconds, self.eject_seconds * (2 ** (e.ejections - 1)))
+                e.until = time.time() + eject
+                e.failures = 0
+
+    def stats(self):
+        """How each endpoint is doing.
+
+        :returns: For each endpoint URL, its `state` (``'healthy'``, ``'ejected'`` or ``'probing'``), the number of `requests` sent to it, how many `failed`, how many are `outstanding`, its moving average `latency_ms`, and how many times it has been ejected (`ejections`).
+        :rtype: Dict[str, Dict[str, Union[str, int, float]]]
+        """
+        with self.lock:
+            now = time.time()
+            out = {}
+            for e in self.endpoints:
+                if e.until > now:
+                    state = 'ejected'
+                elif e.until > 0:
+                    state = 'probing'
+                else:
+                    state = 'healthy'
+                out[e.url] = {
+                    'state': state,
+                    'requests': e.requests,
+                    'failed': e.failed,
+                    'outstanding': e.outstanding,
+                    'latency_ms': (e.latency or 0.0) * 1000.0,
+                    'ejections': e.total_ejections,
+                }
+            return out
+
+    def __take(self, e):
+        # Called with `lock` held.
+        e.outstanding += 1
+        e.requests += 1
+        return e.url
+
+    def __find(self, url):
+        for e in self.endpoints:
+            if e.url == url:
+                return e
+        raise ValueError('Unknown endpoint `%s`' % url)
+
+
+class _Endpoint(object):
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.outstanding = 0
+        self.requests = 0
+        self.failed = 0
+        # Consecutive failures, and consecutive ejections (each one longer
+        # than the last).  `until` is when an ejection ends, or 0 if the
+        # endpoint is healthy.
+        self.failures = 0
+        self.ejections = 0
+        self.total_ejections = 0
+        self.until = 0.0
+        self.probing = False
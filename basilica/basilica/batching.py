@@ -0,0 +1,66 @@
+import threading
+
+
+class AdaptiveBatchSize(object):
+    def __init__(self, start=16, minimum=1, maximum=512, increase=4, decrease=0.75,
+                 target_latency=None, max_bytes=4*1024*1024):
+        """A batch size that adapts to how the server is responding, for the `batch_size` argument of the batch embedding methods.  (Passing `batch_size='auto'` uses one of these with the default settings.)
+
+        Batches grow additively while requests come back faster than `target_latency`, shrink multiplicatively when they come back slower, and halve when one times out.  A batch is also cut short once its payload reaches `max_bytes`, and a batch that times out is split in two rather than being resent as is.
+
+        A single instance can be shared between calls (and threads), so that later calls start from what earlier ones learned.
+
+        :param start: The initial batch size.
+        :type start: int
+        :param minimum: The smallest batch size to shrink to.
+        :type minimum: int
+        :param maximum: The largest batch size to grow to.
+        :type maximum: int
+        :param increase: How many instances to add after a fast batch.
+        :type increase: int
+        :param decrease: What to multiply the batch size by after a slow batch.
+        :type decrease: float
+        :param target_latency: How long a batch should take, in seconds.  Defaults to a quarter of the call's timeout.
+        :type target_latency: float
+        :param max_bytes: The most payload to send in one request.
+        :type max_bytes: int
+
+        >>> sizer = basilica.AdaptiveBatchSize(maximum=128)
+        >>> with basilica.Connection('SLOW_DEMO_KEY') as c:
+        ...   for embedding in c.embed_image_files(paths, batch_size=sizer):
+        ...     print(embedding)
+        """
+        self.size = start
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def record(self, latency, timeout):
+        """Adjust the batch size after a batch came back in `latency` seconds."""
+        target = self.target_latency if self.target_latency is not None else timeout / 4.0
+        with self.lock:
+            if latency <= target:
+                self.size = min(self.maximum, self.size + self.increase)
+            else:
+                self.size = max(self.minimum, int(self.size * self.decrease))
+
+    def timed_out(self):
+        """Adjust the batch size after a batch timed out."""
+        with self.lock:
+            self.size = max(self.minimum, self.size // 2)
+
+
+def payload_bytes(item):
+    # A cheap estimate of how much an encoded instance adds to a request.
+    if isinstance(item, dict):
+        return sum(payload_bytes(v) for v in item.values())
+    if isinstance(item, bytes):
+        # Raw image bytes usually end up base64 encoded.
+        return (len(item) + 2) // 3 * 4
+    if hasattr(item, '__len__'):
+        return len(item)
+    return 0
@@ -0,0 +1,132 @@
+from array import array
+import hashlib
+import json
+import six
+import sqlite3
+import threading
+
+
+def key_prefix(path, opts):
+    """The part of the key shared by every input to one endpoint with one set of options."""
+    return hashlib.sha256(json.dumps([path, opts], sort_keys=True).encode('utf-8'))
+
+def item_key(prefix, item):
+    h = prefix.copy()
+    if isinstance(item, bytes):
+        h.update(b'b')
+        h.update(item)
+    elif isinstance(item, six.text_type):
+        h.update(b't')
+        h.update(item.encode('utf-8'))
+    else:
+        h.update(b'j')
+        h.update(json.dumps(item, sort_keys=True).encode('utf-8'))
+    return h.digest()
+
+
+class EmbeddingCache(object):
+    def __init__(self, path, max_entries=1000000):
+        """An on-disk cache of embeddings, for use with :class:`basilica.Connection`.  Entries are keyed by a hash of the model, version, options and input, and the least recently used entries are evicted once there are more than `max_entries`.
+
+        Because the key includes the version but not the server's notion of what `default` currently points at, pin a version if you plan to keep a cache around across model releases.
+
+        :param path: Where to keep the cache.  It's a SQLite database, and can be shared by several connections.
+        :type path: str
+        :param max_entries: How many embeddings to keep.
+        :type max_entries: int
+
+        >>> cache = basilica.EmbeddingCache('/tmp/embeddings.db')
+        >>> with basilica.Connection('SLOW_DEMO_KEY', cache=cache) as c:
+        ...   embeddings = list(c.embed_sentences(['Sentence one.', 'Sentence two.']))
+        >>> cache.stats()
+        {'hits': 0, 'misses': 2, 'hit_rate': 0.0, 'entries': 2, 'evictions': 0}
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS embeddings '
+                        '(key BLOB PRIMARY KEY, embedding BLOB NOT NULL, used INTEGER NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)')
+        self.db.commit()
+        self.clock = self.db.execute('SELECT COALESCE(MAX(used), 0) FROM embeddings').fetchone()[0]
+        self.entries = self.db.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # When each key that's been hit was last used.  These are written
+        # in batches rather than on every hit, since each write holds the
+        # database's lock until it's committed, which would keep other
+        # connections to the cache from writing.
+        self.touched = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.__write_touched()
+            self.db.commit()
+            self.db.close()
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT embedding FROM embeddings WHERE key = ?',
+                                  (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.clock += 1
+            self.touched[key] = self.clock
+            if len(self.touched) >= _TOUCH_BATCH:
+                self.__write_touched()
+                self.db.commit()
+        return array('d', bytes(row[0])).tolist()
+
+    def put_many(self, items):
+        with self.lock:
+            self.__write_touched()
+            for key, embedding in items:
+                self.clock += 1
+                cur = self.db.execute('INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?)',
+                                      (key, sqlite3.Binary(array('d', embedding).tobytes()), self.clock))
+                self.entries += cur.rowcount
+            if self.entries > self.max_entries:
+                excess = self.entries - self.max_entries
+                self.db.execute('DELETE FROM embeddings WHERE key IN '
+                                '(SELECT key FROM embeddings ORDER BY used LIMIT ?)', (excess,))
+                self.entries -= excess
+                self.evictions += excess
+            self.db.commit()
+
+    def stats(self):
+        """Hit-rate statistics for this cache object.
+
+        :returns: The number of `hits` and `misses` since the cache was opened, their `hit_rate`, the number of `entries` stored, and the number of `evictions` since the cache was opened.
+        :rtype: Dict[str, Union[int, float]]
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'entries': self.entries,
+                'evictions': self.evictions,
+            }
+
+    def __write_touched(self):
+        # Called with `lock` held.
+        if self.touched:
+            self.db.executemany('UPDATE embeddings SET used = ? WHERE key = ?',
+                                [(used, key) for key, used in self.touched.items()])
+            self.touched = {}
+
+
+_TOUCH_BATCH = 1000
@@ -0,0 +1,333 @@
+"""The `basilica` command, for embedding large datasets without writing any
+Python.
+
+    basilica --key KEY reviews.csv --column body --output reviews.npy
+    basilica --key KEY photos/ --output photos.jsonl --concurrency 8
+    cat sentences.txt | basilica --key KEY - --count 100000 --output out.npy
+
+Text is read from CSV, TSV, JSONL, or plain text files (one instance per
+line), or from stdin; images from image files, directories, glob patterns,
+and tar and zip archives.  Embeddings are written to `.npy`, `.jsonl` or
+`.parquet` (which needs pyarrow).  With `--resume`, a job that was
+interrupted picks up where it left off.
+"""
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+import time
+
+from . import Connection, EmbeddingCache, EmbeddingError, RateLimiter, __version__
+from .files import IMAGE_EXTENSIONS, TAR_EXTENSIONS, ZIP_EXTENSIONS, image_sources
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+OUTPUT_FORMATS = ('npy', 'jsonl', 'parquet')
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    key = args.key or os.environ.get('BASILICA_API_KEY')
+    if not key:
+        _fail('an auth key is required (`--key`, or set BASILICA_API_KEY)')
+    output_format = args.output_format or os.path.splitext(args.output)[1].lstrip('.').lower()
+    if output_format not in OUTPUT_FORMATS:
+        _fail('can\'t tell the output format of `%s`; use --output-format' % args.output)
+    if output_format == 'parquet' and pyarrow is None:
+        _fail('Parquet output requires pyarrow (`pip install basilica[parquet]`)')
+    if output_format == 'parquet' and args.resume:
+        _fail('--resume isn\'t supported with Parquet output')
+    opts = json.loads(args.opts) if args.opts else {}
+    if args.dimensions is not None:
+        opts['dimensions'] = args.dimensions
+
+    kind = args.type or ('images' if all(_is_image_path(p) for p in args.inputs) else 'text')
+    if kind == 'images':
+        method = 'embed_image_files'
+        read = lambda: image_sources(args.inputs)
+        model = args.model or 'generic'
+    else:
+        method = 'embed_sentences'
+        read = lambda: _read_text(args)
+        model = args.model or 'english'
+    count = args.count
+    if count is None and '-' not in args.inputs:
+        count = sum(1 for _ in read())
+    if count is None and output_format == 'npy':
+        _fail('--count is required to write `.npy` from stdin')
+
+    kwargs = {
+        'model': model,
+        'version': args.version,
+        'opts': opts,
+        'batch_size': 'auto' if args.batch_size == 'auto' else int(args.batch_size),
+        'timeout': args.timeout,
+        'concurrency': args.concurrency,
+        'dedup': args.dedup,
+        'on_error': args.on_error,
+    }
+    if kind == 'images':
+        kwargs['preprocess_workers'] = args.preprocess_workers
+        kwargs['io_workers'] = args.io_workers
+
+    rate_limit = None
+    if args.requests_per_second or args.items_per_second:
+        rate_limit = RateLimiter(requests_per_second=args.requests_per_second,
+                                 items_per_second=args.items_per_second)
+    cache = EmbeddingCache(args.cache) if args.cache else None
+    servers = args.server or ['https://api.basilica.ai']
+    server = servers if len(servers) > 1 else servers[0]
+    progress = _Progress(count, quiet=args.quiet)
+    with Connection(key, server=server, retries=args.retries, cache=cache,
+                    wire_format=args.wire_format, compression=args.compression,
+                    rate_limit=rate_limit, pool_size=max(10, args.concurrency)) as c:
+        if output_format == 'npy':
+            if not args.resume:
+                _remove(args.output + '.journal')
+            c.embed_to_file(read(), args.output, method=method, count=count,
+                            checkpoint_rows=args.checkpoint_rows,
+                            progress=progress.update, **kwargs)
+        else:
+            done = _resume_jsonl(args.output) if args.resume else 0
+            progress.start(done)
+            inputs = itertools.islice(read(), done, None)
+            embeddings = getattr(c, method)(inputs, **kwargs)
+            write = _write_jsonl if output_format == 'jsonl' else _write_parquet
+            write(args.output, done, embeddings, progress)
+    progress.finish()
+    if cache is not None:
+        cache.close()
+    return 1 if progress.errors else 0
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='basilica', description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__.split('\n\n', 1)[1])
+    parser.add_argument('inputs', nargs='+', metavar='INPUT',
+                        help='Files, directories or glob patterns to embed, or `-` for stdin.')
+    parser.add_argument('--output', '-o', required=True,
+                        help='Where to write the embeddings (`.npy`, `.jsonl` or `.parquet`).')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS)
+    parser.add_argument('--resume', action='store_true',
+                        help='Pick up an interrupted job instead of starting over.')
+    parser.add_argument('--version', action='version', version='basilica %s' % __version__)
+
+    group = parser.add_argument_group('inputs')
+    group.add_argument('--type', choices=['text', 'images'],
+                       help='What the inputs are.  Defaults to images if every input looks like one.')
+    group.add_argument('--input-format', choices=['text', 'csv', 'tsv', 'jsonl'],
+                       help='How to read text inputs.  Defaults to going by the file extension.')
+    group.add_argument('--column', help='Which CSV or TSV column to embed (default `text`, or the first).')
+    group.add_argument('--field', default='text', help='Which JSONL field to embed.')
+    group.add_argument('--count', type=int,
+                       help='How many instances there are (for the ETA, and needed for `.npy` from stdin).')
+
+    group = parser.add_argument_group('model')
+    group.add_argument('--key', help='Your auth key.  Defaults to $BASILICA_API_KEY.')
+    group.add_argument('--server', action='append',
+                       help='Server URL.  Repeat to spread requests across several.')
+    group.add_argument('--model', help='Model name (default `english` for text, `generic` for images).')
+    group.add_argument('--model-version', dest='version', default='default')
+    group.add_argument('--opts', help='Model options, as JSON.')
+    group.add_argument('--dimensions', type=int, help='Number of dimensions to return.')
+
+    group = parser.add_argument_group('performance')
+    group.add_argument('--batch-size', default='auto', help='Instances per request, or `auto`.')
+    group.add_argument('--concurrency', type=int, default=4, help='Requests in flight at a time.')
+    group.add_argument('--timeout', type=float, default=30)
+    group.add_argument('--retries', type=int, default=2)
+    group.add_argument('--preprocess-workers', type=int, default=0,
+                       help='Processes to resize images with.')
+    group.add_argument('--io-workers', type=int, default=4, help='Threads to read image files with.')
+    group.add_argument('--dedup', type=int, default=10000,
+                       help='How many recent distinct inputs to remember, to only embed repeats once.')
+    group.add_argument('--cache', help='An embedding cache database to use.')
+    group.add_argument('--wire-format', choices=['json', 'float32', 'float16'],
+                       default='float32' if numpy is not None else 'json')
+    group.add_argument('--compression', choices=['gzip', 'zstd'])
+    group.add_argument('--requests-per-second', type=float)
+    group.add_argument('--items-per-second', type=float)
+    group.add_argument('--on-error', choices=['raise', 'bisect'], default='bisect',
+                       help='Whether to stop at the first bad instance, or write it as an error and carry on.')
+    group.add_argument('--checkpoint-rows', type=int, default=10000,
+                       help='How often to checkpoint `.npy` output.')
+    group.add_argument('--quiet', '-q', action='store_true', help='Don\'t show progress.')
+    return parser
+
+
+def _read_text(args):
+    for path in args.inputs:
+        fmt = args.input_format or _text_format(path)
+        if path == '-':
+            f = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8') if hasattr(sys.stdin, 'buffer') else sys.stdin
+            for item in _text_items(f, fmt, args):
+                yield item
+        else:
+            with io.open(path, encoding='utf-8', newline='' if fmt in ('csv', 'tsv') else None) as f:
+                for item in _text_items(f, fmt, args):
+                    yield item
+
+
+def _text_items(f, fmt, args):
+    if fmt in ('csv', 'tsv'):
+        reader = csv.DictReader(f, delimiter='\t' if fmt == 'tsv' else ',')
+        column = args.column
+        if column is None:
+            column = 'text' if 'text' in (reader.fieldnames or []) else (reader.fieldnames or [None])[0]
+        for row in reader:
+            yield row[column]
+    elif fmt == 'jsonl':
+        for line in f:
+            if line.strip():
+                value = json.loads(line)
+                yield value[args.field] if isinstance(value, dict) else value
+    else:
+        for line in f:
+            yield line.rstrip('\r\n')
+
+
+def _text_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        return 'csv'
+    if ext == '.tsv':
+        return 'tsv'
+    if ext in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    return 'text'
+
+
+def _is_image_path(path):
+    if path == '-':
+        return False
+    if os.path.isdir(path):
+        return True
+    return path.lower().endswith(IMAGE_EXTENSIONS + TAR_EXTENSIONS + ZIP_EXTENSIONS)
+
+
+def _resume_jsonl(path):
+    # Keep the complete lines, and drop a partly written last one.
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        f.truncate(end)
+    return data[:end].count(b'\n')
+
+
+def _write_jsonl(path, start, embeddings, progress):
+    with open(path, 'a' if start else 'w') as f:
+        for i, e in enumerate(embeddings, start):
+            if isinstance(e, EmbeddingError):
+                f.write(json.dumps({'index': i, 'error': str(e)}) + '\n')
+            else:
+                f.write(json.dumps({'index': i, 'embedding': e}) + '\n')
+            progress.update(i, e)
+
+
+def _write_parquet(path, start, embeddings, progress, row_group=10000):
+    schema = pyarrow.schema([('index', pyarrow.int64()),
+                             ('embedding', pyarrow.list_(pyarrow.float32())),
+                             ('error', pyarrow.string())])
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        rows = []
+        for i, e in enumerate(embeddings, start):
+            error = isinstance(e, EmbeddingError)
+            rows.append((i, None if error else e, str(e) if error else None))
+            progress.update(i, e)
+            if len(rows) >= row_group:
+                writer.write_table(_parquet_table(rows, schema))
+                rows = []
+        if rows:
+            writer.write_table(_parquet_table(rows, schema))
+
+
+def _parquet_table(rows, schema):
+    return pyarrow.Table.from_arrays([pyarrow.array(list(c), type=f.type) for c, f in zip(zip(*rows), schema)],
+                                     schema=schema)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _fail(message):
+    sys.stderr.write('basilica: error: %s\n' % message)
+    sys.exit(2)
+
+
+class _Progress(object):
+    # A status line on stderr, redrawn at most twice a second.
+    def __init__(self, total, quiet=False, out=sys.stderr, interval=0.5):
+        self.total = total
+        self.quiet = quiet
+        self.out = out
+        self.interval = interval
+        self.first = None
+        self.done = 0
+        self.errors = 0
+        self.started = time.time()
+        self.shown = 0
+
+    def start(self, done):
+        self.first = done
+        self.done = done
+
+    def update(self, row, embedding):
+        if self.first is None:
+            self.first = row
+        self.done = row + 1
+        if isinstance(embedding, EmbeddingError):
+            self.errors += 1
+        now = time.time()
+        if not self.quiet and now - self.shown >= self.interval:
+            self.shown = now
+            self.out.write('\r' + self.line(now))
+            self.out.flush()
+
+    def line(self, now):
+        elapsed = max(now - self.started, 1e-9)
+        rate = (self.done - (self.first or 0)) / elapsed
+        if self.total:
+            line = '%d/%d (%.1f%%)' % (self.done, self.total, 100.0 * self.done / self.total)
+            if rate > 0:
+                line += '  ETA %s' % _duration((self.total - self.done) / rate)
+        else:
+            line = '%d' % self.done
+        return '%s  %.1f/s  %d errors ' % (line, rate, self.errors)
+
+    def finish(self):
+        if not self.quiet:
+            self.out.write('\r' + self.line(time.time()) + '\n')
+            self.out.flush()
+
+
+def _duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    return '%ds' % seconds
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import collections
+import json
+import threading
+import time
+
+
+class Coalescer(object):
+    def __init__(self, connection, max_wait_ms=5, max_batch_size=64, concurrency=4,
+                 window=10000):
+        """Collects single-instance embedding calls made from many threads into shared batches.  Use :meth:`basilica.Connection.enable_coalescing` to set one up rather than creating it directly.
+
+        A batch is sent once its oldest instance has waited `max_wait_ms`, or as soon as it has `max_batch_size` instances.  Instances are only batched together if they're for the same model, version, options and timeout.
+
+        :param connection: The connection to send batches with.
+        :type connection: basilica.Connection
+        :param max_wait_ms: The longest an instance waits for others to join its batch, in milliseconds.
+        :type max_wait_ms: float
+        :param max_batch_size: The most instances to send in one batch.
+        :type max_batch_size: int
+        :param concurrency: How many batches to have in flight to the server at a time.
+        :type concurrency: int
+        :param window: How many recent latencies and batch sizes to compute :meth:`stats` from.
+        :type window: int
+        """
+        self.connection = connection
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.cond = threading.Condition()
+        self.groups = collections.OrderedDict()
+        self.closed = False
+        self.stats_lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.instances = 0
+        self.batches = 0
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, url, item, opts, timeout):
+        """Queue up one instance, to be sent in the next batch for `url`.
+
+        :returns: A future for its embedding.
+        :rtype: concurrent.futures.Future
+        """
+        future = Future()
+        now = time.time()
+        key = (url, json.dumps(opts, sort_keys=True), timeout)
+        with self.cond:
+            if self.closed:
+                raise RuntimeError('Coalescer is closed')
+            if key not in self.groups:
+                self.groups[key] = (now + self.max_wait, opts, [])
+            entries = self.groups[key][2]
+            entries.append((item, future, now))
+            if len(entries) >= self.max_batch_size:
+                self.__dispatch(key)
+            elif len(entries) == 1:
+                self.cond.notify()
+        return future
+
+    def close(self):
+        """Send whatever is waiting, and stop."""
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            for key in list(self.groups):
+                self.__dispatch(key)
+            self.cond.notify()
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        """Latency and batching statistics over the last `window` instances and batches.
+
+        :returns: The number of `instances` and `batches` sent so far, the `mean_batch_size`, `p50_batch_size` and `max_batch_size` of recent batches, and the `p50_latency_ms` and `p99_latency_ms` of recent instances (from being submitted to having an embedding).
+        :rtype: Dict[str, Union[int, float]]
+        """
+        with self.stats_lock:
+            latencies = sorted(self.latencies)
+            sizes = sorted(self.batch_sizes)
+            return {
+                'instances': self.instances,
+                'batches': self.batches,
+                'mean_batch_size': float(sum(sizes)) / len(sizes) if sizes else 0.0,
+                'p50_batch_size': _percentile(sizes, 50),
+                'max_batch_size': sizes[-1] if sizes else 0,
+                'p50_latency_ms': _percentile(latencies, 50) * 1000.0,
+                'p99_latency_ms': _percentile(latencies, 99) * 1000.0,
+            }
+
+    def __run(self):
+        with self.cond:
+            while not self.closed:
+                now = time.time()
+                for key, (deadline, opts, entries) in list(self.groups.items()):
+                    if deadline <= now:
+                        self.__dispatch(key)
+                if self.groups:
+                    wait = min(deadline for deadline, _, _ in self.groups.values()) - now
+                    self.cond.wait(max(wait, 0))
+                else:
+                    self.cond.wait()
+
+    def __dispatch(self, key):
+        # Called with `cond` held.
+        _, opts, entries = self.groups.pop(key)
+        self.executor.submit(self.__send, key[0], opts, key[2], entries)
+
+    def __send(self, url, opts, timeout, entries):
+        try:
+            emb = self.connection.raw_embed(url, [e[0] for e in entries], opts=opts, timeout=timeout)
+        except Exception as err:
+            for _, future, _ in entries:
+                future.set_exception(err)
+            return
+        now = time.time()
+        with self.stats_lock:
+            self.instances += len(entries)
+            self.batches += 1
+            self.batch_sizes.append(len(entries))
+            self.latencies.extend(now - start for _, _, start in entries)
+        for (_, future, _), e in zip(entries, emb):
+            future.set_result(e)
+
+
+def _percentile(values, p):
+    # Nearest-rank percentile of sorted `values`.
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
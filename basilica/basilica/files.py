@@ -0,0 +1,113 @@
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import functools
+import glob
+import os
+import six
+import tarfile
+import zipfile
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tif', '.tiff')
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+ZIP_EXTENSIONS = ('.zip',)
+
+# `os.PathLike` is Python 3.6+.
+_PATH_LIKE = getattr(os, 'PathLike', ())
+
+
+def image_sources(paths):
+    """Expands a list of paths into a stream of images, in order.  Each path
+    can be an image file, a directory (whose images are read recursively, in
+    sorted order), a glob pattern, or a tar or zip archive (whose image
+    members are streamed out without extracting them to disk).  A glob
+    pattern that matches nothing raises `FileNotFoundError`.
+
+    Plain files are yielded as zero-argument functions that read them, so
+    that the reads can happen in parallel; archive members are yielded as
+    bytes, since they have to be read in order.  Anything in `paths` that
+    is already one of those is passed through, so the output of this can be
+    sliced (say, to resume a job) and then passed back in.  Paths can also
+    be `pathlib.Path`s (or other `os.PathLike`s).
+    """
+    for path in paths:
+        if isinstance(path, _PATH_LIKE):
+            path = os.fspath(path)
+        if not isinstance(path, six.string_types):
+            if not isinstance(path, bytes) and not callable(path):
+                raise TypeError('`paths` must contain paths, bytes or functions (got `%s`)' % (path,))
+            yield path
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if _has_extension(name, IMAGE_EXTENSIONS + TAR_EXTENSIONS + ZIP_EXTENSIONS):
+                        for source in image_sources([os.path.join(root, name)]):
+                            yield source
+        elif _has_extension(path, TAR_EXTENSIONS):
+            for member in _tar_members(path):
+                yield member
+        elif _has_extension(path, ZIP_EXTENSIONS):
+            for member in _zip_members(path):
+                yield member
+        elif not os.path.exists(path) and any(c in path for c in '*?['):
+            matches = sorted(glob.glob(path, recursive=True))
+            if not matches:
+                # Like any other missing path, rather than quietly
+                # leaving it out of the output.
+                raise FileNotFoundError('no files match `%s`' % path)
+            for source in image_sources(matches):
+                yield source
+        else:
+            yield functools.partial(read_file, path)
+
+
+def read_ahead(sources, workers, prefetch):
+    """Reads the sources from `image_sources` with a pool of `workers`
+    threads, keeping up to `prefetch` of them in flight, and yields their
+    bytes in order."""
+    if workers <= 0:
+        for source in sources:
+            yield source if isinstance(source, bytes) else source()
+        return
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = collections.deque()
+    try:
+        for source in sources:
+            pending.append(source if isinstance(source, bytes) else executor.submit(source))
+            if len(pending) >= prefetch:
+                yield _result(pending.popleft())
+        while pending:
+            yield _result(pending.popleft())
+    finally:
+        for future in pending:
+            if not isinstance(future, bytes):
+                future.cancel()
+        executor.shutdown(wait=False)
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _result(source):
+    return source if isinstance(source, bytes) else source.result()
+
+
+def _has_extension(path, extensions):
+    return path.lower().endswith(extensions)
+
+
+def _tar_members(path):
+    # Streaming mode, so compressed archives are decompressed in one pass.
+    with tarfile.open(path, 'r|*') as tar:
+        for member in tar:
+            if member.isfile() and _has_extension(member.name, IMAGE_EXTENSIONS):
+                yield tar.extractfile(member).read()
+
+
+def _zip_members(path):
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            if not info.filename.endswith('/') and _has_extension(info.filename, IMAGE_EXTENSIONS):
+                yield archive.read(info)
@@ -0,0 +1,86 @@
+import collections
+import threading
+
+from .coalesce import _percentile
+
+
+class HedgePolicy(object):
+    def __init__(self, delay=None, percentile=95, budget=0.05, window=1000, min_samples=20):
+        """When to send a duplicate of a slow request, for the `hedge` argument of :class:`basilica.Connection`.
+
+        If a request hasn't come back after `delay` seconds (or, without a fixed `delay`, after the `percentile` of recent request latencies), the same request is sent again and whichever response arrives first is used.  Hedges are only sent while they make up less than `budget` of all requests, so they can't add more than that much load.
+
+        :param delay: How long to wait before hedging, in seconds.  Defaults to adapting to recent latencies.
+        :type delay: float
+        :param percentile: Which percentile of recent latencies to wait for, when there's no fixed `delay`.
+        :type percentile: float
+        :param budget: The most hedges to send, as a fraction of requests.
+        :type budget: float
+        :param window: How many recent latencies to take the percentile of.
+        :type window: int
+        :param min_samples: How many latencies to see before hedging, when there's no fixed `delay`.
+        :type min_samples: int
+
+        >>> hedge = basilica.HedgePolicy(percentile=90, budget=0.1)
+        >>> with basilica.Connection('SLOW_DEMO_KEY', hedge=hedge) as c:
+        ...   for embedding in c.embed_sentences(sentences, concurrency=4):
+        ...     print(embedding)
+        >>> hedge.stats()
+        {'requests': 120, 'hedges': 9, 'wins': 6, 'delay_ms': 212.5}
+        """
+        self.fixed_delay = delay
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+
+    def delay(self):
+        """How long to wait before hedging a request that's just been sent, or None not to.  Counts the request towards the budget."""
+        with self.lock:
+            self.requests += 1
+            return self.__delay()
+
+    def allow(self):
+        """Whether the budget has room for one more hedge, which is counted if so."""
+        with self.lock:
+            if self.hedges >= self.budget * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def record(self, latency):
+        """Note that a request (or a hedge) came back after `latency` seconds."""
+        with self.lock:
+            self.latencies.append(latency)
+
+    def won(self):
+        """Note that a hedge came back before the request it duplicated."""
+        with self.lock:
+            self.wins += 1
+
+    def stats(self):
+        """How much hedging has been done.
+
+        :returns: The number of `requests`, `hedges` sent, hedges that came back first (`wins`), and the current `delay_ms` (or None if not hedging yet).
+        :rtype: Dict[str, Union[int, float]]
+        """
+        with self.lock:
+            delay = self.__delay()
+            return {
+                'requests': self.requests,
+                'hedges': self.hedges,
+                'wins': self.wins,
+                'delay_ms': delay * 1000.0 if delay is not None else None,
+            }
+
+    def __delay(self):
+        # Called with `lock` held.
+        if self.fixed_delay is not None:
+            return self.fixed_delay
+        if len(self.latencies) < self.min_samples:
+            return None
+        return _percentile(sorted(self.latencies), self.percentile)
@@ -0,0 +1,339 @@
+import json
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class EmbeddingIndex(object):
+    def __init__(self, dimensions=None, metric='cosine'):
+        """An in-memory index of embeddings for finding nearest neighbours, which can be filled straight from :meth:`basilica.Connection.embed_sentences` or :meth:`basilica.Connection.embed_images`.  Needs numpy.
+
+        Embeddings are kept in one contiguous float32 matrix, and searched exactly with a matrix multiply per batch of queries.  For millions of embeddings, :meth:`train` partitions them into clusters with k-means, after which each query only looks in the few clusters nearest to it.
+
+        :param dimensions: The size of each embedding.  Defaults to the size of the first one added.
+        :type dimensions: int
+        :param metric: ``'cosine'`` for cosine distance (embeddings are normalized as they're added), or ``'l2'`` for euclidean distance.
+        :type metric: str
+
+        >>> index = basilica.EmbeddingIndex()
+        >>> with basilica.Connection('SLOW_DEMO_KEY') as c:
+        ...   index.add(c.embed_sentences(sentences))
+        ...   distances, ids = index.search(c.embed_sentences(['A query.']), k=3)
+        >>> [sentences[i] for i in ids[0]]
+        ['A query!', 'A question.', 'Another query.']
+        """
+        if numpy is None:
+            raise ImportError('`EmbeddingIndex` requires numpy (`pip install numpy`)')
+        if metric not in _METRICS:
+            raise ValueError('`metric` argument must be one of %s (got `%s`)' % (_METRICS, metric))
+        self.metric = metric
+        self.dimensions = dimensions
+        self.size = 0
+        self.next_id = 0
+        self.data = None
+        self.ids = None
+        # Squared norms, for `'l2'`.
+        self.norms = None
+        # Set by `train`.
+        self.centroids = None
+        self.assignments = None
+        self.lists = None
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def vectors(self):
+        """The embeddings in the index, in the order they were added (normalized, with ``metric='cosine'``)."""
+        return self.__rows(self.data)
+
+    def add(self, embeddings, ids=None):
+        """Add embeddings to the index.
+
+        :param embeddings: The embeddings, as an iterable of lists of floats (like the generators returned by `embed_sentences`) or a 2-D numpy array.  Errors returned in place of embeddings with ``on_error='bisect'`` (and rows of NaNs) are skipped, but still use up an id.
+        :type embeddings: Iterable[List[float]] or numpy.ndarray
+        :param ids: An integer id for each embedding, to return from :meth:`search`.  Defaults to counting up from the number of embeddings passed to earlier calls, so that ids are positions in the data that was embedded.
+        :type ids: Iterable[int]
+        :returns: How many embeddings were added.
+        :rtype: int
+        """
+        ids = iter(ids) if ids is not None else None
+        added = 0
+        for chunk in _chunks(embeddings, _ADD_CHUNK):
+            chunk = numpy.asarray(chunk, dtype=numpy.float32)
+            if chunk.ndim != 2:
+                raise ValueError('`embeddings` argument must be 2-D (got shape `%s`)' % (chunk.shape,))
+            if ids is None:
+                chunk_ids = numpy.arange(self.next_id, self.next_id + len(chunk), dtype=numpy.int64)
+            else:
+                chunk_ids = numpy.fromiter((next(ids) for _ in range(len(chunk))), dtype=numpy.int64,
+                                           count=len(chunk))
+            self.next_id = max(self.next_id, int(chunk_ids.max()) + 1) if len(chunk) else self.next_id
+            ok = ~numpy.isnan(chunk).any(axis=1)
+            if not ok.all():
+                chunk, chunk_ids = chunk[ok], chunk_ids[ok]
+            added += self.__append(chunk, chunk_ids)
+        return added
+
+    def train(self, clusters=None, iterations=20, sample=100000, seed=0):
+        """Partition the index into `clusters` with k-means, so that :meth:`search` can look at a few of them rather than every embedding.  Embeddings added afterwards are put in the nearest cluster.  Train again once the index has grown a lot, so that the clusters still fit the data.
+
+        :param clusters: How many clusters to make.  Defaults to four times the square root of the number of embeddings.
+        :type clusters: int
+        :param iterations: How many rounds of k-means to run.
+        :type iterations: int
+        :param sample: How many embeddings to fit the clusters to, chosen at random.
+        :type sample: int
+        :param seed: Seed for choosing the sample and the starting centroids.
+        :type seed: int
+        """
+        if self.size == 0:
+            raise RuntimeError('cannot train an empty `EmbeddingIndex`')
+        if clusters is None:
+            clusters = int(4 * numpy.sqrt(self.size))
+        clusters = max(1, min(clusters, self.size))
+        rng = numpy.random.RandomState(seed)
+        data = self.__rows(self.data)
+        if self.size > sample:
+            points = data[numpy.sort(rng.choice(self.size, sample, replace=False))]
+        else:
+            points = numpy.array(data)
+        centroids = points[rng.choice(len(points), clusters, replace=False)].copy()
+        for _ in range(iterations):
+            nearest = self.__nearest(points, centroids)
+            counts = numpy.bincount(nearest, minlength=clusters)
+            sums = numpy.zeros_like(centroids)
+            numpy.add.at(sums, nearest, points)
+            empty = counts == 0
+            # Restart empty clusters from random points.
+            sums[empty] = points[rng.choice(len(points), int(empty.sum()))]
+            counts[empty] = 1
+            centroids = (sums / counts[:, None]).astype(numpy.float32)
+            if self.metric == 'cosine':
+                centroids = _normalize(centroids)
+        self.centroids = centroids
+        self.assignments = numpy.empty(len(self.data), dtype=numpy.int32)
+        for start in range(0, self.size, _ADD_CHUNK):
+            rows = data[start:start+_ADD_CHUNK]
+            self.assignments[start:start+len(rows)] = self.__nearest(rows, self.centroids)
+        self.lists = None
+
+    def search(self, queries, k=10, nprobe=8, exact=False):
+        """Find the `k` embeddings nearest to each query.
+
+        :param queries: The embeddings to look up, as an iterable of lists of floats or a 2-D numpy array (or a single embedding).
+        :type queries: Iterable[List[float]] or numpy.ndarray
+        :param k: How many neighbours to return for each query.
+        :type k: int
+        :param nprobe: After :meth:`train`, how many of the nearest clusters to look in.  More is slower but finds more of the true neighbours.
+        :type nprobe: int
+        :param exact: Whether to compare against every embedding, even after :meth:`train`.
+        :type exact: bool
+        :returns: The distances to each query's neighbours, nearest first, and their ids, as two arrays with one row per query.  Cosine distances are ``1 - cosine similarity``.  Rows are padded with distance infinity and id -1 when there aren't `k` neighbours to return.
+        :rtype: Tuple[numpy.ndarray, numpy.ndarray]
+        """
+        if type(k) != int or k < 1:
+            raise ValueError('`k` argument must be a positive int (got `%s`)' % k)
+        queries = numpy.asarray(list(queries) if not isinstance(queries, numpy.ndarray) else queries,
+                                dtype=numpy.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        if self.dimensions is not None and queries.shape[1] != self.dimensions:
+            raise ValueError('queries must have %d dimensions (got %d)' % (self.dimensions, queries.shape[1]))
+        if self.metric == 'cosine':
+            queries = _normalize(queries)
+        distances = numpy.full((len(queries), k), numpy.inf, dtype=numpy.float32)
+        ids = numpy.full((len(queries), k), -1, dtype=numpy.int64)
+        if self.size == 0:
+            return distances, ids
+        if self.centroids is None or exact:
+            # Enough queries at a time that the matrix multiply is
+            # efficient, but not so many that the score matrix is huge.
+            step = max(1, _MAX_SCORES // self.size)
+            data, norms = self.__rows(self.data), self.__rows(self.norms)
+            for start in range(0, len(queries), step):
+                d, rows = self.__top_k(queries[start:start+step], data, norms, k)
+                distances[start:start+step, :rows.shape[1]] = d
+                ids[start:start+step, :rows.shape[1]] = self.ids[rows]
+            return distances, ids
+        lists = self.__lists()
+        probes = self.__probes(queries, self.centroids, min(nprobe, len(self.centroids)))
+        for i, query in enumerate(queries):
+            rows = numpy.concatenate([lists[c] for c in probes[i]])
+            d, best = self.__top_k(query[None, :], self.data[rows],
+                                   self.norms[rows] if self.norms is not None else None, k)
+            distances[i, :best.shape[1]] = d[0]
+            ids[i, :best.shape[1]] = self.ids[rows[best[0]]]
+        return distances, ids
+
+    def save(self, path):
+        """Write the index to the directory `path`, to open again with :meth:`load`.
+
+        :param path: The directory to write to.  It's created if it doesn't exist, and files already in it are overwritten.
+        :type path: str
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        arrays = {'vectors': self.vectors, 'ids': self.__rows(self.ids)}
+        if self.norms is not None:
+            arrays['norms'] = self.__rows(self.norms)
+        if self.centroids is not None:
+            arrays['centroids'] = self.centroids
+            arrays['assignments'] = self.__rows(self.assignments)
+        # Each file is written alongside and then moved into place, since
+        # an index loaded from `path` may still have the old ones mapped.
+        for name, value in arrays.items():
+            tmp = os.path.join(path, name + '.tmp.npy')
+            numpy.save(tmp, value)
+            os.replace(tmp, os.path.join(path, name + '.npy'))
+        tmp = os.path.join(path, 'index.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'metric': self.metric, 'dimensions': self.dimensions, 'size': self.size,
+                       'next_id': self.next_id, 'arrays': sorted(arrays)}, f)
+        os.replace(tmp, os.path.join(path, 'index.json'))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Open an index written by :meth:`save`.
+
+        :param path: The directory it was saved to.
+        :type path: str
+        :param mmap: Whether to memory-map the embeddings rather than read them in, so that the index opens instantly and pages are only read from disk as searches touch them.
+        :type mmap: bool
+        :rtype: basilica.EmbeddingIndex
+
+        >>> index = basilica.EmbeddingIndex.load('/data/sentences.index')
+        >>> distances, ids = index.search(query, k=5)
+        """
+        with open(os.path.join(path, 'index.json')) as f:
+            meta = json.load(f)
+        index = cls(dimensions=meta['dimensions'], metric=meta['metric'])
+        arrays = dict((name, numpy.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None))
+                      for name in meta['arrays'])
+        # These are at capacity, so the next `add` copies them into memory
+        # rather than writing to the files.
+        index.data = arrays['vectors']
+        index.ids = arrays['ids']
+        index.norms = arrays.get('norms')
+        index.centroids = arrays.get('centroids')
+        index.assignments = arrays.get('assignments')
+        index.size = meta['size']
+        index.next_id = meta['next_id']
+        return index
+
+    def __rows(self, a):
+        return a[:self.size] if a is not None else None
+
+    def __append(self, chunk, chunk_ids):
+        if len(chunk) == 0:
+            return 0
+        if self.dimensions is None:
+            self.dimensions = chunk.shape[1]
+        if chunk.shape[1] != self.dimensions:
+            raise ValueError('embeddings must have %d dimensions (got %d)' % (self.dimensions, chunk.shape[1]))
+        if self.metric == 'cosine':
+            chunk = _normalize(chunk)
+        n = self.size
+        if self.data is None or n + len(chunk) > len(self.data):
+            capacity = max(2 * (len(self.data) if self.data is not None else 0), n + len(chunk), _ADD_CHUNK)
+            self.data = _grow(self.data, n, (capacity, self.dimensions), numpy.float32)
+            self.ids = _grow(self.ids, n, (capacity,), numpy.int64)
+            if self.metric == 'l2':
+                self.norms = _grow(self.norms, n, (capacity,), numpy.float32)
+            if self.assignments is not None:
+                self.assignments = _grow(self.assignments, n, (capacity,), numpy.int32)
+        self.data[n:n+len(chunk)] = chunk
+        self.ids[n:n+len(chunk)] = chunk_ids
+        if self.metric == 'l2':
+            self.norms[n:n+len(chunk)] = numpy.einsum('ij,ij->i', chunk, chunk)
+        if self.assignments is not None:
+            self.assignments[n:n+len(chunk)] = self.__nearest(chunk, self.centroids)
+            self.lists = None
+        self.size += len(chunk)
+        return len(chunk)
+
+    def __lists(self):
+        # The rows in each cluster, as slices of one array sorted by cluster.
+        if self.lists is None:
+            assignments = self.__rows(self.assignments)
+            order = numpy.argsort(assignments, kind='stable')
+            bounds = numpy.searchsorted(assignments[order], numpy.arange(len(self.centroids) + 1))
+            self.lists = [order[bounds[c]:bounds[c+1]] for c in range(len(self.centroids))]
+        return self.lists
+
+    def __nearest(self, points, centroids):
+        return self.__probes(points, centroids, 1)[:, 0]
+
+    def __probes(self, points, centroids, n):
+        # The `n` nearest centroids to each point, as one row per point.
+        norms = numpy.einsum('ij,ij->i', centroids, centroids) if self.metric == 'l2' else None
+        out = []
+        for start in range(0, len(points), _ADD_CHUNK):
+            _, best = self.__top_k(points[start:start+_ADD_CHUNK], centroids, norms, n)
+            out.append(best)
+        return numpy.concatenate(out)
+
+    def __top_k(self, queries, data, norms, k):
+        # The `k` nearest rows of `data` to each query, nearest first.
+        # Rows are ranked by a score that's higher for nearer ones (the
+        # dot product, or for `'l2'`, `2 q.x - |x|^2`, which is `|q|^2`
+        # minus the squared distance), computed in place.
+        scores = numpy.dot(queries, data.T)
+        if self.metric == 'l2':
+            scores *= 2
+            scores -= norms[None, :]
+        n = scores.shape[1]
+        k = min(k, n)
+        if k == 1:
+            best = numpy.argmax(scores, axis=1)[:, None]
+        else:
+            best = numpy.argpartition(scores, n - k, axis=1)[:, n-k:]
+        s = numpy.take_along_axis(scores, best, axis=1)
+        order = numpy.argsort(-s, axis=1)
+        best = numpy.take_along_axis(best, order, axis=1)
+        s = numpy.take_along_axis(s, order, axis=1)
+        if self.metric == 'cosine':
+            return 1.0 - s, best
+        return numpy.sqrt(numpy.maximum(numpy.einsum('ij,ij->i', queries, queries)[:, None] - s, 0)), best
+
+_METRICS = ('cosine', 'l2')
+
+_ADD_CHUNK = 4096
+# The most query-by-embedding distances to compute at once.
+_MAX_SCORES = 1 << 22
+
+def _chunks(embeddings, n):
+    if isinstance(embeddings, numpy.ndarray):
+        if embeddings.ndim == 1:
+            embeddings = embeddings[None, :]
+        for start in range(0, len(embeddings), n):
+            yield embeddings[start:start+n]
+        return
+    chunk = []
+    for e in embeddings:
+        # An `EmbeddingError` becomes a row of NaNs, once we know how wide
+        # to make it.
+        chunk.append(None if isinstance(e, Exception) else e)
+        if len(chunk) == n:
+            yield _fill(chunk)
+            chunk = []
+    if chunk:
+        yield _fill(chunk)
+
+def _fill(chunk):
+    width = max([len(e) for e in chunk if e is not None] or [1])
+    return [e if e is not None else [numpy.nan] * width for e in chunk]
+
+def _grow(a, n, shape, dtype):
+    grown = numpy.empty(shape, dtype=dtype)
+    if a is not None:
+        grown[:n] = a[:n]
+    return grown
+
+def _normalize(a):
+    norms = numpy.linalg.norm(a, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (a / norms).astype(numpy.float32)
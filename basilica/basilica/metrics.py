@@ -0,0 +1,131 @@
+from contextlib import contextmanager
+import collections
+import json
+import os
+import threading
+import time
+
+from .coalesce import _percentile
+
+
+class Metrics(object):
+    def __init__(self, hooks=(), trace=True, window=10000, max_events=100000):
+        """Counters, histograms and a timeline of where time goes in a :class:`basilica.Connection`, for its `metrics` argument.
+
+        Each batch is timed in stages: ``'encode'`` (preparing an instance, when there are no `preprocess_workers`), ``'queue_wait'`` (waiting for an API thread), ``'preprocess_wait'`` (waiting on `preprocess_workers`), ``'batch'`` (everything an API thread does with it, including retries), ``'serialize'`` (building the request body), ``'request'`` (each HTTP attempt), and ``'decode'`` (parsing the response).  The counters are ``'batches'``, ``'items'``, ``'requests'``, ``'retries'``, ``'timeouts'``, ``'throttled'``, ``'hedges'``, ``'errors'``, ``'failed_items'`` (with ``on_error='bisect'``), ``'bytes_sent'`` and ``'bytes_received'``, and ``'queue_depth'`` is sampled as each batch is queued.
+
+        :param hooks: Functions to call as each stage finishes, with the stage's name, its duration in seconds, and a dict of details (like the batch number and size).  They're called from whichever thread did the work, so they should be quick.
+        :type hooks: Iterable[Callable[[str, float, Dict[str, Any]], None]]
+        :param trace: Whether to keep a timeline of stages for :meth:`export_trace`.
+        :type trace: bool
+        :param window: How many recent values to compute histogram percentiles from.
+        :type window: int
+        :param max_events: How many of the most recent stages to keep in the timeline.
+        :type max_events: int
+
+        >>> metrics = basilica.Metrics()
+        >>> with basilica.Connection('SLOW_DEMO_KEY', metrics=metrics) as c:
+        ...   embeddings = list(c.embed_images(images, concurrency=4))
+        >>> metrics.snapshot()['histograms']['request']['p99']
+        0.8132
+        >>> metrics.export_trace('embed.trace.json')  # Open in chrome://tracing.
+        """
+        self.hooks = list(hooks)
+        self.trace = trace
+        self.window = window
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.first = None
+        self.last = None
+        self.counters = collections.defaultdict(int)
+        self.histograms = {}
+        self.events = collections.deque(maxlen=max_events)
+        self.threads = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, value):
+        with self.lock:
+            self.__observe(name, value)
+
+    def record(self, name, start, duration, **args):
+        """Note that a stage took `duration` seconds from `start`."""
+        with self.lock:
+            self.__observe(name, duration)
+            self.first = start if self.first is None else min(self.first, start)
+            self.last = max(self.last, start + duration) if self.last is not None else start + duration
+            if self.trace:
+                thread = threading.current_thread()
+                self.threads[thread.ident] = thread.name
+                self.events.append({
+                    'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+                    'ts': (start - self.started) * 1e6, 'dur': duration * 1e6, 'args': args,
+                })
+        for hook in self.hooks:
+            hook(name, duration, args)
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.time() - start, **args)
+
+    def snapshot(self):
+        """The counters and histograms so far.
+
+        :returns: A dict of `counters`, a dict of `histograms` (each with the `count` of values, and the `mean`, `p50`, `p99` and `max` of recent ones, with durations in seconds), and the overall `items_per_second`.
+        :rtype: Dict[str, Any]
+        """
+        with self.lock:
+            histograms = {}
+            for name, (count, total, values) in self.histograms.items():
+                values = sorted(values)
+                histograms[name] = {
+                    'count': count,
+                    'mean': float(total) / count,
+                    'p50': _percentile(values, 50),
+                    'p99': _percentile(values, 99),
+                    'max': values[-1],
+                }
+            elapsed = self.last - self.first if self.first is not None else 0
+            return {
+                'counters': dict(self.counters),
+                'histograms': histograms,
+                'items_per_second': self.counters['items'] / elapsed if elapsed > 0 else 0.0,
+            }
+
+    def export_trace(self, path):
+        """Write the timeline out as Chrome trace JSON, which can be viewed in chrome://tracing or https://ui.perfetto.dev.
+
+        :param path: Where to write it.
+        :type path: str
+        """
+        with self.lock:
+            events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                       'args': {'name': name}} for tid, name in self.threads.items()]
+            events += list(self.events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def __observe(self, name, value):
+        # Called with `lock` held.
+        if name not in self.histograms:
+            self.histograms[name] = [0, 0, collections.deque(maxlen=self.window)]
+        h = self.histograms[name]
+        h[0] += 1
+        h[1] += value
+        h[2].append(value)
+
+
+@contextmanager
+def span(metrics, name, **args):
+    # `Metrics.span`, or nothing when a connection has no metrics.
+    if metrics is None:
+        yield
+    else:
+        with metrics.span(name, **args):
+            yield
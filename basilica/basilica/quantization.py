@@ -0,0 +1,258 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Quantizer(object):
+    def __init__(self, dtype='int8', scale='vector', dimension_scales=None):
+        """How to store embeddings in less memory, for the `output` argument of :meth:`basilica.Connection.embed_sentences`, :meth:`basilica.Connection.embed_images` and :meth:`basilica.Connection.embed_image_files`, which then return a :class:`basilica.QuantizedEmbeddings`.  Passing ``output='float16'`` or ``output='int8'`` is the same as passing ``Quantizer('float16')`` or ``Quantizer('int8')``.  Needs numpy.
+
+        ``'float16'`` takes half the memory of float32, and ``'int8'`` a quarter (plus 4 bytes per embedding for its scale).  Embeddings are converted a batch at a time as they arrive, so the float32 embeddings are never all in memory at once.
+
+        Quantizing loses a little recall.  On 20,000 clustered 512-dimension embeddings (``python benchmark.py --only quantization``), the 10 nearest neighbours by cosine similarity of 200 queries included 99.9% of those found with float32 embeddings with ``'float16'``, 98.5% with ``'int8'`` and per-vector scales, and 97.9% with ``'int8'`` and per-dimension scales.
+
+        :param dtype: ``'float16'`` or ``'int8'``.
+        :type dtype: str
+        :param scale: For ``'int8'``, whether to scale each embedding by its largest value (``'vector'``), or each dimension by its largest value (``'dimension'``).  Per-dimension scales are taken from the data passed to :meth:`fit`, or from the first batch if it hasn't been called, and values outside them are clipped.
+        :type scale: str
+        :param dimension_scales: Per-dimension scales from an earlier :meth:`fit`, to quantize new embeddings the same way.
+        :type dimension_scales: numpy.ndarray
+
+        >>> quantizer = basilica.Quantizer('int8', scale='dimension').fit(sample_embeddings)
+        >>> with basilica.Connection('SLOW_DEMO_KEY') as c:
+        ...   embeddings = c.embed_sentences(sentences, output=quantizer)
+        >>> embeddings.nbytes
+        51200
+        >>> basilica.cosine_similarity(query, embeddings)
+        array([[0.8132, 0.4127, ...]], dtype=float32)
+        """
+        if numpy is None:
+            raise ImportError('`Quantizer` requires numpy (`pip install numpy`)')
+        if dtype not in _DTYPES:
+            raise ValueError('`dtype` argument must be one of %s (got `%s`)' % (_DTYPES, dtype))
+        if scale not in _SCALES:
+            raise ValueError('`scale` argument must be one of %s (got `%s`)' % (_SCALES, scale))
+        self.dtype = dtype
+        self.scale = scale
+        self.dimension_scales = None
+        if dimension_scales is not None:
+            self.dimension_scales = numpy.asarray(dimension_scales, dtype=numpy.float32)
+
+    def fit(self, embeddings):
+        """Set the per-dimension scales from a sample of embeddings, for ``scale='dimension'``.
+
+        :param embeddings: The sample, as a 2-D array or an iterable of lists of floats.
+        :type embeddings: Union[numpy.ndarray, Iterable[List[float]]]
+        :returns: This quantizer.
+        :rtype: basilica.Quantizer
+        """
+        embeddings = _as_matrix(embeddings)
+        scales = numpy.nanmax(numpy.abs(embeddings), axis=0) / 127.0
+        scales[~(scales > 0)] = 1.0
+        self.dimension_scales = scales.astype(numpy.float32)
+        return self
+
+    def quantize(self, embeddings):
+        """Quantize some embeddings.
+
+        :param embeddings: The embeddings, as a 2-D array or an iterable of lists of floats.
+        :type embeddings: Union[numpy.ndarray, Iterable[List[float]]]
+        :rtype: basilica.QuantizedEmbeddings
+        """
+        return self.stack([_as_matrix(embeddings)], 0)
+
+    def stack(self, batches, capacity):
+        # Quantizes each batch into one growing matrix, like
+        # `basilica._stack`.  Errors become rows that are NaN when
+        # dequantized.
+        values = None
+        row_scales = None
+        n = 0
+        for batch in batches:
+            matrix = _batch_matrix(batch, values.shape[1] if values is not None else None)
+            if matrix is None:
+                # All errors, so we can't tell the dimension yet.  Their
+                # rows are filled in once we can.
+                n += len(batch)
+                continue
+            batch = matrix
+            if values is None:
+                values = numpy.zeros((max(capacity, n + len(batch)), batch.shape[1]),
+                                     dtype=self.dtype)
+                row_scales = numpy.empty(len(values), dtype=numpy.float32)
+                row_scales[:n] = numpy.nan
+            elif n + len(batch) > len(values):
+                size = max(2 * len(values), n + len(batch))
+                values = _grow(values, n, (size, values.shape[1]))
+                row_scales = _grow(row_scales, n, (size,))
+            q, r = self.__quantize(batch)
+            values[n:n+len(batch)] = q
+            row_scales[n:n+len(batch)] = r
+            n += len(batch)
+        if values is None:
+            values = numpy.zeros((n, 0), dtype=self.dtype)
+            row_scales = numpy.full(n, numpy.nan, dtype=numpy.float32)
+        if n < len(values):
+            values = values[:n].copy()
+            row_scales = row_scales[:n].copy()
+        dimension_scales = self.dimension_scales if self.dtype == 'int8' and self.scale == 'dimension' else None
+        return QuantizedEmbeddings(values, row_scales, dimension_scales)
+
+    def __quantize(self, batch):
+        # Rows with NaNs in them (errors) get a NaN scale.
+        missing = numpy.isnan(batch).any(axis=1)
+        batch = numpy.where(missing[:, None], 0, batch)
+        r = numpy.where(missing, numpy.nan, 1.0).astype(numpy.float32)
+        if self.dtype == 'float16':
+            return batch.astype(numpy.float16), r
+        if self.scale == 'vector':
+            r *= numpy.abs(batch).max(axis=1) / 127.0
+            r[r == 0] = 1.0
+            q = batch / numpy.where(missing, 1.0, r)[:, None]
+        else:
+            if self.dimension_scales is None:
+                self.fit(batch[~missing] if (~missing).any() else batch)
+            q = batch / self.dimension_scales[None, :]
+        return numpy.clip(numpy.rint(q), -127, 127).astype(numpy.int8), r
+
+
+class QuantizedEmbeddings(object):
+    def __init__(self, values, row_scales, dimension_scales=None):
+        """Embeddings stored as float16 or int8, as returned by the `embed_*` methods with a quantized `output`.  Embedding `i` is approximately ``values[i] * row_scales[i] * dimension_scales``, which :meth:`dequantize` computes.  Rows for errors (with ``on_error='bisect'``) have a NaN scale.
+
+        Use :func:`basilica.dot` and :func:`basilica.cosine_similarity` to compare them without converting them all back to float32 at once.
+
+        :param values: One row per embedding.
+        :type values: numpy.ndarray
+        :param row_scales: One scale per embedding.
+        :type row_scales: numpy.ndarray
+        :param dimension_scales: One scale per dimension, or None.
+        :type dimension_scales: numpy.ndarray
+        """
+        self.values = values
+        self.row_scales = row_scales
+        self.dimension_scales = dimension_scales
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def nbytes(self):
+        """How much memory the embeddings take, in bytes."""
+        return self.values.nbytes + self.row_scales.nbytes
+
+    def dequantize(self, start=0, stop=None):
+        """Convert embeddings back to float32.
+
+        :param start: The first row to convert.
+        :type start: int
+        :param stop: One past the last row to convert.  Defaults to the end.
+        :type stop: int
+        :returns: One row per embedding.
+        :rtype: numpy.ndarray
+        """
+        out = self.values[start:stop].astype(numpy.float32)
+        out *= self.row_scales[start:stop, None]
+        if self.dimension_scales is not None:
+            out *= self.dimension_scales[None, :]
+        return out
+
+
+def dequantize(embeddings):
+    """Convert :class:`basilica.QuantizedEmbeddings` back to a float32 array (anything else is just converted to one).
+
+    :param embeddings: The embeddings.
+    :type embeddings: Union[basilica.QuantizedEmbeddings, numpy.ndarray, Iterable[List[float]]]
+    :rtype: numpy.ndarray
+    """
+    if isinstance(embeddings, QuantizedEmbeddings):
+        return embeddings.dequantize()
+    return _as_matrix(embeddings)
+
+def dot(a, b):
+    """The dot product of every embedding in `a` with every embedding in `b`, either of which can be quantized.  Quantized embeddings are converted a block at a time, so they're never all in float32 at once.
+
+    :param a: The first embeddings (or a single one).
+    :type a: Union[basilica.QuantizedEmbeddings, numpy.ndarray, Iterable[List[float]]]
+    :param b: The second embeddings (or a single one).
+    :type b: Union[basilica.QuantizedEmbeddings, numpy.ndarray, Iterable[List[float]]]
+    :returns: A matrix with a row for each embedding in `a` and a column for each in `b`.
+    :rtype: numpy.ndarray
+    """
+    a, b = _operand(a), _operand(b)
+    out = numpy.empty((len(a), len(b)), dtype=numpy.float32)
+    for i, x in _blocks(a):
+        for j, y in _blocks(b):
+            out[i:i+len(x), j:j+len(y)] = numpy.dot(x, y.T)
+    return out
+
+def cosine_similarity(a, b):
+    """The cosine similarity of every embedding in `a` with every embedding in `b`, either of which can be quantized, like :func:`basilica.dot`.
+
+    :param a: The first embeddings (or a single one).
+    :type a: Union[basilica.QuantizedEmbeddings, numpy.ndarray, Iterable[List[float]]]
+    :param b: The second embeddings (or a single one).
+    :type b: Union[basilica.QuantizedEmbeddings, numpy.ndarray, Iterable[List[float]]]
+    :returns: A matrix with a row for each embedding in `a` and a column for each in `b`.
+    :rtype: numpy.ndarray
+
+    >>> basilica.cosine_similarity(c.embed_sentence('A query.'), embeddings).argmax()
+    17
+    """
+    a, b = _operand(a), _operand(b)
+    out = dot(a, b)
+    out /= _norms(a)[:, None]
+    out /= _norms(b)[None, :]
+    return out
+
+
+_DTYPES = ('float16', 'int8')
+_SCALES = ('vector', 'dimension')
+
+# How many rows to convert to float32 at a time.
+_BLOCK = 65536
+
+def _operand(x):
+    if isinstance(x, QuantizedEmbeddings):
+        return x
+    x = _as_matrix(x)
+    return x[None, :] if x.ndim == 1 else x
+
+def _as_matrix(embeddings):
+    if isinstance(embeddings, numpy.ndarray):
+        return embeddings.astype(numpy.float32, copy=False)
+    return numpy.asarray(list(embeddings), dtype=numpy.float32)
+
+def _batch_matrix(batch, width):
+    # A batch from `Connection.embed`, with errors as rows of NaNs, or
+    # None if it's all errors and we don't know how wide to make them.
+    if isinstance(batch, numpy.ndarray):
+        return batch.astype(numpy.float32, copy=False)
+    rows = [e for e in batch if not isinstance(e, Exception)]
+    if rows:
+        width = len(rows[0])
+    elif width is None:
+        return None
+    return numpy.asarray([[numpy.nan] * width if isinstance(e, Exception) else e for e in batch],
+                         dtype=numpy.float32)
+
+def _blocks(x):
+    for start in range(0, len(x), _BLOCK):
+        if isinstance(x, QuantizedEmbeddings):
+            yield start, x.dequantize(start, start + _BLOCK)
+        else:
+            yield start, x[start:start+_BLOCK]
+
+def _norms(x):
+    return numpy.concatenate([numpy.linalg.norm(block, axis=1) for _, block in _blocks(x)] or
+                             [numpy.empty(0, dtype=numpy.float32)])
+
+def _grow(a, n, shape):
+    grown = numpy.zeros(shape, dtype=a.dtype)
+    grown[:n] = a[:n]
+    return grown
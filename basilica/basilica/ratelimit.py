@@ -0,0 +1,141 @@
+from email.utils import mktime_tz, parsedate_tz
+import random
+import threading
+import time
+
+
+class RateLimiter(object):
+    def __init__(self, requests_per_second=None, items_per_second=None, burst=1.0,
+                 retries=8, backoff_factor=0.5, max_backoff=60.0,
+                 decrease=0.8, increase=0.01):
+        """Paces requests to the server so as to stay under your quota, for the `rate_limit` argument of :class:`basilica.Connection`.  A single instance can be shared between connections and threads using the same auth key, so that together they keep to one budget.
+
+        Requests are held back by a token bucket for requests and one for instances, either of which can be left out.  When the server turns a request away with a 429, every request through the limiter waits for as long as the `Retry-After` header asks (or, without one, for an exponentially growing and randomly jittered delay), and the rates are scaled down by `decrease`.  They creep back up by `increase` of the configured rate with every request that gets through, so the limiter settles just under the quota rather than repeatedly overshooting it.
+
+        :param requests_per_second: How many requests to send per second, or None for no limit.
+        :type requests_per_second: float
+        :param items_per_second: How many instances to send per second, or None for no limit.
+        :type items_per_second: float
+        :param burst: How many seconds' worth of unused budget can be saved up for a burst.
+        :type burst: float
+        :param retries: How many times to retry a request that got a 429.
+        :type retries: int
+        :param backoff_factor: The first delay after a 429 without a `Retry-After` header, in seconds.  It doubles after each further 429.
+        :type backoff_factor: float
+        :param max_backoff: The longest to wait after a 429, in seconds.
+        :type max_backoff: float
+        :param decrease: What to multiply the rates by after a 429.
+        :type decrease: float
+        :param increase: How much of the configured rates to add back after a request gets through.
+        :type increase: float
+
+        >>> limiter = basilica.RateLimiter(requests_per_second=10, items_per_second=500)
+        >>> with basilica.Connection('SLOW_DEMO_KEY', rate_limit=limiter) as c:
+        ...   embeddings = list(c.embed_sentences(sentences, concurrency=4))
+        """
+        self.requests = _Bucket(requests_per_second, burst) if requests_per_second else None
+        self.items = _Bucket(items_per_second, burst) if items_per_second else None
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.decrease = decrease
+        self.increase = increase
+        self.lock = threading.Lock()
+        self.scale = 1.0
+        self.paused_until = 0.0
+        self.strikes = 0
+        self.throttles = 0
+
+    def reserve(self, items=1):
+        """Take the budget for a request of `items` instances.
+
+        :returns: How many seconds to wait before sending it.
+        :rtype: float
+        """
+        with self.lock:
+            now = time.time()
+            start = max(now, self.paused_until)
+            wait = start - now
+            for bucket, n in ((self.requests, 1), (self.items, items)):
+                if bucket is not None:
+                    wait = max(wait, bucket.take(n, start, self.scale) + start - now)
+            return wait
+
+    def acquire(self, items=1):
+        """Block until a request of `items` instances can be sent."""
+        wait = self.reserve(items)
+        if wait > 0:
+            time.sleep(wait)
+
+    def succeeded(self):
+        """Note that a request got through."""
+        with self.lock:
+            self.strikes = 0
+            self.scale = min(1.0, self.scale + self.increase)
+
+    def throttled(self, retry_after=None):
+        """Note that the server answered a request with a 429, and hold back every request for a while.
+
+        :param retry_after: The response's `Retry-After` header, if it had one.
+        :type retry_after: str
+        """
+        delay = retry_after_seconds(retry_after)
+        with self.lock:
+            self.throttles += 1
+            if delay is None:
+                # Full jitter, so that threads that were turned away together
+                # don't all come back at the same moment.
+                delay = random.uniform(0, self.backoff_factor * (2 ** self.strikes))
+            else:
+                delay += random.uniform(0, 0.1 * delay)
+            delay = min(delay, self.max_backoff)
+            self.strikes += 1
+            self.scale = max(0.01, self.scale * self.decrease)
+            self.paused_until = max(self.paused_until, time.time() + delay)
+
+    def stats(self):
+        """How the limiter is doing.
+
+        :returns: The number of 429s seen (`throttled`), and the fraction of the configured rates currently in use (`scale`).
+        :rtype: Dict[str, float]
+        """
+        with self.lock:
+            return {'throttled': self.throttles, 'scale': self.scale}
+
+
+class _Bucket(object):
+    # A token bucket that can go into debt, so that a request bigger than the
+    # bucket still gets through after waiting long enough.  Called with the
+    # limiter's lock held.
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.rate * burst)
+        self.tokens = self.capacity
+        self.last = time.time()
+
+    def take(self, n, now, scale):
+        rate = self.rate * scale
+        if now > self.last:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * rate)
+            self.last = now
+        self.tokens -= n
+        return max(0.0, -self.tokens / rate)
+
+
+def retry_after_seconds(value):
+    # `Retry-After` is either a number of seconds or an HTTP date.
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, mktime_tz(date) - time.time())
+
+
+def backoff_delay(backoff_factor, attempt):
+    # Exponential backoff with full jitter.
+    return random.uniform(0, backoff_factor * (2 ** attempt))
@@ -0,0 +1,375 @@
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ShardedJob(object):
+    def __init__(self, path, manifest=None, method='embed_image_files', shard_size=10000,
+                 lease_seconds=300, max_attempts=3):
+        """A bulk embedding job that's split into shards, so that many worker processes, on one machine or several, can work on it at once.  Shards are handed out through a SQLite queue in `path`, with leases: a worker that crashes (or loses touch) stops renewing its lease, and its shard goes back on the queue once the lease expires.  Each shard's embeddings are written to their own file, and :meth:`merge` puts them together in input order at the end.  Needs numpy.
+
+        Workers on several machines need `path` and the manifest on a shared filesystem whose locking SQLite can rely on.
+
+        :param path: A directory for the queue and the embeddings of each shard.  It's created if it doesn't exist.
+        :type path: str
+        :param manifest: A text file with one instance per line: a path to an image file for ``'embed_image_files'``, or a sentence for ``'embed_sentences'``.  Only needed the first time; it's split into shards of `shard_size` consecutive lines, so the same manifest always gives the same shards.
+        :type manifest: str
+        :param method: Which method to embed the instances with: ``'embed_image_files'`` or ``'embed_sentences'``.
+        :type method: str
+        :param shard_size: How many instances to put in each shard.
+        :type shard_size: int
+        :param lease_seconds: How long a worker can hold a shard without renewing its lease.  Workers renew it every third of this while they work.
+        :type lease_seconds: float
+        :param max_attempts: How many times to try a shard before giving up on it.
+        :type max_attempts: int
+
+        >>> job = basilica.ShardedJob('/data/photos.job', manifest='/data/photos.txt')
+        >>> job.run('SLOW_DEMO_KEY', workers=8, concurrency=4)  # Or call job.work() on each machine.
+        {'shards': 120, 'pending': 0, 'leased': 0, 'done': 120, 'failed': 0, 'reclaimed': 1}
+        >>> embeddings = job.merge('/data/photos.npy')
+        """
+        if numpy is None:
+            raise ImportError('`ShardedJob` requires numpy (`pip install numpy`)')
+        if method not in _METHODS:
+            raise ValueError('`method` argument must be one of %s (got `%s`)' % (_METHODS, method))
+        if type(shard_size) != int or shard_size < 1:
+            raise ValueError('`shard_size` argument must be a positive int (got `%s`)' % shard_size)
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        if not os.path.isdir(os.path.join(path, 'shards')):
+            os.makedirs(os.path.join(path, 'shards'))
+        self.db = sqlite3.connect(os.path.join(path, 'queue.db'), timeout=60,
+                                  check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.__transaction():
+            self.db.execute('CREATE TABLE IF NOT EXISTS job (settings TEXT NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS shards '
+                            '(id INTEGER PRIMARY KEY, start INTEGER NOT NULL, stop INTEGER NOT NULL, '
+                            'first_row INTEGER NOT NULL, rows INTEGER NOT NULL, '
+                            'state TEXT NOT NULL, worker TEXT, expires REAL, '
+                            'attempts INTEGER NOT NULL, reclaimed INTEGER NOT NULL, error TEXT)')
+            row = self.db.execute('SELECT settings FROM job').fetchone()
+            settings = {'manifest': os.path.abspath(manifest) if manifest is not None else None,
+                        'method': method, 'shard_size': shard_size}
+            if row is None:
+                if manifest is None:
+                    raise ValueError('`%s` has no job in it yet, so `manifest` is needed' % path)
+                self.db.execute('INSERT INTO job VALUES (?)', (json.dumps(settings),))
+                self.db.executemany('INSERT INTO shards VALUES (?, ?, ?, ?, ?, \'pending\', NULL, NULL, 0, 0, NULL)',
+                                    _plan(manifest, shard_size))
+            else:
+                existing = json.loads(row[0])
+                if manifest is not None and existing != settings:
+                    raise ValueError('`%s` is already a job with settings %s; remove it to start over'
+                                     % (path, existing))
+                settings = existing
+        self.manifest = settings['manifest']
+        self.method = settings['method']
+        self.shard_size = settings['shard_size']
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
+
+    def lease(self, worker):
+        """Claim the next shard that's waiting, or whose lease has expired.
+
+        :param worker: A name for the worker claiming it, unique among the workers.
+        :type worker: str
+        :returns: The shard's number, first row and number of rows, or None if no shards are waiting.
+        :rtype: Tuple[int, int, int]
+        """
+        with self.__transaction():
+            return self.__lease(worker, time.time())
+
+    def renew(self, shard, worker):
+        """Extend `worker`'s lease on `shard`.
+
+        :returns: False if the lease has been lost to another worker, in which case the shard's results should be thrown away.
+        :rtype: bool
+        """
+        with self.__transaction():
+            cur = self.db.execute('UPDATE shards SET expires = ? WHERE id = ? AND worker = ? AND state = \'leased\'',
+                                  (time.time() + self.lease_seconds, shard, worker))
+            return cur.rowcount == 1
+
+    def complete(self, shard, worker, output):
+        """Mark `shard` as done, with its embeddings in the `.npy` file `output`, which is moved into place.
+
+        :returns: False if the lease has been lost to another worker, in which case `output` is deleted.
+        :rtype: bool
+        """
+        with self.__transaction():
+            cur = self.db.execute('UPDATE shards SET state = \'done\', worker = NULL '
+                                  'WHERE id = ? AND worker = ? AND state = \'leased\'', (shard, worker))
+            if cur.rowcount == 1:
+                os.replace(output, self.__shard_path(shard))
+                return True
+        os.remove(output)
+        return False
+
+    def release(self, shard, worker, error=None):
+        """Give up on `shard` after an error, so that it can be tried again (up to `max_attempts` times).
+
+        :param error: What went wrong, for :meth:`failures`.
+        :type error: str
+        """
+        with self.__transaction():
+            self.db.execute('UPDATE shards SET state = CASE WHEN attempts >= ? THEN \'failed\' ELSE \'pending\' END, '
+                            'worker = NULL, error = ? WHERE id = ? AND worker = ? AND state = \'leased\'',
+                            (self.max_attempts, error, shard, worker))
+
+    def work(self, key, server=None, connection_kwargs=None, worker=None, max_shards=None, **kwargs):
+        """Embed shards until there are none left to lease.  Call this from each worker process, on any machine that can see `path`.
+
+        :param key: The API key to embed with.
+        :type key: str
+        :param server: The server to send requests to, if not the default.
+        :type server: str
+        :param connection_kwargs: Other arguments for the :class:`basilica.Connection`.
+        :type connection_kwargs: Dict[str, Any]
+        :param worker: A name for this worker, unique among the workers.  Defaults to the host name, process id and a random suffix.
+        :type worker: str
+        :param max_shards: The most shards to embed before returning.
+        :type max_shards: int
+        :param kwargs: Other arguments (such as `model`, `opts`, `concurrency` or `on_error`) to pass to the embedding method.
+        :returns: How many shards this worker completed.
+        :rtype: int
+        """
+        from . import Connection
+        if worker is None:
+            worker = '%s-%d-%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        connection_kwargs = dict(connection_kwargs or {})
+        if server is not None:
+            connection_kwargs['server'] = server
+        completed = 0
+        with Connection(key, **connection_kwargs) as c:
+            while max_shards is None or completed < max_shards:
+                lease = self.lease(worker)
+                if lease is None:
+                    break
+                shard, _, rows = lease
+                output = '%s.%s.tmp.npy' % (self.__shard_path(shard)[:-len('.npy')], worker)
+                heartbeat = _Heartbeat(self, shard, worker)
+                error = None
+                try:
+                    c.embed_to_file(self.__instances(shard), output, method=self.method, count=rows, **kwargs)
+                except Exception as e:
+                    error = '%s: %s' % (type(e).__name__, e)
+                finally:
+                    heartbeat.stop()
+                    _remove(output + '.journal')
+                if error is not None:
+                    self.release(shard, worker, error)
+                    _remove(output)
+                elif not heartbeat.lost and self.complete(shard, worker, output):
+                    completed += 1
+                else:
+                    _remove(output)
+        return completed
+
+    def run(self, key, workers=4, server=None, connection_kwargs=None, **kwargs):
+        """Run `workers` worker processes on this machine until every shard is done (or has failed).  Takes the same arguments as :meth:`work`.
+
+        :param workers: How many worker processes to run.
+        :type workers: int
+        :returns: The job's :meth:`status` at the end.
+        :rtype: Dict[str, int]
+        """
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=_work, args=(self.path, key, server, connection_kwargs, kwargs))
+                     for _ in range(workers)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        status = self.status()
+        crashed = [p.exitcode for p in processes if p.exitcode != 0]
+        if crashed and (status['pending'] or status['leased']):
+            raise RuntimeError('%d worker processes exited with status %s before finishing'
+                               % (len(crashed), crashed))
+        return status
+
+    def status(self):
+        """How far along the job is.
+
+        :returns: The number of `shards`, how many are `pending`, `leased`, `done` and `failed`, and how many times a shard was `reclaimed` after its lease expired.
+        :rtype: Dict[str, int]
+        """
+        with self.lock:
+            counts = dict(self.db.execute('SELECT state, COUNT(*) FROM shards GROUP BY state').fetchall())
+            total, reclaimed = self.db.execute('SELECT COUNT(*), COALESCE(SUM(reclaimed), 0) FROM shards').fetchone()
+        out = {'shards': total}
+        for state in _STATES:
+            out[state] = counts.get(state, 0)
+        out['reclaimed'] = reclaimed
+        return out
+
+    def failures(self):
+        """The last error from each shard that's had one.
+
+        :returns: The error for each shard number.
+        :rtype: Dict[int, str]
+        """
+        with self.lock:
+            return dict(self.db.execute('SELECT id, error FROM shards WHERE error IS NOT NULL').fetchall())
+
+    def merge(self, path):
+        """Put the embeddings of every shard together, in the order of the manifest, in the `.npy` file `path`.  Shards that failed get rows of NaNs.
+
+        :param path: Where to write the embeddings.
+        :type path: str
+        :returns: The embeddings, memory-mapped read-only from `path`.
+        :rtype: numpy.ndarray
+        """
+        with self.lock:
+            shards = self.db.execute('SELECT id, first_row, rows, state FROM shards ORDER BY id').fetchall()
+        unfinished = [s[0] for s in shards if s[3] not in ('done', 'failed')]
+        if unfinished:
+            raise RuntimeError('%d shards are still to be embedded' % len(unfinished))
+        parts = {}
+        for shard, _, _, state in shards:
+            if state == 'done':
+                parts[shard] = numpy.load(self.__shard_path(shard), mmap_mode='r')
+        dimensions = max([p.shape[1] for p in parts.values()] or [0])
+        total = sum(s[2] for s in shards)
+        out = numpy.lib.format.open_memmap(path, mode='w+', dtype=numpy.float32, shape=(total, dimensions))
+        for shard, first_row, rows, _ in shards:
+            part = parts.get(shard)
+            if part is None or part.shape[1] != dimensions:
+                out[first_row:first_row+rows] = numpy.nan
+            else:
+                out[first_row:first_row+rows] = part
+        out.flush()
+        del out
+        return numpy.load(path, mmap_mode='r')
+
+    def __instances(self, shard):
+        with self.lock:
+            start, stop = self.db.execute('SELECT start, stop FROM shards WHERE id = ?', (shard,)).fetchone()
+        with open(self.manifest, 'rb') as f:
+            f.seek(start)
+            lines = f.read(stop - start).split(b'\n')
+        if lines and lines[-1] == b'':
+            lines.pop()
+        return [line.rstrip(b'\r').decode('utf-8') for line in lines]
+
+    def __shard_path(self, shard):
+        return os.path.join(self.path, 'shards', '%08d.npy' % shard)
+
+    def __lease(self, worker, now):
+        # Called in a transaction.
+        row = self.db.execute('SELECT id, first_row, rows, state, attempts FROM shards '
+                              'WHERE state = \'pending\' OR (state = \'leased\' AND expires < ?) '
+                              'ORDER BY id LIMIT 1', (now,)).fetchone()
+        if row is None:
+            return None
+        shard, first_row, rows, state, attempts = row
+        if state == 'leased' and attempts >= self.max_attempts:
+            # The last try ran out of time too.
+            self.db.execute('UPDATE shards SET state = \'failed\', worker = NULL, error = ? WHERE id = ?',
+                            ('lease expired', shard))
+            return self.__lease(worker, now)
+        self.db.execute('UPDATE shards SET state = \'leased\', worker = ?, expires = ?, '
+                        'attempts = attempts + 1, reclaimed = reclaimed + ? WHERE id = ?',
+                        (worker, now + self.lease_seconds, 1 if state == 'leased' else 0, shard))
+        return shard, first_row, rows
+
+    def __transaction(self):
+        return _Transaction(self.db, self.lock)
+
+
+class _Transaction(object):
+    # `BEGIN IMMEDIATE` takes SQLite's write lock up front, so that two
+    # workers can't both read a shard as free and then both lease it.
+    def __init__(self, db, lock):
+        self.db = db
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.db.execute('BEGIN IMMEDIATE')
+        except Exception:
+            self.lock.release()
+            raise
+
+    def __exit__(self, kind, value, traceback):
+        try:
+            self.db.execute('COMMIT' if kind is None else 'ROLLBACK')
+        finally:
+            self.lock.release()
+
+
+class _Heartbeat(object):
+    # Renews a lease every third of `lease_seconds`, until stopped or
+    # the lease is lost.
+    def __init__(self, job, shard, worker):
+        self.job = job
+        self.shard = shard
+        self.worker = worker
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __run(self):
+        while not self.stopped.wait(self.job.lease_seconds / 3.0):
+            if not self.job.renew(self.shard, self.worker):
+                self.lost = True
+                return
+
+
+_METHODS = ('embed_image_files', 'embed_sentences')
+_STATES = ('pending', 'leased', 'done', 'failed')
+
+def _plan(manifest, shard_size):
+    # Shards are runs of `shard_size` consecutive lines, recorded by byte
+    # offset so that workers can seek straight to theirs.
+    shards = []
+    start = offset = 0
+    lines = 0
+    with open(manifest, 'rb') as f:
+        for line in f:
+            offset += len(line)
+            lines += 1
+            if lines % shard_size == 0:
+                shards.append((len(shards), start, offset, lines - shard_size, shard_size))
+                start = offset
+    if lines % shard_size:
+        shards.append((len(shards), start, offset, lines - lines % shard_size, lines % shard_size))
+    return shards
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _work(path, key, server, connection_kwargs, kwargs):
+    # The target of `ShardedJob.run`'s processes.
+    with ShardedJob(path) as job:
+        job.work(key, server=server, connection_kwargs=connection_kwargs, **kwargs)
@@ -0,0 +1,121 @@
+"""An HTTP/2 transport for :class:`basilica.Connection`.  It needs `httpx`
+with HTTP/2 support, which you can get with `pip install basilica[http2]`.
+"""
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers, select_proxy
+import os
+import requests
+import six
+import ssl
+import threading
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class HTTP2Adapter(BaseAdapter):
+    # A requests transport adapter that sends requests through httpx, so
+    # that everything above it (auth, retries, error handling) works the
+    # same as over HTTP/1.1.  Requests to one server share a single TLS
+    # connection, with many of them in flight at once.
+    #
+    # httpx takes TLS and proxy settings per client rather than per
+    # request, so there's a client for each combination of `verify`,
+    # `cert` and proxy that requests passes in (usually just the one).
+    def __init__(self, pool_size=10, pool_block=False, keepalive_timeout=30, connect_retries=0):
+        if httpx is None:
+            raise ImportError('`transport=\'http2\'` requires httpx (`pip install basilica[http2]`)')
+        BaseAdapter.__init__(self)
+        self.connect_retries = connect_retries
+        # httpx always waits for a free connection once `max_connections`
+        # are open, so without `pool_block` there's no limit, and only
+        # `pool_size` of them are kept alive.
+        self.limits = httpx.Limits(max_connections=pool_size if pool_block else None,
+                                   max_keepalive_connections=pool_size,
+                                   keepalive_expiry=keepalive_timeout)
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+        else:
+            connect = read = timeout
+        client = self.__client(verify, cert, select_proxy(request.url, proxies or {}))
+        for i in range(self.connect_retries + 1):
+            try:
+                res = client.request(
+                    request.method, request.url, content=request.body,
+                    headers=dict(request.headers),
+                    timeout=httpx.Timeout(read, connect=connect),
+                )
+                break
+            except httpx.ConnectTimeout as err:
+                if i < self.connect_retries:
+                    continue
+                raise requests.exceptions.ConnectTimeout(err, request=request)
+            except httpx.ConnectError as err:
+                if i < self.connect_retries:
+                    continue
+                raise requests.exceptions.ConnectionError(err, request=request)
+            except httpx.TimeoutException as err:
+                raise requests.exceptions.ReadTimeout(err, request=request)
+            except httpx.TransportError as err:
+                raise requests.exceptions.ConnectionError(err, request=request)
+        response = requests.Response()
+        response.status_code = res.status_code
+        response.headers = CaseInsensitiveDict(res.headers.multi_items())
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.reason = res.reason_phrase
+        response.url = request.url
+        response.request = request
+        response.raw = None
+        response._content = res.content
+        response._content_consumed = True
+        response.http_version = res.http_version
+        return response
+
+    def close(self):
+        with self.lock:
+            clients, self.clients = self.clients, {}
+        for client in clients.values():
+            client.close()
+
+    def __client(self, verify, cert, proxy):
+        key = (verify, cert, proxy)
+        with self.lock:
+            client = self.clients.get(key)
+            if client is None:
+                # requests has already applied the environment's proxy and
+                # CA bundle settings, so httpx shouldn't apply them again.
+                client = self.clients[key] = httpx.Client(
+                    http2=True, limits=self.limits, trust_env=False,
+                    verify=_ssl_context(verify, cert), proxy=proxy,
+                )
+            return client
+
+
+def _ssl_context(verify, cert):
+    # As in requests, `verify` is a bool or the path to a CA bundle file
+    # or directory, and `cert` is the path to a client certificate, or a
+    # (certificate, key) pair of paths.
+    if cert is None and isinstance(verify, bool):
+        return verify
+    if verify is False:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif verify is True:
+        context = ssl.create_default_context(cafile=requests.certs.where())
+    elif os.path.isdir(verify):
+        context = ssl.create_default_context(capath=verify)
+    else:
+        context = ssl.create_default_context(cafile=verify)
+    if isinstance(cert, six.string_types):
+        context.load_cert_chain(cert)
+    elif cert is not None:
+        context.load_cert_chain(*cert)
+    return context
@@ -9,9 +9,20 @@ setup(name='basilica',
       author_email='mlucy@basilica.ai',
       license='MIT',
       packages=['basilica'],
+      python_requires='>=3.7',
       install_requires=[
           'requests',
           'six',
           'Pillow',
       ],
+      extras_require={
+          'async': ['aiohttp'],
+          'http2': ['httpx[http2]>=0.26'],
+          'numpy': ['numpy'],
+          'parquet': ['pyarrow'],
+          'zstd': ['zstandard'],
+      },
+      entry_points={
+          'console_scripts': ['basilica = basilica.cli:main'],
+      },
       zip_safe=True)
@@ -0,0 +1,304 @@
+"""Offline benchmarks for the client, run against the stub server in
+`stub.py`, so that results don't depend on the network or the real API.
+
+    python benchmark.py --output results.json
+    python benchmark.py --quick --jitter 0.01 --error-rate 0.02 --baseline results.json
+
+Each case runs in a fresh process, so that its CPU time and peak memory
+aren't mixed up with the server's or with other cases'.  The `preprocess`
+cases don't touch the server: they time how much CPU it takes to get
+photos ready to upload, against decoding them at full size.  The
+`quantization` cases measure how often the nearest neighbours found with
+quantized embeddings match those found with float32 ones.  With
+`--baseline`, exits with status 1 if any case's throughput dropped by
+more than `--tolerance` compared to an earlier run.
+"""
+from PIL import Image
+import argparse
+import basilica
+import concurrent.futures
+import io
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import stub
+import sys
+import time
+
+WORDS = ('the quick brown fox jumps over a lazy dog while seven wizards '
+         'quietly hex every jovial vexing sphinx of black quartz').split()
+
+
+def sentence_cases(quick):
+    items = 500 if quick else 2000
+    for words in ([8, 64] if quick else [8, 64, 256]):
+        for batch_size in ([16, 64] if quick else [16, 64, 256]):
+            yield {'kind': 'sentences', 'items': items, 'words': words, 'batch_size': batch_size}
+
+
+def image_cases(quick):
+    items = 64 if quick else 256
+    for resolution in ([256, 1024] if quick else [128, 512, 1024, 2048]):
+        for batch_size in ([8, 32] if quick else [8, 32, 64]):
+            yield {'kind': 'images', 'items': items, 'resolution': resolution, 'batch_size': batch_size}
+
+
+def preprocess_cases(quick):
+    # A thumbnail that can be sent as is, a web-sized image, and photos
+    # from a phone and a DSLR.
+    sizes = [(512, 384), (1024, 768), (4032, 3024)]
+    if not quick:
+        sizes.append((6000, 4000))
+    for width, height in sizes:
+        yield {'kind': 'preprocess', 'items': 20 if quick else 50, 'resolution': '%dx%d' % (width, height)}
+
+
+def quantization_cases(quick):
+    for output, scale in [('float16', 'vector'), ('int8', 'vector'), ('int8', 'dimension')]:
+        yield {'kind': 'quantization', 'items': 5000 if quick else 20000, 'output': output, 'scale': scale}
+
+
+def sentences(n, words, seed=0):
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(words)) for _ in range(n)]
+
+
+def images(n, resolution, distinct=8, seed=0):
+    rng = random.Random(seed)
+    out = [photo(resolution, resolution, rng) for _ in range(distinct)]
+    return [out[i % distinct] for i in range(n)]
+
+
+def photo(width, height, rng):
+    # Smoothed noise, so the JPEG is about as big as a photo would be.
+    data = bytes(bytearray(rng.getrandbits(8) for _ in range(3 * 64 * 64)))
+    im = Image.frombytes('RGB', (64, 64), data).resize((width, height), Image.BILINEAR)
+    f = io.BytesIO()
+    im.save(f, 'JPEG', quality=90)
+    return f.getvalue()
+
+
+def full_decode(image):
+    # How images were prepared before the fast paths: decoded at full size
+    # and always re-encoded.
+    im = Image.open(io.BytesIO(image))
+    im.thumbnail((512, 512))
+    im = im.convert('RGB')
+    f = io.BytesIO()
+    im.save(f, 'JPEG')
+    return f.getvalue()
+
+
+def run_preprocess_case(case):
+    from basilica import _transform_image
+    width, height = [int(x) for x in case['resolution'].split('x')]
+    rng = random.Random(0)
+    data = [photo(width, height, rng) for _ in range(4)]
+    def cpu(f):
+        start = time.process_time()
+        for i in range(case['items']):
+            f(data[i % len(data)])
+        return (time.process_time() - start) / case['items']
+    full = cpu(full_decode)
+    fast = cpu(lambda image: _transform_image(image, True))
+    result = dict(case)
+    result.update({
+        'bytes_per_image': sum(len(d) for d in data) // len(data),
+        'cpu_ms_per_image': fast * 1000.0,
+        'cpu_ms_per_image_full_decode': full * 1000.0,
+        'cpu_ms_saved_per_image': (full - fast) * 1000.0,
+        'items_per_second': 1.0 / fast if fast > 0 else float('inf'),
+        'failed': 0,
+    })
+    return result
+
+
+def clustered_embeddings(n, dimensions=512, clusters=100, seed=0):
+    # Real embeddings bunch up by topic, so nearest neighbours are
+    # mostly in the same cluster, and close together.
+    import numpy
+    rng = numpy.random.RandomState(seed)
+    centers = rng.randn(clusters, dimensions)
+    data = centers[rng.randint(clusters, size=n)] + 0.5 * rng.randn(n, dimensions)
+    return data.astype(numpy.float32), rng
+
+
+def run_quantization_case(case, k=10, queries=200):
+    import numpy
+    data, rng = clustered_embeddings(case['items'])
+    query = data[rng.choice(len(data), queries, replace=False)] + 0.1 * rng.randn(queries, data.shape[1])
+    quantizer = basilica.Quantizer(case['output'], scale=case['scale'])
+    start = time.process_time()
+    quantized = quantizer.quantize(data)
+    elapsed = time.process_time() - start
+    exact = numpy.argsort(-basilica.cosine_similarity(query, data), axis=1)[:, :k]
+    approximate = numpy.argsort(-basilica.cosine_similarity(query, quantized), axis=1)[:, :k]
+    recall = numpy.mean([len(set(a) & set(b)) / float(k) for a, b in zip(exact, approximate)])
+    result = dict(case)
+    result.update({
+        'recall_at_10': recall,
+        'bytes_per_embedding': quantized.nbytes / float(len(quantized)),
+        'float32_bytes_per_embedding': data.shape[1] * 4.0,
+        'max_error': float(numpy.abs(quantized.dequantize() - data).max()),
+        'items_per_second': len(data) / elapsed if elapsed > 0 else float('inf'),
+        'failed': 0,
+    })
+    return result
+
+
+def run_case(url, case, concurrency, timeout, retries):
+    if case['kind'] == 'preprocess':
+        return run_preprocess_case(case)
+    if case['kind'] == 'quantization':
+        return run_quantization_case(case)
+    if case['kind'] == 'sentences':
+        data = sentences(case['items'], case['words'])
+    else:
+        data = images(case['items'], case['resolution'])
+    metrics = basilica.Metrics(trace=False)
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    failed = 0
+    with basilica.Connection('BENCHMARK_KEY', server=url, retries=retries, metrics=metrics) as c:
+        if case['kind'] == 'sentences':
+            embeddings = c.embed_sentences(data, batch_size=case['batch_size'], timeout=timeout,
+                                           concurrency=concurrency)
+        else:
+            embeddings = c.embed_images(data, batch_size=case['batch_size'], timeout=timeout,
+                                        concurrency=concurrency)
+        try:
+            count = sum(1 for _ in embeddings)
+        except Exception:
+            count = metrics.snapshot()['counters'].get('items', 0)
+            failed = 1
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    snapshot = metrics.snapshot()
+    batch = snapshot['histograms'].get('batch', {})
+    result = dict(case)
+    result.update({
+        'embedded': count,
+        'failed': failed,
+        'seconds': elapsed,
+        'items_per_second': count / elapsed,
+        'latency_p50_ms': batch.get('p50', 0) * 1000.0,
+        'latency_p99_ms': batch.get('p99', 0) * 1000.0,
+        'latency_max_ms': batch.get('max', 0) * 1000.0,
+        'cpu_seconds': (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+        # Kilobytes on Linux, bytes on macOS.
+        'peak_rss_mb': after.ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0),
+        'retries': snapshot['counters'].get('retries', 0),
+        'timeouts': snapshot['counters'].get('timeouts', 0),
+    })
+    return result
+
+
+def describe(result):
+    params = ' '.join('%s=%s' % (k, result[k]) for k in ('words', 'resolution', 'batch_size', 'output', 'scale')
+                      if k in result)
+    if result['kind'] == 'quantization':
+        return '%-10s %-28s recall@10 %6.4f  %6.1f bytes/embedding (float32 %6.1f)' % (
+            result['kind'], params, result['recall_at_10'], result['bytes_per_embedding'],
+            result['float32_bytes_per_embedding'])
+    if result['kind'] == 'preprocess':
+        return '%-10s %-28s %7.1f ms/image  (full decode %7.1f ms, saves %7.1f ms)' % (
+            result['kind'], params, result['cpu_ms_per_image'], result['cpu_ms_per_image_full_decode'],
+            result['cpu_ms_saved_per_image'])
+    return '%-10s %-28s %9.1f items/s  p50 %7.1f ms  p99 %7.1f ms  cpu %6.2f s  rss %6.1f MB%s' % (
+        result['kind'], params, result['items_per_second'], result['latency_p50_ms'],
+        result['latency_p99_ms'], result['cpu_seconds'], result['peak_rss_mb'],
+        '  FAILED' if result['failed'] else '')
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    previous = {case_key(r): r for r in baseline['results']}
+    for r in results:
+        old = previous.get(case_key(r))
+        if old is not None and r['items_per_second'] < old['items_per_second'] * (1 - tolerance):
+            regressions.append((r, old))
+    return regressions
+
+
+def case_key(result):
+    return tuple(sorted((k, result[k]) for k in ('kind', 'items', 'words', 'resolution', 'batch_size',
+                                                 'output', 'scale')
+                        if k in result))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', help='Where to write the results as JSON.')
+    parser.add_argument('--baseline', help='Earlier results to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='How much slower a case can get before it counts as a regression.')
+    parser.add_argument('--quick', action='store_true', help='Run fewer, smaller cases.')
+    parser.add_argument('--only', choices=['sentences', 'images', 'preprocess', 'quantization'],
+                        help='Only run one kind of case.')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=5.0)
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Server latency per request, in seconds.')
+    parser.add_argument('--latency-per-item', type=float, default=0.0002,
+                        help='Server latency per instance, in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Up to this much extra random latency per request, in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests that get a 500.')
+    parser.add_argument('--timeout-rate', type=float, default=0.0,
+                        help='Fraction of requests that stall past the timeout.')
+    args = parser.parse_args(argv)
+
+    cases = []
+    if args.only in (None, 'sentences'):
+        cases += list(sentence_cases(args.quick))
+    if args.only in (None, 'images'):
+        cases += list(image_cases(args.quick))
+    if args.only in (None, 'preprocess'):
+        cases += list(preprocess_cases(args.quick))
+    if args.only in (None, 'quantization'):
+        cases += list(quantization_cases(args.quick))
+
+    server = stub.StubServer(latency=args.latency, latency_per_item=args.latency_per_item,
+                             jitter=args.jitter, error_rate=args.error_rate,
+                             timeout_rate=args.timeout_rate, hang=args.timeout * 2)
+    results = []
+    context = multiprocessing.get_context('spawn')
+    with server:
+        for case in cases:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run_case, server.url, case, args.concurrency,
+                                         args.timeout, args.retries).result()
+            results.append(result)
+            print(describe(result))
+
+    out = {
+        'environment': {
+            'basilica': basilica.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'settings': vars(args),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=2, sort_keys=True)
+
+    status = 1 if any(r['failed'] for r in results) else 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for r, old in compare(results, baseline, args.tolerance):
+            print('REGRESSION %s: %.1f items/s, was %.1f' % (
+                dict(case_key(r)), r['items_per_second'], old['items_per_second']))
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""A local stand-in for the basilica.ai embedding API, for offline tests
+and benchmarks.  It answers any `/embed/...` path with deterministic fake
+embeddings, and can be made slow or unreliable on purpose.
+"""
+from PIL import Image
+from six.moves import BaseHTTPServer, socketserver
+import base64
+import email
+import gzip
+import hashlib
+import io
+import json
+import numpy
+import random
+import socket
+import struct
+import threading
+import time
+import zstandard
+
+BINARY_TYPE = 'application/x-basilica-embeddings'
+
+
+def fake_embedding(item, dimensions):
+    if isinstance(item, dict):
+        item = item['img']
+    seed = hashlib.sha256(item.encode('utf-8')).hexdigest()
+    rng = random.Random(seed)
+    return [rng.uniform(-1, 1) for _ in range(dimensions)]
+
+
+def fake_image(size, seed=0):
+    rng = random.Random(seed)
+    im = Image.new('RGB', size, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    out = io.BytesIO()
+    im.save(out, 'JPEG')
+    return out.getvalue()
+
+
+class StubServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, latency=0.0, latency_per_item=0.0, dimensions=512, binary=True,
+                 request_formats=True, throttle=0, retry_after=None,
+                 jitter=0.0, error_rate=0.0, timeout_rate=0.0, hang=10.0, seed=0,
+                 reject=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.latency_per_item = latency_per_item
+        self.dimensions = dimensions
+        self.binary = binary
+        self.request_formats = request_formats
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.throttled = 0
+        # Faults: `jitter` adds up to that much random latency,
+        # `error_rate` of requests get a 500, and `timeout_rate` of them
+        # stall for `hang` seconds before answering (if the client is still
+        # listening).
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.rng = random.Random(seed)
+        self.errors = 0
+        self.timeouts = 0
+        # Requests with a sentence containing `reject` get a 400.
+        self.reject = reject
+        self.rejected = 0
+        self.content_types = []
+        self.request_types = []
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.items = 0
+        self.batch_sizes = []
+        self.batch_bytes = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.connections = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *a):
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *a):
+        pass
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_HEAD(self):
+        self.send_payload(200, 'text/plain', b'')
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if not self.path.startswith(('/embed/text/', '/embed/images/')):
+            self.send_json(404, {'error': 'Not found.'})
+            return
+        query = self.parse_query(body)
+        if query is None:
+            self.send_json(415, {'error': 'Unsupported request format.'})
+            return
+        with server.lock:
+            throttled = server.throttled < server.throttle
+            if throttled:
+                server.throttled += 1
+            fault = server.rng.random()
+            jitter = server.rng.uniform(0, server.jitter)
+        if throttled:
+            headers = {} if server.retry_after is None else {'Retry-After': server.retry_after}
+            self.send_json(429, {'error': 'Too many requests.'}, headers)
+            return
+        if server.reject is not None and any(server.reject in i for i in query['data']
+                                             if not isinstance(i, dict)):
+            with server.lock:
+                server.rejected += 1
+            self.send_json(400, {'error': 'Bad instance.'})
+            return
+        if fault < server.error_rate:
+            with server.lock:
+                server.errors += 1
+            self.send_json(500, {'error': 'Injected error.'})
+            return
+        if fault < server.error_rate + server.timeout_rate:
+            with server.lock:
+                server.timeouts += 1
+            time.sleep(server.hang)
+        with server.lock:
+            server.requests += 1
+            server.items += len(query['data'])
+            server.batch_sizes.append(len(query['data']))
+            server.batch_bytes.append(len(body))
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.latency + server.latency_per_item * len(query['data']) + jitter)
+            dimensions = query.get('dimensions', server.dimensions)
+            embeddings = [fake_embedding(i, dimensions) for i in query['data']]
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+        accept = self.headers.get('Accept', '')
+        if server.binary and accept.startswith(BINARY_TYPE):
+            dtype = 'float16' if 'dtype=float16' in accept.split(',')[0] else 'float32'
+            self.send_binary(embeddings, dimensions, dtype)
+        else:
+            self.send_json(200, {'embeddings': embeddings})
+
+    def parse_query(self, body):
+        content_type = self.headers.get('Content-Type', 'application/json')
+        encoding = self.headers.get('Content-Encoding')
+        with self.server.lock:
+            self.server.request_types.append((content_type.split(';')[0], encoding))
+        if content_type.startswith('multipart/') or encoding is not None:
+            if not self.server.request_formats:
+                return None
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif encoding == 'zstd':
+            body = zstandard.ZstdDecompressor().decompress(body)
+        if not content_type.startswith('multipart/'):
+            return json.loads(body.decode('utf-8'))
+        msg = email.message_from_bytes(('Content-Type: %s\r\n\r\n' % content_type).encode('utf-8') + body)
+        query = {'data': []}
+        for part in msg.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            value = part.get_payload(decode=True)
+            if name == 'opts':
+                query.update(json.loads(value.decode('utf-8')))
+            elif name == 'data':
+                query['data'].append(json.loads(value.decode('utf-8')))
+            else:
+                query['data'].append({name: base64.b64encode(value).decode('utf-8')})
+        return query
+
+    def send_binary(self, embeddings, dimensions, dtype):
+        values = numpy.array(embeddings, dtype='<f2' if dtype == 'float16' else '<f4')
+        payload = struct.pack('<II', len(embeddings), dimensions) + values.tobytes()
+        self.send_payload(200, '%s; dtype=%s' % (BINARY_TYPE, dtype), payload)
+
+    def send_json(self, code, out, headers={}):
+        self.send_payload(code, 'application/json', json.dumps(out).encode('utf-8'), headers)
+
+    def send_payload(self, code, content_type, payload, headers={}):
+        with self.server.lock:
+            self.server.content_types.append(content_type)
+        try:
+            self.send_response(code)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except socket.error:
+            # The client gave up on us.
+            self.close_connection = True
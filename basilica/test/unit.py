@@ -1,12 +1,23 @@
+from PIL import Image
 from scipy import spatial
 from six.moves.queue import Queue
 import basilica
+import collections
+import io
+import json
+import numpy
 import os
+import pathlib
 import requests
 import six
+import stub
+import tarfile
+import tempfile
+import threading
 import time
 import unittest
 import unittest
+import zipfile
 
 test_key = os.environ.get('BASILICA_TEST_KEY', 'SLOW_DEMO_KEY')
 fake_key = 'FAKE_KEY'
@@ -79,5 +90,748 @@ class TestDriver(unittest.TestCase):
         for e in emb_inner:
             self.assertTrue(sufficiently_equal(sentences_truth[1], e))
 
+class TestStub(unittest.TestCase):
+    def test_concurrency_order(self):
+        with stub.StubServer(latency=0.01) as server:
+            with basilica.Connection(fake_key, server=server.url) as c:
+                embeddings = list(c.embed_sentences(sentences_large, batch_size=16, concurrency=8))
+        self.assertEqual(768, len(embeddings))
+        for s, e in zip(sentences_large, embeddings):
+            self.assertEqual(stub.fake_embedding(s, 512), e)
+        self.assertTrue(server.max_in_flight > 1)
+
+    def test_concurrency_throughput(self):
+        def timed(concurrency):
+            with stub.StubServer(latency=0.1) as server:
+                with basilica.Connection(fake_key, server=server.url) as c:
+                    begin = time.time()
+                    list(c.embed_sentences(sentences_small * 8, batch_size=3, concurrency=concurrency))
+                    return time.time() - begin
+        self.assertTrue(timed(8) * 3 < timed(1))
+
+    def test_preprocess_workers(self):
+        images = [stub.fake_image(size) for size in [(64, 64), (1024, 768), (300, 900)] * 5]
+        with stub.StubServer() as server:
+            with basilica.Connection(fake_key, server=server.url) as c:
+                serial = list(c.embed_images(images, batch_size=4))
+                parallel = list(c.embed_images(images, batch_size=4, preprocess_workers=3))
+        self.assertEqual(15, len(parallel))
+        self.assertEqual(serial, parallel)
+
+    def test_numpy_output(self):
+        def gen(s):
+            for i in s:
+                yield i
+        with stub.StubServer() as server:
+            with basilica.Connection(fake_key, server=server.url) as c:
+                single = c.embed_sentence(sentences_small[0], output='numpy')
+                embeddings = c.embed_sentences(sentences_large, batch_size=50, output='numpy')
+                streamed = c.embed_sentences(gen(sentences_large), batch_size=50, output='numpy')
+                reduced = c.embed_sentences(sentences_small, opts={'dimensions': 16}, output='numpy')
+        self.assertEqual((512,), single.shape)
+        self.assertEqual(numpy.float32, single.dtype)
+        self.assertEqual((768, 512), embeddings.shape)
+        self.assertEqual(numpy.float32, embeddings.dtype)
+        self.assertTrue(numpy.array_equal(embeddings, streamed))
+        self.assertEqual((3, 16), reduced.shape)
+        for s, e in zip(sentences_large, embeddings):
+            self.assertTrue(numpy.allclose(stub.fake_embedding(s, 512), e))
+
+    def test_cache(self):
+        def gen(s):
+            for i in s:
+                yield i
+        images = [stub.fake_image((64, 64), seed=i) for i in range(6)]
+        path = os.path.join(tempfile.mkdtemp(), 'cache.db')
+        with stub.StubServer() as server:
+            with basilica.EmbeddingCache(path, max_entries=5) as cache:
+                with basilica.Connection(fake_key, server=server.url, cache=cache) as c:
+                    first = list(c.embed_sentences(sentences_small, batch_size=2))
+                    self.assertEqual(2, server.requests)
+                    second = list(c.embed_sentences(gen(sentences_small + ['Something new.']), batch_size=2))
+                    self.assertEqual(3, server.requests)
+                    self.assertEqual(4, server.items)
+                    other = list(c.embed_sentences(sentences_small, opts={'dimensions': 16}))
+                    self.assertEqual(4, server.requests)
+                    list(c.embed_images(images[:2]))
+                    list(c.embed_images(images[:3]))
+                    self.assertEqual(10, server.items)
+                stats = cache.stats()
+        self.assertEqual(first, second[:3])
+        self.assertEqual(stub.fake_embedding('Something new.', 512), second[3])
+        self.assertEqual(16, len(other[0]))
+        self.assertEqual(5, stats['hits'])
+        self.assertEqual(10, stats['misses'])
+        self.assertEqual(5, stats['entries'])
+        self.assertEqual(5, stats['evictions'])
+        with basilica.EmbeddingCache(path) as cache:
+            self.assertEqual(5, cache.entries)
+        # Hits don't hold the database's write lock.
+        path = os.path.join(tempfile.mkdtemp(), 'cache.db')
+        with basilica.EmbeddingCache(path, max_entries=2) as reader:
+            reader.put_many([(b'a', [1.0]), (b'b', [2.0])])
+            self.assertEqual([1.0], reader.get(b'a'))
+            with basilica.EmbeddingCache(path) as writer:
+                writer.db.execute('PRAGMA busy_timeout = 100')
+                writer.put_many([(b'c', [3.0])])
+            # `a` was used more recently than `b`, so `b` is evicted.
+            reader.put_many([(b'd', [4.0])])
+            self.assertEqual(None, reader.get(b'b'))
+            self.assertEqual([1.0], reader.get(b'a'))
+
+    def test_dedup(self):
+        def gen(s):
+            for i in s:
+                yield i
+        images = [stub.fake_image((64, 64), seed=i) for i in range(3)] * 4
+        with stub.StubServer() as server:
+            with basilica.Connection(fake_key, server=server.url) as c:
+                embeddings = list(c.embed_sentences(gen(sentences_large), batch_size=2, dedup=100))
+                self.assertEqual(3, server.items)
+                image_embeddings = list(c.embed_images(images, batch_size=2, dedup=100))
+                self.assertEqual(6, server.items)
+                list(c.embed_sentences(sentences_large[:60], batch_size=2, concurrency=4, dedup=1))
+                self.assertEqual(6 + 60, server.items)
+        self.assertEqual(768, len(embeddings))
+        for s, e in zip(sentences_large, embeddings):
+            self.assertEqual(stub.fake_embedding(s, 512), e)
+        self.assertEqual(image_embeddings[:3] * 4, image_embeddings)
+
+    def test_auto_batch_size(self):
+        sizer = basilica.AdaptiveBatchSize(start=64)
+        with stub.StubServer(latency_per_item=0.01) as server:
+            with basilica.Connection(fake_key, server=server.url) as c:
+                embeddings = list(c.embed_sentences(sentences_large[:100], batch_size=sizer, timeout=0.25))
+        self.assertEqual(100, len(embeddings))
+        for s, e in zip(sentences_large, embeddings):
+            self.assertEqual(stub.fake_embedding(s, 512), e)
+        self.assertEqual(64, server.batch_sizes[0])
+        self.assertEqual(32, server.batch_sizes[1])
+        self.assertTrue(sizer.size < 32)
+        # The halves of a batch that timed out come back as arrays here.
+        sizer = basilica.AdaptiveBatchSize(start=8)
+        with stub.StubServer(latency_per_item=0.1) as server:
+            with basilica.Connection(fake_key, server=server.url, wire_format='float32') as c:
+                embeddings = list(c.embed_sentences(sentences_large[:8], batch_size=sizer, timeout=0.5))
+        self.assertEqual([8, 4, 4], server.batch_sizes)
+        self.assertTrue(numpy.allclose([stub.fake_embedding(s, 512) for s in sentences_large[:8]],
+                                       embeddings))
+
+    def test_auto_batch_bytes(self):
+        images = [stub.fake_image((512, 512), seed=i) for i in range(20)]
+        sizer = basilica.AdaptiveBatchSize(max_bytes=20000)
+        with stub.StubServer() as server:
+            with basilica.Connection(fake_key, server=server.url) as c:
+                embeddings = list(c.embed_images(images, batch_size=sizer, preprocess_workers=2))
+                self.assertEqual(20, len(embeddings))
+                self.assertTrue(max(server.batch_bytes) < 20000 + 100)
+                self.assertEqual(list(c.embed_images(images)), embeddings)
+
+    def test_wire_format(self):
+        expected = numpy.array([stub.fake_embedding(s, 512) for s in sentences_large])
+        for binary in [True, False]:
+            with stub.StubServer(binary=binary) as server:
+                for wire_format in ['float32', 'float16']:
+                    with basilica.Connection(fake_key, server=server.url, wire_format=wire_format) as c:
+                        embeddings = c.embed_sentences(sentences_large, output='numpy')
+                        listed = list(c.embed_sentences(sentences_small))
+                        single = c.embed_sentence(sentences_small[0], output='numpy')
+                    self.assertEqual((768, 512), embeddings.shape)
+                    self.assertEqual(numpy.float32, embeddings.dtype)
+                    self.assertTrue(numpy.allclose(expected, embeddings, atol=1e-3))
+                    self.assertTrue(numpy.allclose(expected[:3], listed, atol=1e-3))
+                    self.assertEqual(list, type(listed[0]))
+                    self.assertEqual((512,), single.shape)
+            binary_types = [t for t in server.content_types if t.startswith(stub.BINARY_TYPE)]
+            self.assertEqual(binary, len(binary_types) == len(server.content_types))
+            self.assertEqual(not binary, len(binary_types) == 0)
+
+    def test_request_format(self):
+        images = [stub.fake_image((600, 400), seed=i) for i in range(5)]
+        with stub.StubServer() as server:
+            with basilica.Connection(fake_key, server=server.url) as c:
+                expected_images = list(c.embed_images(images, batch_size=2))
+                expected_sentences = list(c.embed_sentences(sentences_small))
+            json_bytes = sum(server.batch_bytes[:3])
+        for request_formats in [True, False]:
+            for request_format, compression in [('multipart', None), ('json', 'gzip'), ('json', 'zstd')]:
+                with stub.StubServer(request_formats=request_formats) as server:
+                    with basilica.Connection(fake_key, server=server.url, request_format=request_format,
+                                             compression=compression) as c:
+                        self.assertEqual(expected_images, list(c.embed_images(images, batch_size=2)))
+                        self.assertEqual(expected_sentences, list(c.embed_sentences(sentences_small)))
+                        self.assertEqual(request_formats, (request_format, compression) ==
+                                         (c.request_format, c.compression))
+                if request_formats and request_format == 'multipart':
+                    self.assertTrue(sum(server.batch_bytes[:3]) < 0.8 * json_bytes)
+                if not request_formats:
+                    self.assertEqual(('application/json', None), server.request_types[-1])
+
+    def test_streaming_body(self):
+        images = [stub.fake_image((1200, 900), seed=i) for i in range(4)]
+        query = {'model': 'm', 'data': [{'img': os.urandom(n)} for n in [0, 1, 2, 100001]] + ['text']}
+        body = basilica._json_stream(query)
+        chunks = list(body)
+        self.assertEqual(basilica._json_body(query), b''.join(chunks))
+        self.assertEqual(len(body), sum(len(chunk) for chunk in chunks))
+        self.assertTrue(max(len(chunk) for chunk in chunks) <= 65536)
+        with stub.StubServer() as server:
+            with basilica.Connection(fake_key, server=server.url) as c:
+                expected = list(c.embed_images(images, batch_size=2))
+            server.error_rate = 0.5
+            for transport in ['http1', 'http2']:
+                with basilica.Connection(fake_key, server=server.url, transport=transport,
+                                         retries=20, backoff_factor=0.001) as c:
+                    self.assertEqual(expected, list(c.embed_images(images, batch_size=2)))
+
+    def test_embed_to_file(self):
+        class Crash(Exception):
+            pass
+        def crash_after(s, n):
+            for i, x in enumerate(s):
+                if i == n:
+                    raise Crash()
+                yield x
+        sentences = ['Sentence %d.' % i for i in range(500)]
+        path = os.path.join(tempfile.mkdtemp(), 'embeddings.npy')
+        with stub.StubServer() as server:
+            with basilica.Connection(fake_key, server=server.url) as c:
+                with self.assertRaises(Crash):
+                    c.embed_to_file(crash_after(sentences, 230), path, count=500,
+                                    batch_size=20, checkpoint_rows=50)
+                self.assertEqual(200, json.load(open(path + '.journal'))['done'])
+                sent = server.items
+                embeddings = c.embed_to_file(sentences, path, batch_size=20, checkpoint_rows=50)
+                self.assertEqual(sent + 300, server.items)
+                again = c.embed_to_file(sentences, path)
+                self.assertEqual(sent + 300, server.items)
+                with self.assertRaises(ValueError):
+                    c.embed_to_file(sentences[:10], path)
+                with self.assertRaises(ValueError):
+                    c.embed_to_file(sentences[:230], path + '2', count=500, checkpoint_rows=50)
+                with self.assertRaises(ValueError):
+                    c.embed_to_file(sentences, path + '2', opts={'dimensions': 16})
+                with self.assertRaises(ValueError):
+                    c.embed_to_file(sentences, path + '3', count=100)
+        self.assertEqual((500, 512), embeddings.shape)
+        self.assertTrue(numpy.array_equal(embeddings, again))
+        for s, e in zip(sentences, embeddings):
+            self.assertTrue(numpy.allclose(stub.fake_embedding(s, 512), e))
+
+    def test_image_file_sources(self):
+        images = [stub.fake_image((64, 64), seed=i) for i in range(8)]
+        root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(root, 'dir', 'sub'))
+        paths = [os.path.join(root, 'dir', 'a.jpg'), os.path.join(root, 'dir', 'sub', 'b.jpg'),
+                 os.path.join(root, 'c.jpg')]
+        for path, image in zip(paths, images):
+            with open(path, 'wb') as f:
+                f.write(image)
+        with open(os.path.join(root, 'dir', 'notes.txt'), 'w') as f:
+            f.write('not an image')
+        with tarfile.open(os.path.join(root, 'images.tar.gz'), 'w:gz') as tar:
+            for i in [3, 4]:
+                info = tarfile.TarInfo('%d.jpg' % i)
+                info.size = len(images[i])
+                tar.addfile(info, io.BytesIO(images[i]))
+        with zipfile.ZipFile(os.path.join(root, 'images.zip'), 'w') as archive:
+            for i in [5, 6, 7]:
+                archive.writestr('inner/%d.jpg' % i, images[i])
+        with stub.StubServer() as server:
+            with basilica.Connection(fake_key, server=server.url) as c:
+                expected = list(c.embed_images(images))
+                sources = [os.path.join(root, 'dir'), os.path.join(root, '*.jpg'),
+                           os.path.join(root, 'images.tar.gz'), os.path.join(root, 'images.zip')]
+                for io_workers in [0, 3]:
+                    embeddings = list(c.embed_image_files(sources, io_workers=io_workers, prefetch=2))
+                    self.assertEqual(expected, embeddings)
+                sources = [pathlib.Path(root, 'dir'), pathlib.Path(root, 'c.jpg')]
+                self.assertEqual(expected[:3], list(c.embed_image_files(sources)))
+                with self.assertRaises(TypeError):
+                    list(basilica.files.image_sources([3]))
+                with self.assertRaises(FileNotFoundError):
+                    list(basilica.files.image_sources([os.path.join(root, '*.png')]))
+
+                # `count` and resuming are in images, not paths.
+                class Crash(Exception):
+                    pass
+                def crash_at_5(i, e):
+                    if i == 5:
+                        raise Crash()
+                sources = [os.path.join(root, 'dir'), os.path.join(root, '*.jpg'),
+                           os.path.join(root, 'images.tar.gz'), os.path.join(root, 'images.zip')]
+                path = os.path.join(root, 'out.npy')
+                with self.assertRaises(Crash):
+                    c.embed_to_file(sources, path, method='embed_image_files', batch_size=2,
+                                    checkpoint_rows=2, progress=crash_at_5)
+                self.assertEqual(4, json.load(open(path + '.journal'))['done'])
+                out = c.embed_to_file(sources, path, method='embed_image_files', batch_size=2)
+                self.assertTrue(numpy.allclose(expected, out))
+                del out
+
+    def test_image_fast_path(self):
+        small = stub.fake_image((400, 300))
+        self.assertIs(small, basilica._transform_image(small, True))
+        for size in [(4032, 3024), (300, 1200)]:
+            out = Image.open(io.BytesIO(basilica._transform_image(stub.fake_image(size), True)))
+            self.assertEqual('JPEG', out.format)
+            self.assertEqual(512, max(out.size))
+        png = io.BytesIO()
+        Image.new('RGB', (64, 64)).save(png, 'PNG')
+        out = Image.open(io.BytesIO(basilica._transform_image(png.getvalue(), True)))
+        self.assertEqual(('JPEG', (64, 64)), (out.format, out.size))
+        big = stub.fake_image((2048, 2048))
+        self.assertLess(len(basilica._transform_image(big, True, jpeg_quality=10)),
+                        len(basilica._transform_image(big, True, jpeg_quality=95)))
+
+    def test_coalescing(self):
+        sentences = ['Sentence %d.' % i for i in range(64)]
+        results = {}
+        def call(c, s):
+            results[s] = c.embed_sentence(s)
+        with stub.StubServer(latency=0.05) as server:
+            with basilica.Connection(fake_key, server=server.url) as c:
+                coalescer = c.enable_coalescing(max_wait_ms=20, max_batch_size=16)
+                threads = [threading.Thread(target=call, args=(c, s)) for s in sentences]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                single = c.embed_sentence(sentences[0], output='numpy')
+                stats = coalescer.stats()
+        for s in sentences:
+            self.assertEqual(stub.fake_embedding(s, 512), results[s])
+        self.assertEqual((512,), single.shape)
+        self.assertTrue(server.requests <= 10)
+        self.assertEqual(65, stats['instances'])
+        self.assertEqual(server.requests, stats['batches'])
+        self.assertEqual(16, stats['max_batch_size'])
+        self.assertTrue(50 <= stats['p50_latency_ms'] <= stats['p99_latency_ms'])
+
+    def test_rate_limit(self):
+        sentences = ['Sentence %d.' % i for i in range(30)]
+        expected = [stub.fake_embedding(s, 512) for s in sentences]
+        limiter = basilica.RateLimiter(requests_per_second=50, burst=0.1)
+        with stub.StubServer() as server:
+            with basilica.Connection(fake_key, server=server.url, rate_limit=limiter) as c:
+                start = time.time()
+                embeddings = list(c.embed_sentences(sentences, batch_size=1, concurrency=4))
+                elapsed = time.time() - start
+        self.assertEqual(expected, embeddings)
+        # 5 requests fit in the burst, and the other 25 go at 50/s.
+        self.assertTrue(elapsed >= 0.45)
+
+        with stub.StubServer(throttle=3, retry_after='1') as server:
+            with basilica.Connection(fake_key, server=server.url) as c:
+                start = time.time()
+                embeddings = list(c.embed_sentences(sentences, batch_size=10, concurrency=3))
+                elapsed = time.time() - start
+                stats = c.rate_limit.stats()
+        self.assertEqual(expected, embeddings)
+        self.assertEqual(3, server.throttled)
+        self.assertEqual(3, stats['throttled'])
+        self.assertTrue(elapsed >= 1)
+
+        with stub.StubServer(throttle=100) as server:
+            with basilica.Connection(fake_key, server=server.url,
+                                     rate_limit=basilica.RateLimiter(retries=2, backoff_factor=0.01)) as c:
+                with six.assertRaisesRegex(self, requests.exceptions.HTTPError, r"^429 .*$"):
+                    list(c.embed_sentences(sentences[:1]))
+        self.assertEqual(3, server.throttled)
+
+    def test_metrics(self):
+        sentences = ['Sentence %d.' % i for i in range(40)]
+        stages = collections.Counter()
+        metrics = basilica.Metrics(hooks=[lambda name, duration, args: stages.update([name])])
+        with stub.StubServer(throttle=1, retry_after='0') as server:
+            with basilica.Connection(fake_key, server=server.url, metrics=metrics) as c:
+                embeddings = list(c.embed_sentences(sentences, batch_size=10, concurrency=2))
+        self.assertEqual(40, len(embeddings))
+        snapshot = metrics.snapshot()
+        counters = snapshot['counters']
+        self.assertEqual(40, counters['items'])
+        self.assertEqual(4, counters['batches'])
+        self.assertEqual(5, counters['requests'])
+        self.assertEqual(1, counters['throttled'])
+        self.assertEqual(1, counters['retries'])
+        # The throttled request isn't in the server's tally.
+        self.assertTrue(counters['bytes_sent'] > sum(server.batch_bytes))
+        self.assertTrue(counters['bytes_received'] > 40 * 512)
+        self.assertTrue(snapshot['items_per_second'] > 0)
+        for stage in ['queue_wait', 'preprocess_wait', 'batch', 'serialize', 'request', 'decode']:
+            self.assertTrue(stages[stage] > 0, stage)
+        self.assertEqual(4, stages['batch'])
+        self.assertEqual(5, snapshot['histograms']['request']['count'])
+        self.assertEqual(4, snapshot['histograms']['queue_depth']['count'])
+
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'trace.json')
+            metrics.export_trace(path)
+            with open(path) as f:
+                events = json.load(f)['traceEvents']
+        batches = [e for e in events if e['name'] == 'batch']
+        self.assertEqual([0, 1, 2, 3], sorted(e['args']['batch'] for e in batches))
+        self.assertTrue(all(e['ph'] == 'X' and e['dur'] >= 0 for e in batches))
+        self.assertTrue(any(e['ph'] == 'M' for e in events))
+
+    def test_faults(self):
+        sentences = ['Sentence %d.' % i for i in range(60)]
+        expected = [stub.fake_embedding(s, 512) for s in sentences]
+        with stub.StubServer(jitter=0.01, error_rate=0.2, timeout_rate=0.1, hang=0.5, seed=1) as server:
+            with basilica.Connection(fake_key, server=server.url, retries=10, backoff_factor=0.01) as c:
+                embeddings = list(c.embed_sentences(sentences, batch_size=3, timeout=0.2, concurrency=4))
+            self.assertEqual(expected, embeddings)
+            self.assertTrue(server.errors > 0)
+            self.assertTrue(server.timeouts > 0)
+            with basilica.Connection(fake_key, server=server.url) as c:
+                with six.assertRaisesRegex(self, requests.exceptions.HTTPError, r"^404 .*$"):
+                    c.raw_embed(server.url + '/nowhere', ['A sentence.'], opts={}, timeout=1)
+
+    def test_load_balancing(self):
+        sentences = ['Sentence %d.' % i for i in range(200)]
+        expected = [stub.fake_embedding(s, 512) for s in sentences]
+        with stub.StubServer(latency=0.01) as fast, stub.StubServer(latency=0.1) as slow, \
+             stub.StubServer(error_rate=1.0) as broken:
+            balancer = basilica.LoadBalancer([fast.url, slow.url, broken.url], eject_seconds=60)
+            with basilica.Connection(fake_key, server=balancer, retries=5, backoff_factor=0.01) as c:
+                embeddings = list(c.embed_sentences(sentences, batch_size=5, concurrency=4))
+        self.assertEqual(expected, embeddings)
+        stats = balancer.stats()
+        self.assertEqual('ejected', stats[broken.url]['state'])
+        # Requests already in flight when it was ejected fail too.
+        self.assertTrue(stats[broken.url]['failed'] >= 3)
+        self.assertEqual(1, stats[broken.url]['ejections'])
+        self.assertTrue(fast.requests > 2 * slow.requests > 0)
+        self.assertEqual(40, fast.requests + slow.requests)
+        self.assertEqual(0, sum(s['outstanding'] for s in stats.values()))
+
+        # An ejected endpoint gets one probe once it's due back.
+        balancer = basilica.LoadBalancer(['a', 'b'], max_failures=1, eject_seconds=0.05)
+        balancer.release(balancer.acquire(), 0.01, True)
+        balancer.release(balancer.acquire(), 0.01, True)
+        balancer.release(balancer.acquire(), 0.01, False)
+        ejected = [url for url, s in balancer.stats().items() if s['state'] == 'ejected']
+        self.assertEqual(1, len(ejected))
+        time.sleep(0.06)
+        self.assertEqual(ejected[0], balancer.acquire())
+        self.assertEqual('probing', balancer.stats()[ejected[0]]['state'])
+        self.assertNotEqual(ejected[0], balancer.acquire())
+        balancer.release(ejected[0], 0.01, True)
+        self.assertEqual('healthy', balancer.stats()[ejected[0]]['state'])
+
+    def test_hedging(self):
+        sentences = ['Sentence %d.' % i for i in range(100)]
+        expected = [stub.fake_embedding(s, 512) for s in sentences]
+        for budget in [0.5, 0.0]:
+            hedge = basilica.HedgePolicy(delay=0.1, budget=budget)
+            metrics = basilica.Metrics()
+            with stub.StubServer(latency=0.01, timeout_rate=0.1, hang=0.5) as server:
+                with basilica.Connection(fake_key, server=server.url, hedge=hedge, metrics=metrics) as c:
+                    embeddings = list(c.embed_sentences(sentences, batch_size=2, timeout=2, concurrency=4))
+            self.assertEqual(expected, embeddings)
+            stats = hedge.stats()
+            self.assertEqual(50, stats['requests'])
+            self.assertTrue(stats['hedges'] <= budget * 50)
+            if budget:
+                self.assertTrue(stats['wins'] > 0)
+                self.assertEqual(stats['hedges'], metrics.snapshot()['counters']['hedges'])
+            else:
+                self.assertEqual(0, stats['hedges'])
+
+        hedge = basilica.HedgePolicy(percentile=50, min_samples=3)
+        self.assertEqual(None, hedge.delay())
+        for latency in [0.1, 0.2, 0.3]:
+            hedge.record(latency)
+        self.assertEqual(0.2, hedge.delay())
+
+    def test_bisect(self):
+        sentences = ['Sentence %d.' % i for i in range(50)]
+        sentences[7] = sentences[30] = 'BAD sentence.'
+        with stub.StubServer(reject='BAD') as server:
+            with basilica.Connection(fake_key, server=server.url) as c:
+                with six.assertRaisesRegex(self, requests.exceptions.HTTPError, r"^400 .*$"):
+                    list(c.embed_sentences(sentences, batch_size=8))
+                embeddings = list(c.embed_sentences(sentences, batch_size=8, concurrency=2,
+                                                    on_error='bisect'))
+                array = c.embed_sentences(sentences, batch_size=8, on_error='bisect', output='numpy')
+        with stub.StubServer(reject='BAD') as server:
+            with basilica.Connection(fake_key, server=server.url, wire_format='float32') as c:
+                binary = list(c.embed_sentences(sentences, batch_size=8, on_error='bisect'))
+        self.assertEqual([7, 30], [i for i, e in enumerate(binary) if isinstance(e, basilica.EmbeddingError)])
+        self.assertTrue(numpy.allclose(stub.fake_embedding(sentences[6], 512), binary[6]))
+        # A server outage isn't down to the instances, so it isn't bisected.
+        with stub.StubServer(error_rate=1.0) as server:
+            with basilica.Connection(fake_key, server=server.url, retries=0) as c:
+                with six.assertRaisesRegex(self, requests.exceptions.HTTPError, r"^500 .*$"):
+                    list(c.embed_sentences(sentences, batch_size=8, on_error='bisect'))
+            self.assertEqual(1, server.errors)
+        for i, s in enumerate(sentences):
+            if i in (7, 30):
+                self.assertTrue(isinstance(embeddings[i], basilica.EmbeddingError))
+                self.assertEqual(400, embeddings[i].error.response.status_code)
+                self.assertTrue(numpy.isnan(array[i]).all())
+            else:
+                self.assertEqual(stub.fake_embedding(s, 512), embeddings[i])
+                self.assertTrue(numpy.allclose(stub.fake_embedding(s, 512), array[i]))
+
+        images = [stub.fake_image((32, 32), seed=i) for i in range(6)]
+        images[0] = images[4] = b'not an image'
+        with stub.StubServer() as server:
+            with basilica.Connection(fake_key, server=server.url) as c:
+                for workers in [0, 2]:
+                    embeddings = list(c.embed_images(images, batch_size=4, preprocess_workers=workers,
+                                                     on_error='bisect'))
+                    self.assertEqual([True, False, False, False, True, False],
+                                     [isinstance(e, basilica.EmbeddingError) for e in embeddings])
+                    self.assertTrue(isinstance(embeddings[0].error, TypeError))
+                # Leading errors don't trip up the dimension check.
+                with tempfile.TemporaryDirectory() as root:
+                    out = c.embed_to_file(images, os.path.join(root, 'out.npy'), method='embed_images',
+                                          checkpoint_rows=1, on_error='bisect')
+                    self.assertEqual((6, 512), out.shape)
+                    self.assertEqual([True, False, False, False, True, False],
+                                     [bool(numpy.isnan(row).all()) for row in out])
+                    del out
+
+    def test_connection_pool(self):
+        sentences = ['Sentence %d.' % i for i in range(60)]
+        expected = [stub.fake_embedding(s, 512) for s in sentences]
+        with stub.StubServer(latency=0.02) as server:
+            with basilica.Connection(fake_key, server=server.url, pool_size=3, pool_block=True,
+                                     prewarm=3) as c:
+                self.assertEqual(3, server.connections)
+                embeddings = list(c.embed_sentences(sentences, batch_size=5, concurrency=6))
+            self.assertEqual(expected, embeddings)
+            self.assertEqual(3, server.connections)
+            self.assertTrue(server.max_in_flight <= 3)
+
+            with basilica.Connection(fake_key, server=server.url, keepalive_timeout=0.05) as c:
+                c.embed_sentence('A sentence.')
+                c.embed_sentence('A sentence.')
+                time.sleep(0.1)
+                c.embed_sentence('A sentence.')
+            self.assertEqual(5, server.connections)
+
+    def test_http2_transport(self):
+        sentences = ['Sentence %d.' % i for i in range(30)]
+        expected = [stub.fake_embedding(s, 512) for s in sentences]
+        # The stub only speaks HTTP/1.1, which httpx falls back to.
+        with stub.StubServer(reject='BAD', timeout_rate=0.0, hang=0.5) as server:
+            with basilica.Connection(fake_key, server=server.url, transport='http2', prewarm=1,
+                                     wire_format='float32') as c:
+                embeddings = list(c.embed_sentences(sentences, batch_size=5, concurrency=3))
+                self.assertTrue(numpy.allclose(expected, embeddings))
+                with six.assertRaisesRegex(self, requests.exceptions.HTTPError, r"^400 .*$"):
+                    c.embed_sentence('BAD sentence.')
+                server.timeout_rate = 1.0
+                with self.assertRaises(requests.exceptions.ReadTimeout):
+                    c.embed_sentence('A sentence.', timeout=0.1)
+        with stub.StubServer(latency=0.02) as server:
+            with basilica.Connection(fake_key, server=server.url, transport='http2',
+                                     pool_size=1, pool_block=True) as c:
+                embeddings = list(c.embed_sentences(sentences, batch_size=5, concurrency=3))
+                self.assertTrue(numpy.allclose(expected, embeddings))
+            self.assertEqual(1, server.connections)
+            with basilica.Connection(fake_key, server=server.url, transport='http2', pool_size=1) as c:
+                list(c.embed_sentences(sentences, batch_size=5, concurrency=3))
+            self.assertTrue(server.connections > 2)
+            with basilica.Connection(fake_key, server=server.url, transport='http2', retries=0) as c:
+                c.session.proxies = {'http': 'http://127.0.0.1:1'}
+                with self.assertRaises(requests.exceptions.ConnectionError):
+                    c.embed_sentence('A sentence.')
+
+    def test_index(self):
+        sentences = ['Sentence %d.' % i for i in range(50)]
+        with stub.StubServer() as server:
+            with basilica.Connection(fake_key, server=server.url) as c:
+                embeddings = list(c.embed_sentences(sentences))
+                index = basilica.EmbeddingIndex()
+                self.assertEqual(50, index.add(c.embed_sentences(sentences, batch_size=7)))
+                distances, ids = index.search(c.embed_sentences(sentences[:3]), k=5)
+        self.assertEqual([0, 1, 2], list(ids[:, 0]))
+        for j in range(5):
+            self.assertAlmostEqual(spatial.distance.cosine(embeddings[0], embeddings[ids[0, j]]),
+                                   distances[0, j], places=5)
+        _, ids = index.search(embeddings[0], k=100)
+        self.assertEqual(list(range(50)), sorted(ids[0, :50]))
+        self.assertEqual([-1] * 50, list(ids[0, 50:]))
+        index = basilica.EmbeddingIndex(metric='l2')
+        index.add([[0.0, 0.0], basilica.EmbeddingError('bad'), [3.0, 4.0]], ids=[10, 11, 12])
+        self.assertEqual(2, len(index))
+        distances, ids = index.search([[0.0, 1.0]], k=2)
+        self.assertEqual([10, 12], list(ids[0]))
+        self.assertTrue(numpy.allclose([1.0, numpy.sqrt(18.0)], distances[0]))
+
+    def test_index_approximate(self):
+        rng = numpy.random.RandomState(0)
+        centers = rng.randn(50, 32)
+        data = centers[rng.randint(50, size=5000)] + 0.2 * rng.randn(5000, 32)
+        queries = data[:100] + 0.01 * rng.randn(100, 32)
+        for metric in ['cosine', 'l2']:
+            index = basilica.EmbeddingIndex(metric=metric)
+            index.add(data)
+            _, exact = index.search(queries, k=10)
+            index.train(iterations=10)
+            _, approximate = index.search(queries, k=10, nprobe=8)
+            recall = numpy.mean([len(set(a) & set(b)) / 10.0 for a, b in zip(exact, approximate)])
+            self.assertTrue(recall > 0.9, recall)
+            _, nearest = index.search(queries, k=10, nprobe=1)
+            self.assertEqual((100, 10), nearest.shape)
+            self.assertTrue((nearest[:, 0] >= 0).all())
+            root = tempfile.mkdtemp()
+            index.save(root)
+            loaded = basilica.EmbeddingIndex.load(root)
+            self.assertIsInstance(loaded.vectors, numpy.memmap)
+            self.assertTrue((approximate == loaded.search(queries, k=10, nprobe=8)[1]).all())
+            self.assertTrue((exact == loaded.search(queries, k=10, exact=True)[1]).all())
+            loaded.add(queries[:1])
+            self.assertEqual(5000, loaded.search(queries[:1], k=1)[1][0, 0])
+            # Saving over the files a loaded index has mapped.
+            loaded = basilica.EmbeddingIndex.load(root)
+            loaded.train(clusters=20, iterations=5)
+            _, retrained = loaded.search(queries, k=10, nprobe=4)
+            loaded.save(root)
+            self.assertTrue((exact == loaded.search(queries, k=10, exact=True)[1]).all())
+            reloaded = basilica.EmbeddingIndex.load(root)
+            self.assertEqual(20, len(reloaded.centroids))
+            self.assertTrue((retrained == reloaded.search(queries, k=10, nprobe=4)[1]).all())
+            self.assertEqual([], [name for name in os.listdir(root) if '.tmp' in name])
+            # With one cluster, searching it is the same as an exact search.
+            index.train(clusters=1)
+            self.assertTrue(numpy.allclose(index.search(queries, k=10, exact=True)[0],
+                                           index.search(queries, k=10)[0], atol=1e-3))
+
+    def test_quantized_output(self):
+        sentences = ['Sentence %d.' % i for i in range(40)]
+        with stub.StubServer(reject='BAD') as server:
+            with basilica.Connection(fake_key, server=server.url) as c:
+                expected = c.embed_sentences(sentences, output='numpy')
+                for output, bytes_per_value, tolerance in [('float16', 2, 1e-3), ('int8', 1, 1e-2)]:
+                    quantized = c.embed_sentences(sentences, batch_size=7, output=output)
+                    self.assertEqual((40, 512), quantized.shape)
+                    self.assertEqual(40 * (512 * bytes_per_value + 4), quantized.nbytes)
+                    self.assertTrue(numpy.allclose(expected, basilica.dequantize(quantized), atol=tolerance))
+                    similarity = basilica.cosine_similarity(expected[:3], quantized)
+                    self.assertEqual([0, 1, 2], list(similarity.argmax(axis=1)))
+                    self.assertTrue(numpy.allclose(basilica.cosine_similarity(expected[:3], expected),
+                                                   similarity, atol=tolerance))
+                quantizer = basilica.Quantizer('int8', scale='dimension').fit(expected)
+                quantized = c.embed_sentences(sentences[:5] + ['BAD'] + sentences[5:], output=quantizer,
+                                              on_error='bisect')
+                self.assertTrue(numpy.isnan(quantized.dequantize(5, 6)).all())
+                self.assertTrue(numpy.allclose(expected, numpy.delete(quantized.dequantize(), 5, axis=0),
+                                               atol=1e-2))
+                self.assertTrue(numpy.allclose(numpy.dot(expected[:2], expected.T),
+                                               numpy.delete(basilica.dot(expected[:2], quantized), 5, axis=1),
+                                               rtol=1e-2, atol=0.5))
+                with self.assertRaises(ValueError):
+                    c.embed_sentence('A sentence.', output='int8')
+
+    def test_sharded_job(self):
+        sentences = ['Sentence %d.' % i for i in range(95)]
+        expected = [stub.fake_embedding(s, 512) for s in sentences]
+        root = tempfile.mkdtemp()
+        manifest = os.path.join(root, 'sentences.txt')
+        with open(manifest, 'w') as f:
+            f.write('\n'.join(sentences) + '\n')
+        with stub.StubServer() as server:
+            with basilica.ShardedJob(os.path.join(root, 'job'), manifest=manifest, method='embed_sentences',
+                                     shard_size=10, lease_seconds=0.5) as job:
+                self.assertEqual(10, job.status()['pending'])
+                # A worker that crashed holding the first shard.
+                self.assertEqual((0, 0, 10), job.lease('crashed'))
+                self.assertEqual(4, job.work(fake_key, server=server.url, max_shards=4, batch_size=4))
+                self.assertEqual({'shards': 10, 'pending': 5, 'leased': 1, 'done': 4, 'failed': 0,
+                                  'reclaimed': 0}, job.status())
+                time.sleep(0.6)
+                status = job.run(fake_key, workers=2, server=server.url, batch_size=4)
+                self.assertEqual((10, 1), (status['done'], status['reclaimed']))
+                # The crashed worker has lost its lease, so can't hand in its shard.
+                stale = os.path.join(root, 'stale.npy')
+                numpy.save(stale, numpy.zeros((10, 512), dtype=numpy.float32))
+                self.assertFalse(job.renew(0, 'crashed'))
+                self.assertFalse(job.complete(0, 'crashed', stale))
+                self.assertTrue(numpy.allclose(expected, job.merge(os.path.join(root, 'out.npy'))))
+            with basilica.ShardedJob(os.path.join(root, 'job')) as job:
+                self.assertEqual(10, job.status()['done'])
+                with self.assertRaises(ValueError):
+                    basilica.ShardedJob(os.path.join(root, 'job'), manifest=manifest, shard_size=7)
+
+    def test_cli(self):
+        import basilica.cli
+        sentences = ['Sentence %d.' % i for i in range(40)]
+        root = tempfile.mkdtemp()
+        with open(os.path.join(root, 'in.csv'), 'w') as f:
+            f.write('id,text\n' + ''.join('%d,%s\n' % (i, s) for i, s in enumerate(sentences)))
+        with open(os.path.join(root, 'in.txt'), 'w') as f:
+            f.write(''.join(s + '\n' for s in sentences))
+        os.mkdir(os.path.join(root, 'images'))
+        for i in range(5):
+            with open(os.path.join(root, 'images', '%d.jpg' % i), 'wb') as f:
+                f.write(stub.fake_image((16, 16), seed=i))
+        with stub.StubServer() as server:
+            def run(*args):
+                return basilica.cli.main(['--key', fake_key, '--server', server.url, '--quiet'] + list(args))
+
+            out = os.path.join(root, 'out.jsonl')
+            self.assertEqual(0, run(os.path.join(root, 'in.csv'), '-o', out, '--batch-size', '8'))
+            with open(out) as f:
+                rows = [json.loads(line) for line in f]
+            self.assertEqual(list(range(40)), [r['index'] for r in rows])
+            self.assertTrue(numpy.allclose([stub.fake_embedding(s, 512) for s in sentences],
+                                           [r['embedding'] for r in rows]))
+            # Resuming keeps the complete lines and redoes the rest.
+            with open(out, 'rb+') as f:
+                f.truncate(len(b''.join(f.readlines()[:25])) + 10)
+            items = server.items
+            self.assertEqual(0, run(os.path.join(root, 'in.csv'), '-o', out, '--resume'))
+            self.assertEqual(items + 15, server.items)
+            with open(out) as f:
+                self.assertEqual(rows, [json.loads(line) for line in f])
+
+            with open(os.path.join(root, 'in.tsv'), 'w') as f:
+                f.write('id\ttext\n' + ''.join('%d\t%s\n' % (i, s) for i, s in enumerate(sentences)))
+            self.assertEqual(0, run(os.path.join(root, 'in.tsv'), '-o', out))
+            with open(out) as f:
+                self.assertEqual(rows, [json.loads(line) for line in f])
+
+            out = os.path.join(root, 'out.npy')
+            self.assertEqual(0, run(os.path.join(root, 'in.txt'), '-o', out, '--dimensions', '16'))
+            self.assertEqual((40, 16), numpy.load(out).shape)
+
+            out = os.path.join(root, 'images.npy')
+            self.assertEqual(0, run(os.path.join(root, 'images'), '-o', out))
+            self.assertEqual((5, 512), numpy.load(out).shape)
+
+            # A rejected line is written as an error, and the exit status says so.
+            with open(os.path.join(root, 'bad.txt'), 'w') as f:
+                f.write(''.join(s + '\n' for s in sentences[:5] + ['BAD sentence.'] + sentences[5:10]))
+            server.reject = 'BAD'
+            out = os.path.join(root, 'bad.jsonl')
+            self.assertEqual(1, run(os.path.join(root, 'bad.txt'), '-o', out))
+            with open(out) as f:
+                rows = [json.loads(line) for line in f]
+            self.assertEqual([5], [r['index'] for r in rows if 'error' in r])
+            self.assertEqual(11, len(rows))
+            out = os.path.join(root, 'bad.npy')
+            self.assertEqual(1, run(os.path.join(root, 'bad.txt'), '-o', out))
+            self.assertEqual([5], [i for i, row in enumerate(numpy.load(out)) if numpy.isnan(row).all()])
+
+    def test_async(self):
+        import asyncio
+        import basilica.aio
+        async def run(url):
+            async with basilica.aio.AsyncConnection(fake_key, server=url) as c:
+                single = await c.embed_sentence(sentences_small[0])
+                embeddings = [e async for e in c.embed_sentences(sentences_large, batch_size=16)]
+                return single, embeddings
+        with stub.StubServer(latency=0.01) as server:
+            single, embeddings = asyncio.run(run(server.url))
+        self.assertEqual(stub.fake_embedding(sentences_small[0], 512), single)
+        self.assertEqual(768, len(embeddings))
+        for s, e in zip(sentences_large, embeddings):
+            self.assertEqual(stub.fake_embedding(s, 512), e)
+        self.assertTrue(server.max_in_flight > 1)
+
 if __name__ == "__main__":
     unittest.main()